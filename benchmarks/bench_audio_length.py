@@ -0,0 +1,102 @@
+#!/bin/env python3
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import docopt
+import json
+import time
+import wave
+import tempfile
+import subprocess
+
+from pathlib import Path
+
+from tavox.audio import read_audio_length
+from tavox.external_tools import ffprobe_get_audio_length, _get_ffmpeg_bin
+
+usage_msg = """
+Compares the native audio length parser with ffprobe.
+
+Usage:
+  bench_audio_length.py [--files N --json PATH]
+
+Options:
+  --files N    Number of files per format [default: 200].
+  --json PATH  Write the results to a JSON file.
+"""
+
+
+def _create_files(directory: Path, num_files: int) -> dict[str, list[Path]]:
+	files = {"wav": [], "flac": [], "mp3": []}
+	for i in range(num_files):
+		path = directory / f"sample{i}.wav"
+		with wave.open(str(path), "wb") as w:
+			w.setnchannels(1)
+			w.setsampwidth(2)
+			w.setframerate(24000)
+			w.writeframes(b"\0\0" * (24000 + 97 * i))
+		files["wav"].append(path)
+
+		for fmt in ("flac", "mp3"):
+			encoded = path.with_suffix(f".{fmt}")
+			r = subprocess.run([_get_ffmpeg_bin(), "-v", "quiet", "-i", str(path), str(encoded)])
+			if r.returncode == 0:
+				files[fmt].append(encoded)
+	return files
+
+
+def _measure(fn, files: list[Path]) -> tuple[float, list[float]]:
+	start = time.perf_counter()
+	lengths = [fn(x) for x in files]
+	return time.perf_counter() - start, lengths
+
+
+def main():
+	options = docopt.docopt(usage_msg)
+	results = {}
+	with tempfile.TemporaryDirectory(prefix="tavox_bench_") as tmp_dir:
+		files = _create_files(Path(tmp_dir), int(options["--files"]))
+		for fmt, paths in files.items():
+			if len(paths) == 0:
+				continue
+			native_time, native_lengths = _measure(read_audio_length, paths)
+			ffprobe_time, ffprobe_lengths = _measure(ffprobe_get_audio_length, paths)
+			results[fmt] = {
+				"files": len(paths),
+				"native_s": native_time,
+				"ffprobe_s": ffprobe_time,
+				"speedup": ffprobe_time / native_time,
+				"max_abs_diff_s": max(abs(a - b) for a, b in zip(native_lengths, ffprobe_lengths)),
+			}
+
+	print(f"{'format':<8}{'files':>7}{'native [ms/file]':>18}{'ffprobe [ms/file]':>19}{'speedup':>10}{'max diff [s]':>14}")
+	for fmt, r in results.items():
+		print(
+			f"{fmt:<8}{r['files']:>7}{r['native_s'] / r['files'] * 1000:>18.3f}{r['ffprobe_s'] / r['files'] * 1000:>19.3f}"
+			f"{r['speedup']:>10.1f}{r['max_abs_diff_s']:>14.4f}"
+		)
+
+	if options["--json"]:
+		with open(options["--json"], "w") as f:
+			json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+	main()
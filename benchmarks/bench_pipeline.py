@@ -0,0 +1,375 @@
+#!/bin/env python3
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import sys
+import json
+import time
+import wave
+import base64
+import shutil
+import random
+import inspect
+import resource
+import tempfile
+import subprocess
+
+from pathlib import Path
+from collections import Counter
+
+import docopt
+import tavox
+import tavox.mlt
+
+from tavox import Voice
+
+usage_msg = """
+Measures the MLT project creation (create_mlt) on synthetic decks. Every deck is built twice in a separate
+process: "cold" with an empty cache and "warm" with all voice samples and slides cached. The voice samples are
+generated by an in-process fake voice, pdftoppm, ffprobe and ffmpeg are replaced by stubs unless --real-tools
+is given, such that the benchmark runs offline.
+
+Usage:
+  bench_pipeline.py [--slides LIST --seed N --real-tools --separate-audio --json PATH --keep]
+  bench_pipeline.py --single DIR --mode MODE [--real-tools --separate-audio]
+
+Options:
+  --slides LIST     Comma-separated numbers of slides of the decks [default: 10,100,1000,5000].
+  --seed N          Seed of the generated scripts [default: 0].
+  --real-tools      Use the installed pdftoppm, ffprobe and ffmpeg instead of the stubs.
+  --separate-audio  Don't premix the audio track.
+  --json PATH       Write the results to a JSON file.
+  --keep            Keep the generated decks and caches (their location is printed).
+  --single DIR      Internal: build the deck in DIR and print the measurements as JSON.
+  --mode MODE       Internal: "cold" or "warm".
+"""
+
+# the stages of create_mlt, generator stages are timed whenever they produce an event
+_STAGES = [
+	"_render_pdfs",
+	"_synthesize_samples",
+	"_probe_audio_files",
+	"_remove_unnecessary_cuts",
+	"_merge_speak_events",
+	"_process_slide_events",
+	"_process_audio_events",
+	"_create_mlt_playlists",
+	"_mix_audio_track",
+	"_create_mlt_project_file",
+]
+
+# audit events that are not caused by the pipeline itself
+_IGNORED_AUDIT_EVENTS = {"sys._getframe", "object.__getattr__", "object.__setattr__", "builtins.id", "compile", "exec", "import", "marshal.loads"}
+
+# length of the fake voice samples (in seconds per word) and of the stubbed audio files
+_WORD_DURATION = 0.05
+_STUB_AUDIO_DURATION = 2.0
+_AUDIO_SAMPLE_RATE = 48000
+
+# 1x1 grey PNG
+_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAAAAAA6fptVAAAACklEQVR4nGNoAAAAggCBd81ytgAAAABJRU5ErkJggg==")
+
+_STUBS = {
+	"pdftoppm": f"""
+import re, sys
+args = sys.argv[1:]
+with open(args[-2], "rb") as f:
+	num_pages = int(re.search(rb"/Count (\\d+)", f.read()).group(1))
+first = int(args[args.index("-f") + 1]) if "-f" in args else 1
+last = int(args[args.index("-l") + 1]) if "-l" in args else num_pages
+for page in range(first, last + 1):
+	with open(f"{{args[-1]}}-{{page:0{{len(str(num_pages))}}d}}.png", "wb") as f:
+		f.write({_PNG!r})
+""",
+	"pdfinfo": """
+import re, sys
+with open(sys.argv[-1], "rb") as f:
+	num_pages = int(re.search(rb"/Count (\\d+)", f.read()).group(1))
+print(f"Pages: {num_pages}")
+""",
+	"ffprobe": f"""
+print({_STUB_AUDIO_DURATION})
+""",
+	"ffmpeg": f"""
+import sys
+args = sys.argv[1:]
+if "-encoders" in args:
+	print(" V..... libx264 H.264")
+elif "s16le" in args:
+	# decoding of audio files into raw PCM (one output per input), the stubbed files consist of silence
+	for i, arg in enumerate(args):
+		if arg == "-ar":
+			with open(args[i + 2], "wb") as f:
+				f.write(bytes(4 * int({_STUB_AUDIO_DURATION} * int(args[i + 1]))))
+else:
+	sys.exit("unsupported ffmpeg invocation")
+""",
+}
+
+_WORDS = "slide shows the results of our analysis and the next steps we are going to take for the evaluation of the new design".split()
+
+
+def _write_pdf(path: Path, num_pages: int):
+	# every page has a different content stream, such that the slide cache keys, which are content hashes, all differ
+	objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+	kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(num_pages))
+	objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {num_pages} /MediaBox [0 0 1600 900] >>".encode("ascii"))
+	for i in range(num_pages):
+		content = f"{(i % 10) / 10} g {i % 1500} {(i // 1500) % 800} 100 100 re f".encode("ascii")
+		objects.append(f"<< /Type /Page /Parent 2 0 R /Contents {4 + 2 * i} 0 R /Resources << >> >>".encode("ascii"))
+		objects.append(f"<< /Length {len(content)} >>\nstream\n".encode("ascii") + content + b"\nendstream")
+
+	with open(path, "wb") as f:
+		f.write(b"%PDF-1.4\n")
+		offsets = []
+		for i, obj in enumerate(objects):
+			offsets.append(f.tell())
+			f.write(f"{i + 1} 0 obj\n".encode("ascii") + obj + b"\nendobj\n")
+		xref = f.tell()
+		f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii"))
+		for offset in offsets:
+			f.write(f"{offset:010d} 00000 n \n".encode("ascii"))
+		f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("ascii"))
+
+
+def _write_script(path: Path, num_slides: int, seed: int):
+	# mostly single slides with a few sentences, a slide range, a delay or an audio file now and then
+	rng = random.Random(seed)
+	lines = ["set_voice(\"bench\")", "set_pdf(\"deck.pdf\")"]
+	slide = 1
+	while slide <= num_slides:
+		if slide + 2 <= num_slides and rng.random() < 0.05:
+			lines.append(f"show_slide_range({slide}, {slide + 2})")
+			slide += 3
+		else:
+			lines.append(f"show_slide({slide})")
+			slide += 1
+		for _ in range(rng.randint(1, 3)):
+			words = rng.choices(_WORDS, k=rng.randint(4, 12))
+			lines.append(f"speak(\"{' '.join(words).capitalize()}.\")")
+		if rng.random() < 0.1:
+			lines.append(f"delay({rng.choice([0.25, 0.5, 1])})")
+		if rng.random() < 0.02:
+			lines.append("play_audio(\"music.ogg\")")
+	path.write_text("\n".join(lines) + "\n")
+
+
+def _write_audio_file(path: Path, real_tools: bool):
+	if real_tools:
+		subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"sine=d={_STUB_AUDIO_DURATION}", str(path)], check=True)
+	else:
+		# the stubbed ffprobe and ffmpeg never read the file
+		path.write_bytes(b"OggS")
+
+
+def _create_stubs(directory: Path):
+	directory.mkdir(exist_ok=True)
+	for name, code in _STUBS.items():
+		stub = directory / name
+		stub.write_text(f"#!{sys.executable}\n{code}")
+		stub.chmod(0o755)
+
+
+class _BenchVoice(Voice):
+	"""
+	Deterministic fake voice, the length of a sample is proportional to the number of words of the text.
+	"""
+
+	@property
+	def voice_id(self) -> str:
+		return "bench/fake"
+
+	def generate_sample(self, text: str, dir_path: str | os.PathLike):
+		with wave.open(f"{dir_path}/sample.wav", "wb") as w:
+			w.setnchannels(1)
+			w.setsampwidth(2)
+			w.setframerate(_AUDIO_SAMPLE_RATE)
+			w.writeframes(bytes(2 * int(len(text.split()) * _WORD_DURATION * _AUDIO_SAMPLE_RATE)))
+
+
+class _StageTimer:
+	"""
+	Attributes the elapsed time to the innermost active stage, such that the times of nested stages (i.e., chained
+	generators) are not counted twice.
+	"""
+
+	def __init__(self):
+		self.times = Counter()
+		self._stack = []
+		self._last = time.perf_counter()
+
+	def enter(self, name: str):
+		now = time.perf_counter()
+		if len(self._stack) > 0:
+			self.times[self._stack[-1]] += now - self._last
+		self._stack.append(name)
+		self._last = now
+
+	def exit(self):
+		now = time.perf_counter()
+		self.times[self._stack.pop()] += now - self._last
+		self._last = now
+
+	def wrap(self, name: str, fn):
+		if inspect.isgeneratorfunction(fn):
+			def wrapper(*args, **kwargs):
+				generator = fn(*args, **kwargs)
+				while True:
+					self.enter(name)
+					try:
+						event = next(generator)
+					except StopIteration:
+						return
+					finally:
+						self.exit()
+					yield event
+		else:
+			def wrapper(*args, **kwargs):
+				self.enter(name)
+				try:
+					return fn(*args, **kwargs)
+				finally:
+					self.exit()
+		return wrapper
+
+
+def _read_proc_io() -> dict[str, int] | None:
+	try:
+		with open("/proc/self/io") as f:
+			return {k: int(v) for k, v in (line.split(":") for line in f)}
+	except OSError:
+		return None
+
+
+def _run_single(work_dir: Path, mode: str, separate_audio: bool) -> dict:
+	timer = _StageTimer()
+	for stage in _STAGES:
+		setattr(tavox.mlt, stage, timer.wrap(stage, getattr(tavox.mlt, stage)))
+
+	audit_events = Counter()
+	subprocesses = Counter()
+
+	def audit_hook(event: str, args):
+		if event in _IGNORED_AUDIT_EVENTS:
+			return
+		audit_events[event] += 1
+		if event == "subprocess.Popen":
+			subprocesses[Path(str(args[0])).name] += 1
+
+	tavox.register_voice("bench", _BenchVoice())
+	project = tavox.TavoxProject()
+	tavox.activate_project(project)
+	# the slides are stored next to the project file (in a directory named like the PDF)
+	(work_dir / mode).mkdir()
+	mlt_project_file = work_dir / mode / "project.mlt"
+	sample_db = tavox.SampleDB(work_dir / "cache")
+
+	io_before = _read_proc_io()
+	sys.addaudithook(audit_hook)
+	start = time.perf_counter()
+
+	timer.enter("script")
+	os.chdir(work_dir)
+	namespace = {}
+	exec("from tavox import *\nfrom tavox.script import play_audio", namespace)
+	exec(compile((work_dir / "deck.tavox").read_text(), "deck.tavox", "exec"), namespace)
+	timer.exit()
+
+	tavox.create_mlt(project, mlt_project_file, sample_db=sample_db, premix_audio=not separate_audio)
+	sample_db.close()
+
+	total = time.perf_counter() - start
+	io_after = _read_proc_io()
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return {
+		"mode": mode,
+		"events": len(project.timeline),
+		"total_s": total,
+		"stages_s": dict(timer.times),
+		"subprocesses": dict(subprocesses),
+		"audit_events": dict(audit_events),
+		"syscalls": {k: io_after[k] - io_before[k] for k in ("syscr", "syscw", "rchar", "wchar")} if io_before is not None else None,
+		"peak_rss_mb": usage.ru_maxrss / 1024,
+		"cpu_s": usage.ru_utime + usage.ru_stime,
+		"children_cpu_s": children.ru_utime + children.ru_stime,
+	}
+
+
+def _run_deck(work_dir: Path, mode: str, options: dict) -> dict:
+	env = dict(os.environ)
+	if not options["--real-tools"]:
+		env["PATH"] = f"{work_dir.parent / 'stubs'}{os.pathsep}{env['PATH']}"
+	command = [sys.executable, __file__, "--single", str(work_dir), "--mode", mode]
+	for flag in ("--real-tools", "--separate-audio"):
+		if options[flag]:
+			command.append(flag)
+	r = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True)
+	if r.returncode != 0:
+		raise RuntimeError(f"benchmark of {work_dir} ({mode}) failed")
+	return json.loads(r.stdout.splitlines()[-1])
+
+
+def main():
+	options = docopt.docopt(usage_msg)
+
+	if options["--single"]:
+		print(json.dumps(_run_single(Path(options["--single"]), options["--mode"], options["--separate-audio"])))
+		return
+
+	slide_counts = [int(x) for x in options["--slides"].split(",")]
+	tmp_dir = tempfile.mkdtemp(prefix="tavox_bench_")
+	results = {"python": sys.version, "real_tools": options["--real-tools"], "separate_audio": options["--separate-audio"], "decks": []}
+	_create_stubs(Path(tmp_dir) / "stubs")
+
+	for num_slides in slide_counts:
+		work_dir = Path(tmp_dir) / f"deck{num_slides}"
+		work_dir.mkdir()
+		_write_pdf(work_dir / "deck.pdf", num_slides)
+		_write_script(work_dir / "deck.tavox", num_slides, int(options["--seed"]))
+		_write_audio_file(work_dir / "music.ogg", options["--real-tools"])
+		for mode in ("cold", "warm"):
+			r = _run_deck(work_dir, mode, options)
+			r["slides"] = num_slides
+			results["decks"].append(r)
+
+	print(f"{'slides':>7}{'events':>8}{'mode':>6}{'total [s]':>11}{'subproc':>9}{'opens':>8}{'syscalls':>10}{'rss [MiB]':>11}  slowest stages")
+	for r in results["decks"]:
+		slowest = sorted(r["stages_s"].items(), key=lambda x: -x[1])[:3]
+		syscalls = r["syscalls"]["syscr"] + r["syscalls"]["syscw"] if r["syscalls"] is not None else float("nan")
+		print(
+			f"{r['slides']:>7}{r['events']:>8}{r['mode']:>6}{r['total_s']:>11.3f}{sum(r['subprocesses'].values()):>9}"
+			f"{r['audit_events'].get('open', 0):>8}{syscalls:>10}{r['peak_rss_mb']:>11.1f}  "
+			+ ", ".join(f"{name.strip('_')} {t:.3f}s" for name, t in slowest)
+		)
+
+	if options["--json"]:
+		with open(options["--json"], "w") as f:
+			json.dump(results, f, indent=2)
+
+	if options["--keep"]:
+		print(f"decks and caches kept in {tmp_dir}")
+	else:
+		shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+	main()
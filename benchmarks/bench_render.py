@@ -0,0 +1,180 @@
+#!/bin/env python3
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import json
+import time
+import shutil
+import resource
+import tempfile
+
+from pathlib import Path
+
+import docopt
+
+from tavox import TavoxProject, SampleDB, ChunkCache, create_mlt, get_render_profile, render_segmented, render_chunked, render_ffmpeg
+from tavox.external_tools import ffmpeg_get_encoders, _get_melt_bin
+
+from bench_pipeline import _write_pdf
+
+usage_msg = """
+Measures the render throughput of a synthetic deck of fixed length for every combination of render profile,
+backend and video encoder. Reports the realtime factor (seconds of video per second of wall-clock time), the
+CPU utilization and the bitrate of the video. Requires pdftoppm, ffmpeg and (for the melt backends) melt.
+
+Usage:
+  bench_render.py [--length SECONDS --slides N --profiles LIST --backends LIST --encoders LIST --json PATH --keep]
+
+Options:
+  --length SECONDS  Length of the video [default: 120].
+  --slides N        Number of slides of the deck [default: 20].
+  --profiles LIST   Comma-separated render profiles [default: draft,final].
+  --backends LIST   Comma-separated backends: melt (a single melt process), melt-segmented (parallel melt
+                    processes), melt-chunked (per-slide chunks, empty chunk cache) and ffmpeg
+                    [default: melt,melt-segmented,melt-chunked,ffmpeg].
+  --encoders LIST   Comma-separated video encoders, by default all available ones of libx264, libopenh264,
+                    libx265, libvpx-vp9 and libsvtav1 are used [default: auto].
+  --json PATH       Write the results to a JSON file.
+  --keep            Keep the generated deck and videos (their location is printed).
+"""
+
+_ENCODERS = ["libx264", "libopenh264", "libx265", "libvpx-vp9", "libsvtav1"]
+
+
+def _available_backends(backends: list[str]) -> list[str]:
+	try:
+		_get_melt_bin()
+		return backends
+	except Exception:
+		print("melt not found, skipping the melt backends")
+		return [x for x in backends if not x.startswith("melt")]
+
+
+def _build_project(work_dir: Path, profile: str, length: float, num_slides: int) -> Path:
+	project = TavoxProject()
+	project.set_render_profile(profile)
+	project.set_pdf(work_dir / "deck.pdf")
+	for slide in range(1, num_slides + 1):
+		project.show_slide(slide)
+		project.delay(length / num_slides)
+
+	build_dir = work_dir / profile
+	build_dir.mkdir()
+	mlt_project_file = build_dir / "project.mlt"
+	sample_db = SampleDB(work_dir / "cache")
+	try:
+		create_mlt(project, mlt_project_file, sample_db=sample_db)
+	finally:
+		sample_db.close()
+	return mlt_project_file
+
+
+def _render(backend: str, mlt_project_file: Path, out_path: Path, consumer_properties: list[str]):
+	match backend:
+		case "melt":
+			render_segmented(mlt_project_file, out_path, consumer_properties, num_segments=1)
+		case "melt-segmented":
+			render_segmented(mlt_project_file, out_path, consumer_properties)
+		case "melt-chunked":
+			with tempfile.TemporaryDirectory(prefix="chunks_", dir=out_path.parent) as chunk_dir:
+				render_chunked(mlt_project_file, out_path, consumer_properties, ChunkCache(chunk_dir, out_path.suffix))
+		case "ffmpeg":
+			render_ffmpeg(mlt_project_file, out_path, consumer_properties)
+		case _:
+			raise ValueError(f"unknown backend {backend}")
+
+
+def _measure(backend: str, mlt_project_file: Path, out_path: Path, consumer_properties: list[str], length: float) -> dict:
+	self_before = resource.getrusage(resource.RUSAGE_SELF)
+	children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+	start = time.perf_counter()
+	_render(backend, mlt_project_file, out_path, consumer_properties)
+	wall = time.perf_counter() - start
+	self_after = resource.getrusage(resource.RUSAGE_SELF)
+	children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+	cpu = sum(
+		after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+		for before, after in ((self_before, self_after), (children_before, children_after))
+	)
+	size = out_path.stat().st_size
+	return {
+		"wall_s": wall,
+		"realtime_factor": length / wall,
+		"cpu_s": cpu,
+		# 1.0 means that all cores were busy for the whole render
+		"cpu_utilization": cpu / wall / (os.cpu_count() or 1),
+		"size_bytes": size,
+		"bitrate_kbps": size * 8 / length / 1000,
+	}
+
+
+def main():
+	options = docopt.docopt(usage_msg)
+	length = float(options["--length"])
+	num_slides = int(options["--slides"])
+	profiles = options["--profiles"].split(",")
+	backends = _available_backends(options["--backends"].split(","))
+	supported_encoders = ffmpeg_get_encoders()
+	if options["--encoders"] == "auto":
+		encoders = [x for x in _ENCODERS if x in supported_encoders]
+	else:
+		encoders = options["--encoders"].split(",")
+		for encoder in encoders:
+			if encoder not in supported_encoders:
+				print(f"ffmpeg does not support the encoder {encoder}, skipping it")
+		encoders = [x for x in encoders if x in supported_encoders]
+
+	tmp_dir = Path(tempfile.mkdtemp(prefix="tavox_bench_"))
+	_write_pdf(tmp_dir / "deck.pdf", num_slides)
+	results = {"length_s": length, "slides": num_slides, "cpu_count": os.cpu_count(), "runs": []}
+
+	print(f"{'profile':<9}{'backend':<16}{'encoder':<13}{'wall [s]':>10}{'realtime':>10}{'cpu':>7}{'bitrate [kbit/s]':>18}")
+	for profile in profiles:
+		mlt_project_file = _build_project(tmp_dir, profile, length, num_slides)
+		for backend in backends:
+			for encoder in encoders:
+				consumer_properties = get_render_profile(profile).get_consumer_properties(encoder)
+				out_path = mlt_project_file.parent / f"{backend}_{encoder}.mkv"
+				try:
+					r = _measure(backend, mlt_project_file, out_path, consumer_properties, length)
+				except Exception as ex:
+					print(f"{profile:<9}{backend:<16}{encoder:<13} failed: {str(ex).splitlines()[0]}")
+					continue
+				r.update({"profile": profile, "backend": backend, "encoder": encoder})
+				results["runs"].append(r)
+				print(
+					f"{profile:<9}{backend:<16}{encoder:<13}{r['wall_s']:>10.2f}{r['realtime_factor']:>9.1f}x"
+					f"{r['cpu_utilization'] * 100:>6.0f}%{r['bitrate_kbps']:>18.1f}"
+				)
+
+	if options["--json"]:
+		with open(options["--json"], "w") as f:
+			json.dump(results, f, indent=2)
+
+	if options["--keep"]:
+		print(f"deck and videos kept in {tmp_dir}")
+	else:
+		shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+	main()
@@ -20,7 +20,14 @@
 
 from ._version import __version__
 from .project import TavoxProject
-from .script import speak, show_slide, show_slide_range, show_next_slide, set_pdf, delay, set_voice, activate_project
-from .mlt import create_mlt
+from .script import speak, show_slide, show_slide_range, show_next_slide, set_pdf, delay, set_voice, set_render_profile, activate_project
+from .mlt import create_mlt, WorkerPools
+from .cache import SampleDB, FileCache, SlideCache, ChunkCache, PlaceholderCache, SLIDE_CACHE_DIR_NAME, WORKSPACE_DIR_NAME, CHUNK_CACHE_DIR_NAME, PLACEHOLDER_CACHE_DIR_NAME
+from .profiles import RenderProfile, available_render_profiles, get_render_profile, register_render_profile
+from .preview import PreviewSettings
+from .workspace import BuildWorkspace, prune_workspaces
 from .voices import available_voices, register_voice, Voice
-from .external_tools import run_pdftoppm, run_melt, ffprobe_get_audio_length, ffmpeg_get_encoders
+from .external_tools import run_pdftoppm, run_melt, run_ffmpeg, ffprobe_get_audio_length, ffmpeg_get_encoders, Cancellation, RenderCancelled
+from .audio import get_audio_length, write_audio_track
+from .render import render_segmented, render_chunked, render_ffmpeg, render_audio
+from .profiling import Profiler, enable_profiling, disable_profiling
@@ -0,0 +1,393 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import json
+import math
+import wave
+import array
+import struct
+import logging
+import tempfile
+import threading
+
+from pathlib import Path
+from typing import BinaryIO, Optional, Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+from .external_tools import ffprobe_get_audio_length, run_ffmpeg
+from .profiling import count
+
+logger = logging.getLogger("tavox")
+
+AUDIO_LENGTH_CACHE_FILE_NAME = "audio_lengths.json"
+
+# format of the audio tracks assembled by tavox: stereo, 16 bit PCM, 48 kHz (the default sample rate of melt)
+AUDIO_TRACK_SAMPLE_RATE = 48000
+AUDIO_TRACK_CHANNELS = 2
+_AUDIO_TRACK_BLOCK_SIZE = 1 << 16  # sample frames
+_MONO_TO_STEREO_GAIN = math.sqrt(0.5)
+# incremented whenever premixed tracks of an earlier version sound different, version 2: mono sources at -3 dB
+AUDIO_TRACK_VERSION = 2
+# maximum number of audio files decoded by a single ffmpeg process, which keeps the command line and the number of
+# open files of the process bounded
+_DECODE_BATCH_SIZE = 64
+
+# WAVE format tags for which the data chunk size divided by the byte rate is exact
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_ALAW = 0x0006
+_WAVE_FORMAT_MULAW = 0x0007
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+_MP3_BITRATES = {
+	# (mpeg version 1, layer): kbit/s for the bitrate indices 1-14
+	(True, 1): [32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+	(True, 2): [32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+	(True, 3): [32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+	(False, 1): [32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+	(False, 2): [8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+	(False, 3): [8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+_MP3_SAMPLE_RATES = {
+	3: [44100, 48000, 32000],  # MPEG 1
+	2: [22050, 24000, 16000],  # MPEG 2
+	0: [11025, 12000, 8000],  # MPEG 2.5
+}
+
+
+def _wav_length(f: BinaryIO, file_size: int) -> Optional[float]:
+	riff = f.read(12)
+	if len(riff) < 12 or riff[8:12] != b"WAVE" or riff[0:4] not in (b"RIFF", b"RF64"):
+		return None
+
+	byte_rate = None
+	format_tag = None
+	ds64_data_size = None
+	while True:
+		header = f.read(8)
+		if len(header) < 8:
+			return None
+		chunk_id, chunk_size = struct.unpack("<4sI", header)
+		if chunk_id == b"fmt ":
+			fmt = f.read(chunk_size)
+			format_tag, _, _, byte_rate = struct.unpack("<HHII", fmt[:12])
+		elif chunk_id == b"ds64":
+			ds64 = f.read(chunk_size)
+			ds64_data_size = struct.unpack("<Q", ds64[8:16])[0]
+		elif chunk_id == b"data":
+			if byte_rate is None or byte_rate == 0:
+				return None
+			if format_tag not in (_WAVE_FORMAT_PCM, _WAVE_FORMAT_IEEE_FLOAT, _WAVE_FORMAT_ALAW, _WAVE_FORMAT_MULAW, _WAVE_FORMAT_EXTENSIBLE):
+				return None
+			data_size = chunk_size
+			if chunk_size == 0xFFFFFFFF and ds64_data_size is not None:
+				data_size = ds64_data_size
+			# streamed files (e.g., from TTS services) use placeholder sizes, the data extends to the end of the file
+			data_size = min(data_size, file_size - f.tell()) if data_size not in (0, 0xFFFFFFFF) else file_size - f.tell()
+			return data_size / byte_rate
+		else:
+			f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def _skip_id3v2(f: BinaryIO) -> int:
+	header = f.read(10)
+	if len(header) == 10 and header[0:3] == b"ID3":
+		size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+		if header[5] & 0x10:  # footer present
+			size += 10
+		offset = 10 + size
+	else:
+		offset = 0
+	f.seek(offset)
+	return offset
+
+
+def _flac_length(f: BinaryIO) -> Optional[float]:
+	_skip_id3v2(f)
+	if f.read(4) != b"fLaC":
+		return None
+	block_header = f.read(4)
+	if len(block_header) < 4 or block_header[0] & 0x7F != 0:  # STREAMINFO must be the first metadata block
+		return None
+	stream_info = f.read(34)
+	if len(stream_info) < 34:
+		return None
+	bits = int.from_bytes(stream_info[10:18], "big")
+	sample_rate = bits >> 44
+	total_samples = bits & 0xFFFFFFFFF
+	if sample_rate == 0 or total_samples == 0:  # unknown
+		return None
+	return total_samples / sample_rate
+
+
+def _mp3_length(f: BinaryIO, file_size: int) -> Optional[float]:
+	audio_start = _skip_id3v2(f)
+	data = f.read(4096)
+
+	# find the first frame header
+	for i in range(len(data) - 4):
+		if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+			continue
+		header = int.from_bytes(data[i:i + 4], "big")
+		version = (header >> 19) & 0x3
+		layer = 4 - ((header >> 17) & 0x3)
+		bitrate_index = (header >> 12) & 0xF
+		sample_rate_index = (header >> 10) & 0x3
+		channel_mode = (header >> 6) & 0x3
+		if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+			continue
+		break
+	else:
+		return None
+
+	mpeg1 = version == 3
+	sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+	bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_index - 1] * 1000
+	if layer == 1:
+		samples_per_frame = 384
+	elif layer == 2 or mpeg1:
+		samples_per_frame = 1152
+	else:
+		samples_per_frame = 576
+
+	# VBR files carry the number of frames in a Xing/Info or VBRI header in the first frame
+	side_info_size = (32 if channel_mode != 3 else 17) if mpeg1 else (17 if channel_mode != 3 else 9)
+	xing = data[i + 4 + side_info_size:i + 4 + side_info_size + 12]
+	if xing[0:4] in (b"Xing", b"Info") and len(xing) == 12:
+		flags = int.from_bytes(xing[4:8], "big")
+		if flags & 0x1:
+			return int.from_bytes(xing[8:12], "big") * samples_per_frame / sample_rate
+	vbri = data[i + 4 + 32:i + 4 + 32 + 18]
+	if vbri[0:4] == b"VBRI" and len(vbri) == 18:
+		return int.from_bytes(vbri[14:18], "big") * samples_per_frame / sample_rate
+
+	# constant bitrate
+	audio_size = file_size - audio_start - i
+	f.seek(-128, os.SEEK_END)
+	if f.read(3) == b"TAG":
+		audio_size -= 128
+	return audio_size * 8 / bitrate
+
+
+def read_audio_length(audio_file: str | os.PathLike) -> Optional[float]:
+	"""
+	Determines the length of a WAV, FLAC or MP3 file in seconds by parsing its headers. Returns None if the
+	format is not supported.
+	"""
+	file_size = os.path.getsize(audio_file)
+	with open(audio_file, "rb") as f:
+		magic = f.read(4)
+		f.seek(0)
+		try:
+			if magic in (b"RIFF", b"RF64"):
+				return _wav_length(f, file_size)
+			if magic == b"fLaC" or (magic[0:3] == b"ID3" and str(audio_file).lower().endswith(".flac")):
+				return _flac_length(f)
+			if magic[0:3] == b"ID3" or (len(magic) >= 2 and magic[0] == 0xFF and magic[1] & 0xE0 == 0xE0):
+				return _mp3_length(f, file_size)
+		except (struct.error, OSError, KeyError, IndexError) as ex:
+			logger.debug(f"unable to parse audio file {audio_file}: {ex}")
+	return None
+
+
+def get_audio_length(audio_file: str | os.PathLike) -> float:
+	"""
+	Returns the length of an audio file in seconds. ffprobe is only used for formats that cannot be parsed natively.
+	"""
+	length = read_audio_length(audio_file)
+	if length is None:
+		logger.debug(f"using ffprobe to determine the length of {audio_file}")
+		length = ffprobe_get_audio_length(audio_file)
+	return length
+
+
+class AudioLengthCache:
+	"""
+	Persistent memo of ffprobe results, keyed by (path, mtime, size).
+	"""
+
+	def __init__(self, path: str | os.PathLike):
+		self._path = Path(path)
+		self._lock = threading.Lock()
+		self._dirty = False
+		self._entries: dict[str, list] = {}
+		try:
+			with open(self._path, "r") as f:
+				self._entries = json.load(f)
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError) as ex:
+			logger.debug(f"ignoring invalid audio length cache {self._path}: {ex}")
+
+	@staticmethod
+	def _key(audio_file: Path) -> tuple[str, int, int]:
+		stat = audio_file.stat()
+		return str(audio_file), stat.st_mtime_ns, stat.st_size
+
+	def get(self, audio_file: Path) -> Optional[float]:
+		path, mtime, size = self._key(audio_file)
+		with self._lock:
+			entry = self._entries.get(path)
+		if entry is not None and entry[0] == mtime and entry[1] == size:
+			count("audio length cache hit")
+			return entry[2]
+		count("audio length cache miss")
+		return None
+
+	def put(self, audio_file: Path, length: float):
+		path, mtime, size = self._key(audio_file)
+		with self._lock:
+			self._entries[path] = [mtime, size, length]
+			self._dirty = True
+
+	def save(self):
+		with self._lock:
+			if not self._dirty:
+				return
+			# drop entries of files that no longer exist
+			self._entries = {k: v for k, v in self._entries.items() if os.path.exists(k)}
+			fd, tmp_path = tempfile.mkstemp(prefix=".tavox_", dir=self._path.parent)
+			with os.fdopen(fd, "w") as f:
+				json.dump(self._entries, f)
+			os.replace(tmp_path, self._path)
+			self._dirty = False
+
+
+def get_audio_lengths(audio_files: Iterable[str | os.PathLike], jobs: int = 8, cache: Optional[AudioLengthCache] = None) -> dict[Path, float]:
+	"""
+	Determines the lengths of many audio files. Each file is only probed once, files that cannot be parsed
+	natively are probed concurrently by up to `jobs` ffprobe processes. The ffprobe results are memoized in
+	the given cache.
+	"""
+	lengths: dict[Path, float] = {}
+	to_probe: list[Path] = []
+	for audio_file in dict.fromkeys(Path(x).absolute() for x in audio_files):
+		length = read_audio_length(audio_file)
+		if length is None and cache is not None:
+			length = cache.get(audio_file)
+		if length is None:
+			to_probe.append(audio_file)
+		else:
+			lengths[audio_file] = length
+
+	if len(to_probe) > 0:
+		logger.debug(f"probing {len(to_probe)} audio file(s) using ffprobe")
+		with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="tavox_ffprobe") as executor:
+			for audio_file, length in zip(to_probe, executor.map(ffprobe_get_audio_length, to_probe)):
+				lengths[audio_file] = length
+				if cache is not None:
+					cache.put(audio_file, length)
+
+	return lengths
+
+
+def _has_track_format(audio_file: str | os.PathLike) -> bool:
+	# mono files (e.g., most voice samples) are upmixed while the track is written, all other files are decoded
+	try:
+		with wave.open(str(audio_file), "rb") as w:
+			return w.getnchannels() in (1, AUDIO_TRACK_CHANNELS) and w.getsampwidth() == 2 and w.getframerate() == AUDIO_TRACK_SAMPLE_RATE and w.getcomptype() == "NONE"
+	except (wave.Error, EOFError, OSError):
+		return False
+
+
+def _upmix(data: bytes) -> bytes:
+	# mixes a mono 16 bit PCM block into both channels at -3 dB, like ffmpeg does for -ac 2, such that mono samples
+	# have the same level whether they are decoded by ffmpeg or not
+	mono = array.array("h", [round(x * _MONO_TO_STEREO_GAIN) for x in array.array("h", data)])
+	stereo = array.array("h", bytes(2 * len(data)))
+	stereo[0::2] = mono
+	stereo[1::2] = mono
+	return stereo.tobytes()
+
+
+def write_audio_track(
+	pieces: list[tuple[int, int, str | os.PathLike | None]],
+	total_length: int,
+	fps: int,
+	audio_file: str | os.PathLike,
+	tmp_dir: str | os.PathLike,
+	num_workers: Optional[int] = None
+):
+	"""
+	Assembles an audio track (stereo 16 bit PCM WAV at 48 kHz) from the given pieces, which are specified as (first
+	frame, number of frames, audio file or None for silence). Like in melt, every audio file is truncated or
+	padded with silence to the length of its piece and the track is padded to total_length frames. Audio files
+	in a different format (e.g., voice samples at 22.05 or 24 kHz) are decoded to raw PCM, each ffmpeg process
+	decodes up to _DECODE_BATCH_SIZE files, one output per input. The track itself is written by streaming the
+	samples of one piece after the other.
+	"""
+	resources = list(dict.fromkeys(x[2] for x in pieces if x[2] is not None))
+	raw_files = {}
+	for i, resource in enumerate(resources):
+		if not _has_track_format(resource):
+			raw_files[resource] = Path(tmp_dir) / f"audio{i}.raw"
+
+	def decode(batch: list[str | os.PathLike]):
+		arguments = []
+		for resource in batch:
+			arguments += ["-i", f"{resource}"]
+		for i, resource in enumerate(batch):
+			arguments += ["-map", f"{i}:a:0", "-f", "s16le", "-ac", f"{AUDIO_TRACK_CHANNELS}", "-ar", f"{AUDIO_TRACK_SAMPLE_RATE}", f"{raw_files[resource]}"]
+		run_ffmpeg(arguments)
+
+	if len(raw_files) > 0:
+		to_decode = list(raw_files.keys())
+		batches = [to_decode[i:i + _DECODE_BATCH_SIZE] for i in range(0, len(to_decode), _DECODE_BATCH_SIZE)]
+		logger.debug(f"decoding {len(raw_files)} audio file(s) using {len(batches)} ffmpeg process(es)")
+		with ThreadPoolExecutor(max_workers=min(len(batches), num_workers or os.cpu_count() or 1), thread_name_prefix="tavox_ffmpeg") as executor:
+			for _ in executor.map(decode, batches):
+				pass
+
+	frame_size = 2 * AUDIO_TRACK_CHANNELS
+	to_samples = lambda frames: frames * AUDIO_TRACK_SAMPLE_RATE // fps
+	with wave.open(str(audio_file), "wb") as w:
+		w.setnchannels(AUDIO_TRACK_CHANNELS)
+		w.setsampwidth(2)
+		w.setframerate(AUDIO_TRACK_SAMPLE_RATE)
+		position = 0
+		# the last (empty) piece pads the audio track to the total length
+		for start, length, resource in pieces + [(total_length, 0, None)]:
+			num_samples = to_samples(min(start + length, total_length)) - position
+			if num_samples <= 0:
+				continue
+			position += num_samples
+			if resource is not None:
+				if resource in raw_files:
+					source = open(raw_files[resource], "rb")
+					read = lambda n: source.read(n * frame_size)
+				else:
+					source = wave.open(str(resource), "rb")
+					if source.getnchannels() == 1:
+						read = lambda n: _upmix(source.readframes(n))
+					else:
+						read = source.readframes
+				with source:
+					while num_samples > 0:
+						data = read(min(num_samples, _AUDIO_TRACK_BLOCK_SIZE))
+						if len(data) == 0:
+							break
+						w.writeframesraw(data)
+						num_samples -= len(data) // frame_size
+			while num_samples > 0:
+				block = min(num_samples, _AUDIO_TRACK_BLOCK_SIZE)
+				w.writeframesraw(bytes(block * frame_size))
+				num_samples -= block
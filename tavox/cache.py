@@ -26,36 +26,127 @@ import glob
 import tempfile
 import logging
 import textwrap
+import sqlite3
+import threading
+import time
 
 from pathlib import Path
+from dataclasses import dataclass
 
 from .voices import Voice
+from .audio import get_audio_length, AUDIO_LENGTH_CACHE_FILE_NAME
+from .profiling import span, count
 
 logger = logging.getLogger("tavox")
 
+DEFAULT_CACHE_PATH = Path.home() / ".tavox_cache"
+
+_AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3")
+_MANIFEST_FILE_NAME = "manifest.sqlite"
+_MANIFEST_VERSION = 1
+_LAST_USED_FLUSH_THRESHOLD = 256
+SLIDE_CACHE_DIR_NAME = "slides"
+WORKSPACE_DIR_NAME = "builds"
+CHUNK_CACHE_DIR_NAME = "chunks"
+PLACEHOLDER_CACHE_DIR_NAME = "placeholders"
+
 def hash_text(text: str) -> str:
 	return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
+@dataclass
+class Sample:
+	path: Path
+	duration: float  # seconds
+
+
 class SampleDB:
+	"""
+	Cache of synthesized voice samples. The samples are stored as <path>/<voice_id>/<hash><extension>, an SQLite
+	manifest (<path>/manifest.sqlite) maps (voice_id, text hash) to the sample file. The text of each sample is
+	additionally written to <hash>.text when the sample is added, which allows to rebuild the manifest.
+	"""
 
 	def __init__(self, path):
 		self._path = path
 		os.makedirs(self._path, exist_ok=True)
+		self._lock = threading.Lock()
+		self._last_used: dict[tuple[str, str], float] = {}
+		self._hits = 0
+		self._misses = 0
+		self._db = sqlite3.connect(Path(self._path) / _MANIFEST_FILE_NAME, timeout=60, check_same_thread=False, isolation_level=None)
+		self._init_manifest()
 
-	def _add_sample_to_db(self, text: str, voice: Voice):
-		sample_dir = tempfile.TemporaryDirectory(prefix="tavox_", delete=False)
-		try:
-			voice.generate_sample(text, sample_dir.name)
-		except Exception as e:
-			logger.error(f"Unable to synthesize sample \"{textwrap.shorten(text, 40)}\" with voice {voice.voice_id}")
-			raise e
+	@property
+	def path(self) -> Path:
+		return Path(self._path)
+
+	def _init_manifest(self):
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				self._db.execute(
+					"""CREATE TABLE IF NOT EXISTS samples (
+						voice_id TEXT NOT NULL,
+						hash TEXT NOT NULL,
+						text TEXT NOT NULL,
+						path TEXT NOT NULL,
+						format TEXT NOT NULL,
+						duration REAL,
+						size INTEGER,
+						created REAL,
+						last_used REAL,
+						PRIMARY KEY (voice_id, hash)
+					)"""
+				)
+				self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+				row = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+				if row is None:
+					self._migrate_legacy_layout()
+					self._db.execute("INSERT INTO meta VALUES ('version', ?)", (str(_MANIFEST_VERSION),))
+				self._db.execute("COMMIT")
+			except BaseException as ex:
+				self._db.execute("ROLLBACK")
+				raise ex
+
+	def _migrate_legacy_layout(self):
+		# older versions of tavox only stored <hash>.text and <hash>.last_used files next to the samples
+		num_samples = 0
+		for text_file_path in Path(self._path).glob("**/*.text"):
+			base_path = text_file_path.parent
+			h = text_file_path.stem
+			audio_file_candidates = [x for x in base_path.glob(f"{h}.*") if x.suffix in _AUDIO_EXTENSIONS]
+			if len(audio_file_candidates) == 0:
+				continue
+			audio_file = audio_file_candidates[0]
+			with open(text_file_path, "r") as text_file:
+				text = text_file.read()
+
+			stat = audio_file.stat()
+			last_used = stat.st_mtime
+			last_used_path = base_path / f"{h}.last_used"
+			if last_used_path.exists():
+				try:
+					with open(last_used_path, "r") as f:
+						last_used = datetime.datetime.fromisoformat(f.read().strip()).timestamp()
+				except ValueError:
+					pass
+				last_used_path.unlink()
 
-		sample_path = glob.glob(f"{sample_dir.name}/*")
-		if len(sample_path) != 1:
-			raise Exception("The Voice instance created an unexpected number of files.")
-		sample_path = Path(sample_path[0])
+			cursor = self._db.execute(
+				"INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?, ?, NULL, ?, ?, ?)",
+				(
+					base_path.relative_to(self._path).as_posix(), h, text,
+					audio_file.relative_to(self._path).as_posix(), "".join(audio_file.suffixes),
+					stat.st_size, stat.st_mtime, last_used
+				)
+			)
+			num_samples += cursor.rowcount
+		if num_samples > 0:
+			logger.info(f"added {num_samples} cached sample(s) to the sample manifest")
+		return num_samples
 
+	def _store_sample(self, text: str, voice: Voice, sample_path: Path):
 		base_path = Path(f"{self._path}/{voice.voice_id}")
 		os.makedirs(base_path, exist_ok=True)
 
@@ -73,26 +164,391 @@ class SampleDB:
 		with open(f"{base_path}/{h}.text", "w") as text_file:
 			text_file.write(text)
 
-		sample_dir.cleanup()
+		# the duration is measured once, s.t., the timeline can be created without probing the samples again
+		duration = get_audio_length(dest)
+
+		now = time.time()
+		with self._lock:
+			self._db.execute(
+				"INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(voice.voice_id, h, text, dest.relative_to(self._path).as_posix(), extension, duration, dest.stat().st_size, now, now)
+			)
+
+	def _add_sample_to_db(self, text: str, voice: Voice):
+		# create the temporary directory inside the cache, s.t., the sample can be moved into place by a simple rename
+		sample_dir = tempfile.TemporaryDirectory(prefix=".tavox_", dir=self._path, delete=False)
+		try:
+			try:
+				with span(voice.voice_id, "tts", samples=1):
+					voice.generate_sample(text, sample_dir.name)
+			except Exception as e:
+				logger.error(f"Unable to synthesize sample \"{textwrap.shorten(text, 40)}\" with voice {voice.voice_id}")
+				raise e
+
+			sample_path = glob.glob(f"{sample_dir.name}/*")
+			if len(sample_path) != 1:
+				raise Exception("The Voice instance created an unexpected number of files.")
+			self._store_sample(text, voice, Path(sample_path[0]))
+		finally:
+			sample_dir.cleanup()
+
+	def _add_samples_to_db(self, texts: list[str], voice: Voice):
+		sample_dir = tempfile.TemporaryDirectory(prefix=".tavox_", dir=self._path, delete=False)
+		try:
+			try:
+				with span(voice.voice_id, "tts", samples=len(texts)):
+					voice.generate_samples(texts, sample_dir.name)
+			except Exception as e:
+				logger.error(f"Unable to synthesize a batch of {len(texts)} sample(s) with voice {voice.voice_id}")
+				raise e
+
+			# the sample of the i-th text is expected to be named {i}.<extension>
+			sample_paths: dict[int, list[Path]] = {}
+			for path in Path(sample_dir.name).iterdir():
+				index = path.name.split(".")[0]
+				if not index.isdigit():
+					raise Exception(f"The Voice instance created an unexpected file: {path.name}")
+				sample_paths.setdefault(int(index), []).append(path)
+			if sorted(sample_paths.keys()) != list(range(len(texts))) or any(len(x) != 1 for x in sample_paths.values()):
+				raise Exception("The Voice instance created an unexpected number of files.")
+
+			for idx, text in enumerate(texts):
+				self._store_sample(text, voice, sample_paths[idx][0])
+		finally:
+			sample_dir.cleanup()
 
-	def _find_sample(self, text: str, voice: Voice) -> None | Path:
+	def _lookup(self, text: str, voice: Voice) -> None | tuple[str, float | None]:
 		h = hash_text(text)
-		base_path = Path(f"{self._path}/{voice.voice_id}")
-		text_file_path = Path(f"{base_path}/{h}.text")
-		if text_file_path.exists():
-			with open(text_file_path, "r") as text_file:
-				if text_file.read() != text:  # hash collision?
-					return None
-				audio_file_candidates = [x for x in base_path.glob(f"{h}*") if x.suffix in (".wav", ".flac", ".mp3")]
-				# mark the entry as used
-				with open(f"{base_path}/{h}.last_used", "w") as f:
-					f.write(f"{datetime.datetime.now()}")
-				return audio_file_candidates[0]
-		else:
+		with self._lock:
+			row = self._db.execute("SELECT text, path, duration FROM samples WHERE voice_id = ? AND hash = ?", (voice.voice_id, h)).fetchone()
+		if row is None or row[0] != text:  # hash collision?
 			return None
+		return row[1], row[2]
+
+	def _find_sample(self, text: str, voice: Voice) -> None | Sample:
+		entry = self._lookup(text, voice)
+		if entry is None:
+			return None
+		path, duration = entry
+		h = hash_text(text)
+		if duration is None:
+			# samples imported from older cache layouts have no duration yet
+			duration = get_audio_length(Path(self._path) / path)
+			with self._lock:
+				self._db.execute("UPDATE samples SET duration = ? WHERE voice_id = ? AND hash = ?", (duration, voice.voice_id, h))
+		# mark the entry as used, the timestamps are written to the manifest in batches
+		with self._lock:
+			self._last_used[(voice.voice_id, h)] = time.time()
+			flush = len(self._last_used) >= _LAST_USED_FLUSH_THRESHOLD
+		if flush:
+			self.flush()
+		return Sample(path=Path(self._path) / path, duration=duration)
 
-	def get_sample(self, text: str, voice: Voice) -> Path:
+	def contains(self, text: str, voice: Voice) -> bool:
+		# this is the query used to determine which samples must be synthesized, hence it provides the cache statistics
+		found = self._lookup(text, voice) is not None
+		with self._lock:
+			if found:
+				self._hits += 1
+			else:
+				self._misses += 1
+		count("sample cache hit" if found else "sample cache miss")
+		return found
+
+	def flush(self):
+		with self._lock:
+			if len(self._last_used) == 0 and self._hits == 0 and self._misses == 0:
+				return
+			self._db.execute("BEGIN IMMEDIATE")
+			self._db.executemany(
+				"UPDATE samples SET last_used = MAX(COALESCE(last_used, 0), ?) WHERE voice_id = ? AND hash = ?",
+				[(t, voice_id, h) for (voice_id, h), t in self._last_used.items()]
+			)
+			for key, value in (("hits", self._hits), ("misses", self._misses)):
+				self._db.execute("INSERT OR IGNORE INTO meta VALUES (?, '0')", (key,))
+				self._db.execute("UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE key = ?", (value, key))
+			self._db.execute("COMMIT")
+			self._last_used.clear()
+			self._hits = 0
+			self._misses = 0
+
+	def close(self):
+		self.flush()
+		with self._lock:
+			self._db.close()
+
+	def get_sample(self, text: str, voice: Voice) -> Sample:
 		s = self._find_sample(text, voice)
 		if s is None:
 			self._add_sample_to_db(text, voice)
 		return self._find_sample(text, voice)
+
+	def get_samples(self, texts: list[str], voice: Voice) -> list[Sample]:
+		missing = []
+		for text in dict.fromkeys(texts):
+			if self._lookup(text, voice) is None:
+				missing.append(text)
+
+		if len(missing) > 0:
+			self._add_samples_to_db(missing, voice)
+
+		return [self._find_sample(text, voice) for text in texts]
+
+	def _remove_entries(self, entries: list[tuple[str, str, str]]):
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			self._db.executemany("DELETE FROM samples WHERE voice_id = ? AND hash = ?", [(v, h) for v, h, _ in entries])
+			self._db.execute("COMMIT")
+		for voice_id, h, path in entries:
+			for file in (Path(self._path) / path, Path(self._path) / voice_id / f"{h}.text"):
+				file.unlink(missing_ok=True)
+
+	def _find_orphans(self) -> list[Path]:
+		with self._lock:
+			known = {row[0] for row in self._db.execute("SELECT path FROM samples")}
+			known |= {f"{v}/{h}.text" for v, h in self._db.execute("SELECT voice_id, hash FROM samples")}
+			voice_ids = {row[0] for row in self._db.execute("SELECT DISTINCT voice_id FROM samples")}
+
+		orphans = []
+		stale = time.time() - 24 * 3600
+		for root, dirs, files in os.walk(self._path):
+			root_path = Path(root)
+			if root_path == Path(self._path):
+				# managed by the slide, chunk and placeholder caches and the build workspaces
+				for d in (SLIDE_CACHE_DIR_NAME, WORKSPACE_DIR_NAME, CHUNK_CACHE_DIR_NAME, PLACEHOLDER_CACHE_DIR_NAME):
+					if d in dirs:
+						dirs.remove(d)
+			for d in list(dirs):
+				# left over temporary directories of interrupted runs
+				if d.startswith(".tavox_") and (root_path / d).stat().st_mtime < stale:
+					orphans.append(root_path / d)
+					dirs.remove(d)
+			for f in files:
+				path = root_path / f
+				rel_path = path.relative_to(self._path).as_posix()
+				if root_path == Path(self._path) and (f.startswith(_MANIFEST_FILE_NAME) or f == AUDIO_LENGTH_CACHE_FILE_NAME):
+					continue
+				if path.suffix == ".info":
+					if rel_path.removesuffix(".info") not in voice_ids:
+						orphans.append(path)
+				elif rel_path not in known:
+					orphans.append(path)
+		return orphans
+
+	def _select_evictions(self, max_size: int | None, max_age: float | None) -> list[tuple[str, str, str, int]]:
+		with self._lock:
+			rows = self._db.execute("SELECT voice_id, hash, path, COALESCE(size, 0), COALESCE(last_used, 0) FROM samples ORDER BY last_used ASC").fetchall()
+
+		evictions = []
+		total_size = sum(row[3] for row in rows)
+		now = time.time()
+		for voice_id, h, path, size, last_used in rows:
+			too_old = max_age is not None and last_used < now - max_age
+			too_big = max_size is not None and total_size > max_size
+			if not too_old and not too_big:
+				break
+			evictions.append((voice_id, h, path, size))
+			total_size -= size
+		return evictions
+
+	def prune(self, max_size: int | None = None, max_age: float | None = None, dry_run: bool = False) -> dict[str, int]:
+		"""
+		Evicts the least recently used samples until the cache is within the given size (in bytes) and
+		age (in seconds) budget and removes orphaned files.
+		"""
+		self.flush()
+		evictions = self._select_evictions(max_size, max_age)
+		orphans = self._find_orphans()
+
+		result = {
+			"samples": len(evictions),
+			"orphans": len(orphans),
+			"size": sum(x[3] for x in evictions) + sum(_disk_usage(x) for x in orphans)
+		}
+		if dry_run:
+			return result
+
+		self._remove_entries([x[:3] for x in evictions])
+		for orphan in orphans:
+			logger.debug(f"removing orphaned file {orphan}")
+			if orphan.is_dir():
+				shutil.rmtree(orphan, ignore_errors=True)
+			else:
+				orphan.unlink(missing_ok=True)
+		return result
+
+	def verify(self) -> dict[str, int]:
+		"""
+		Checks that every manifest entry refers to an existing sample and removes broken entries. Samples
+		that are not in the manifest, but still have their .text file, are added again.
+		"""
+		self.flush()
+		with self._lock:
+			rows = self._db.execute("SELECT voice_id, hash, path, size FROM samples").fetchall()
+
+		broken = []
+		for voice_id, h, path, size in rows:
+			file = Path(self._path) / path
+			if not file.exists() or (size is not None and file.stat().st_size != size):
+				logger.warning(f"broken cache entry: {path}")
+				broken.append((voice_id, h, path))
+		self._remove_entries(broken)
+
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			num_recovered = self._migrate_legacy_layout()
+			self._db.execute("COMMIT")
+
+		return {"checked": len(rows), "broken": len(broken), "recovered": num_recovered}
+
+	def statistics(self, max_size: int | None = None, max_age: float | None = None) -> dict:
+		self.flush()
+		with self._lock:
+			voices = {
+				voice_id: {"samples": n, "size": size}
+				for voice_id, n, size in self._db.execute("SELECT voice_id, COUNT(*), SUM(COALESCE(size, 0)) FROM samples GROUP BY voice_id")
+			}
+			meta = dict(self._db.execute("SELECT key, value FROM meta"))
+
+		hits = int(meta.get("hits", 0))
+		misses = int(meta.get("misses", 0))
+		orphans = self._find_orphans()
+		evictions = self._select_evictions(max_size, max_age)
+		return {
+			"path": str(self._path),
+			"samples": sum(x["samples"] for x in voices.values()),
+			"size": sum(x["size"] for x in voices.values()),
+			"voices": voices,
+			"hits": hits,
+			"misses": misses,
+			"hit_rate": hits / (hits + misses) if hits + misses > 0 else None,
+			"orphans": len(orphans),
+			"reclaimable": sum(_disk_usage(x) for x in orphans) + sum(x[3] for x in evictions),
+		}
+
+
+class FileCache:
+	"""
+	Content-addressed cache of generated files. The files are stored as <path>/<key[:2]>/<key><extension>. The
+	modification time of a file is updated whenever it is used and serves as its last-used timestamp when the
+	cache is pruned.
+	"""
+
+	def __init__(self, path, extension: str):
+		self._path = Path(path)
+		self._extension = extension
+		os.makedirs(self._path, exist_ok=True)
+
+	@property
+	def path(self) -> Path:
+		return self._path
+
+	def _file_path(self, key: str) -> Path:
+		return self._path / key[:2] / f"{key}{self._extension}"
+
+	def get(self, key: str) -> Path | None:
+		path = self._file_path(key)
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			count(f"{self._path.name} cache miss")
+			return None
+		count(f"{self._path.name} cache hit")
+		return path
+
+	def put(self, key: str, file: Path) -> Path:
+		"""
+		Moves the given file into the cache.
+		"""
+		path = self._file_path(key)
+		os.makedirs(path.parent, exist_ok=True)
+		os.replace(file, path)
+		return path
+
+	def temporary_directory(self) -> tempfile.TemporaryDirectory:
+		return tempfile.TemporaryDirectory(prefix=".tavox_", dir=self._path)
+
+	def _files(self) -> list[tuple[Path, int, float]]:
+		files = []
+		for path in self._path.glob("??/*"):
+			stat = path.stat()
+			files.append((path, stat.st_size, stat.st_mtime))
+		return files
+
+	def prune(self, max_size: int | None = None, max_age: float | None = None, dry_run: bool = False) -> dict[str, int]:
+		"""
+		Removes the least recently used files until the cache is within the given size (in bytes) and
+		age (in seconds) budget, as well as left over temporary directories.
+		"""
+		now = time.time()
+		files = sorted(self._files(), key=lambda x: x[2])
+		total_size = sum(x[1] for x in files)
+		evictions = []
+		for path, size, last_used in files:
+			too_old = max_age is not None and last_used < now - max_age
+			too_big = max_size is not None and total_size > max_size
+			if not too_old and not too_big:
+				break
+			evictions.append((path, size))
+			total_size -= size
+		stale = [x for x in self._path.glob(".tavox_*") if x.stat().st_mtime < now - 24 * 3600]
+
+		result = {
+			"files": len(evictions),
+			"size": sum(x[1] for x in evictions) + sum(_disk_usage(x) for x in stale)
+		}
+		if dry_run:
+			return result
+
+		for path, _ in evictions:
+			path.unlink(missing_ok=True)
+		for x in stale:
+			shutil.rmtree(x, ignore_errors=True)
+		return result
+
+	def statistics(self) -> dict:
+		files = self._files()
+		return {"files": len(files), "size": sum(x[1] for x in files)}
+
+
+class SlideCache(FileCache):
+	"""
+	Cache of rendered slide images. The key of an image is derived from the content hash of the PDF page and
+	the rendering parameters.
+	"""
+
+	def __init__(self, path):
+		super().__init__(path, ".png")
+
+	@staticmethod
+	def key(page_hash: str, width: int, height: int, dpi: int) -> str:
+		return hashlib.sha256(f"{page_hash}:{width}x{height}:{dpi}".encode("ascii")).hexdigest()
+
+
+class ChunkCache(FileCache):
+	"""
+	Cache of encoded video chunks, i.e., parts of a video that show a single slide. The key of a chunk is
+	derived from the content of the image and the audio samples it consists of, its duration and the encoder
+	settings (see render.get_chunks).
+	"""
+
+
+class PlaceholderCache(FileCache):
+	"""
+	Cache of the placeholder samples used in preview builds instead of synthesized voice samples. They only
+	depend on their duration (in milliseconds) and on whether they start with a tone, hence they are kept
+	separately from the voice samples in the SampleDB.
+	"""
+
+	def __init__(self, path):
+		super().__init__(path, ".wav")
+
+	@staticmethod
+	def key(duration_ms: int, tone: bool) -> str:
+		return hashlib.sha256(f"{duration_ms}:{int(tone)}".encode("ascii")).hexdigest()
+
+
+def _disk_usage(path: Path) -> int:
+	if path.is_dir():
+		return sum(_disk_usage(x) for x in path.iterdir())
+	return path.stat().st_size
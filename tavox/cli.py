@@ -21,19 +21,24 @@
 
 import docopt
 import os
-import tempfile
+import glob
 import subprocess
 import shutil
 import sys
+import time
 import pathlib
+import threading
 import logging
 import logging.config
 
 from typing import Dict, Any
 from pathlib import Path
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from tavox import *
 from tavox import __version__
+from tavox.profiling import span
 
 red = "\x1b[31;20m"
 bold_red = "\x1b[31;1m"
@@ -104,23 +109,98 @@ logging.config.dictConfig(config=logging_cfg)
 
 usage_msg = """
 Usage:
-  tavox [--pre-script PS --no-video --speak-merge --mlt-project MLT --out-path PATH --voice VOICE --debug] <SCRIPT>
+  tavox [--pre-script PS --no-video --audio-only --separate-audio --preview --preview-rate WPM --preview-tone --speak-merge --mlt-project MLT --out-path PATH --voice VOICE --jobs N --render-profile NAME --backend NAME --segments N --no-chunk-cache --cache-dir DIR --cache-max-size SIZE --cache-max-age DAYS --profile PATH --debug] <SCRIPT>
+  tavox batch [--pre-script PS --no-video --audio-only --separate-audio --preview --preview-rate WPM --preview-tone --speak-merge --out-dir DIR --voice VOICE --jobs N --render-profile NAME --backend NAME --segments N --no-chunk-cache --cache-dir DIR --cache-max-size SIZE --cache-max-age DAYS --profile PATH --debug] <PATTERN>...
   tavox [--pre-script PS --debug] --list-voices
+  tavox cache (stats|prune|verify) [--cache-dir DIR --max-size SIZE --max-age DAYS --dry-run --debug]
   tavox -h | --help
   tavox --version
 
 Options:
   --no-video         Don't render the video, just create the mlt project.
+  --audio-only       Don't render the video, just the audio track (e.g., as
+                     podcast). The format is determined by the extension of
+                     the output file (default: <SCRIPT>.flac).
+  --separate-audio   Don't mix the voice samples into a single audio track,
+                     keep a producer for every sample in the MLT project
+                     (e.g., for editing the project in Shotcut).
+  --preview          Don't synthesize the voice samples, use silent
+                     placeholders of the estimated duration instead. This is
+                     useful for quickly checking the timing of the slides.
+  --preview-rate WPM  The speaking rate (words per minute) used to estimate
+                     the duration of the placeholders [default: 150].
+  --preview-tone     Start every placeholder with a short tone.
   --speak-merge      Merge subsequent speak commands before generating voice
                      samples.
-  --mlt-project MLT  The path to the mlt-project file. If ommitted a temporary
-                     file will be created.
+  --mlt-project MLT  The path to the mlt-project file. If ommitted the project
+                     is built in a persistent workspace in the cache directory,
+                     such that unchanged stages are skipped in later builds.
   --out-path PATH    The path to the output video file.
+  --out-dir DIR      The directory of the output files in batch mode (default:
+                     the current directory).
   --voice VOICE      Set the initial voice [default: default].
+  -j N --jobs N      Maximum number of voice samples that are synthesized
+                     concurrently. Voices may impose a lower limit
+                     [default: 4].
+  --render-profile NAME  The render profile that sets the frame rate, the
+                     resolution and the encoder settings of the video, e.g.,
+                     "draft" for fast previews or "final". Overrides the
+                     profile set by the script (set_render_profile), which
+                     defaults to "final".
+  --backend NAME     The backend that renders the video: "melt" renders the
+                     MLT project, "ffmpeg" encodes the slides and the audio
+                     track directly, which is much faster [default: melt].
+  --segments N       Number of parts of the video (split at slide boundaries)
+                     that are rendered in parallel and then concatenated. By
+                     default the number is chosen based on the number of CPU
+                     cores (and the length of the video if --no-chunk-cache is
+                     given) [default: auto].
+  --no-chunk-cache   Don't encode every slide into a separate video chunk.
+                     By default the chunks are cached, such that only the
+                     slides whose image, audio or duration changed are
+                     encoded again in later builds.
   --pre-script PS    A python script that is simply executed (using exec)
                      before the actual SCRIPT is run and the voice is set. This
                      can be used to, e.g., load a custom voice.
   --list-voices      Print the list of available voices.
+  --cache-dir DIR    The directory of the voice sample cache
+                     [default: ~/.tavox_cache].
+  --cache-max-size SIZE  Prune the sample cache to the given size (e.g., 500M,
+                     10G) after the voice samples have been generated.
+                     The least recently used samples are removed first.
+  --cache-max-age DAYS   Remove samples that have not been used for the given
+                     number of days after the voice samples have been
+                     generated.
+  --profile PATH     Record the duration of the build stages, external tool
+                     calls and voice synthesis as well as the cache hits and
+                     misses. A summary is written to PATH (JSON), a trace that
+                     can be opened in chrome://tracing or ui.perfetto.dev to
+                     PATH with the extension .trace.json.
+
+Batch mode:
+  batch              Build all scripts given by PATTERN (paths or glob
+                     patterns, e.g., "lectures/*.tavox") in a single process.
+                     The voices and the sample cache are shared, and the
+                     output of a script is rendered while the next script is
+                     built. The output files are named <SCRIPT>.mkv (or
+                     <SCRIPT>.flac with --audio-only). A failing script does
+                     not stop the other scripts, a summary of all scripts is
+                     shown at the end. The pre-script is only run once.
+
+Cache commands:
+  stats              Show the size of the sample and slide caches, the hit rate
+                     and the space that can be reclaimed.
+  prune              Remove orphaned files and, if --max-size or --max-age is
+                     given, the least recently used samples and slides. The
+                     budgets apply to samples and slides separately. Build
+                     workspaces of scripts that no longer exist (or exceed
+                     --max-age) are removed as well.
+  verify             Remove cache entries whose sample files are missing or
+                     damaged and recover samples missing in the manifest.
+  --max-size SIZE    Size budget of the cache (e.g., 500M, 10G).
+  --max-age DAYS     Age budget of the cache in days since the last use.
+  --dry-run          Only report what would be removed.
+
   --debug            Enable debug output.
   -h --help          Show this help message.
   --version          Show version information.
@@ -141,17 +221,135 @@ def run_script(script: str | os.PathLike):
 		logger.error(f"Script '{script_path}' not found!")
 		raise ex
 
+	old_wd = os.getcwd()
 	try:
-		old_wd = os.getcwd()
 		os.chdir(script_path.parent)
 		exec(code_obj)
-		os.chdir(old_wd)
 	except Exception as ex:
 		logger.error(f"Failed to execute script '{script_path}'")
 		raise ex
+	finally:
+		os.chdir(old_wd)
 
 logger = logging.getLogger("tavox")
 
+def _parse_size(size: str) -> int:
+	units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+	size = size.strip().upper().removesuffix("B")
+	try:
+		if size[-1:] in units:
+			return int(float(size[:-1]) * units[size[-1]])
+		return int(size)
+	except ValueError as ex:
+		logger.error(f"Invalid size: {size}")
+		raise ex
+
+def _parse_days(days: str) -> float:
+	try:
+		return float(days) * 24 * 3600
+	except ValueError as ex:
+		logger.error(f"Invalid number of days: {days}")
+		raise ex
+
+def _parse_segments(segments: str) -> int:
+	try:
+		num_segments = int(segments)
+		if num_segments < 1:
+			raise ValueError()
+		return num_segments
+	except ValueError as ex:
+		logger.error(f"Invalid number of segments: {segments}")
+		raise ex
+
+def _parse_preview_rate(rate: str) -> float:
+	try:
+		words_per_minute = float(rate)
+		if words_per_minute <= 0:
+			raise ValueError()
+		return words_per_minute
+	except ValueError as ex:
+		logger.error(f"Invalid speaking rate: {rate}")
+		raise ex
+
+def _format_size(size: int) -> str:
+	for unit in ["B", "KiB", "MiB", "GiB"]:
+		if size < 1024:
+			return f"{size:.1f} {unit}"
+		size /= 1024
+	return f"{size:.1f} TiB"
+
+class _ProgressBar:
+	"""
+	Shows the progress of the rendering on stderr, including the render speed (frames per second) and the
+	estimated remaining time.
+	"""
+
+	_WIDTH = 30
+	# minimum time between two redraws in seconds
+	_INTERVAL = 0.2
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._start = time.monotonic()
+		self._last_draw = None
+
+	def __call__(self, done: int, total: int):
+		with self._lock:
+			now = time.monotonic()
+			if self._last_draw is not None and now - self._last_draw < self._INTERVAL and done < total:
+				return
+			self._last_draw = now
+			elapsed = now - self._start
+			rate = done / elapsed if elapsed > 0 else 0
+			eta = str(timedelta(seconds=round((total - done) / rate))) if rate > 0 else "-:--:--"
+			fraction = done / total if total > 0 else 1
+			filled = round(self._WIDTH * fraction)
+			sys.stderr.write(f"\r[{'#' * filled}{'.' * (self._WIDTH - filled)}] {fraction * 100:5.1f}% {done}/{total} frames, {rate:.1f} fps, ETA {eta} ")
+			sys.stderr.flush()
+
+	def close(self):
+		with self._lock:
+			if self._last_draw is not None:
+				sys.stderr.write("\n")
+				sys.stderr.flush()
+
+def _file_caches(cache_dir: Path) -> dict[str, FileCache]:
+	return {
+		"slide": SlideCache(cache_dir / SLIDE_CACHE_DIR_NAME),
+		"video chunk": ChunkCache(cache_dir / CHUNK_CACHE_DIR_NAME, ""),
+		"placeholder sample": PlaceholderCache(cache_dir / PLACEHOLDER_CACHE_DIR_NAME),
+	}
+
+def run_cache_command(options: dict[str, Any], sample_db: SampleDB):
+	max_size = _parse_size(options["--max-size"]) if options["--max-size"] else None
+	max_age = _parse_days(options["--max-age"]) if options["--max-age"] else None
+
+	if options["stats"]:
+		stats = sample_db.statistics(max_size, max_age)
+		print(f"cache directory: {stats['path']}")
+		print(f"samples:         {stats['samples']} ({_format_size(stats['size'])})")
+		hit_rate = "n/a" if stats["hit_rate"] is None else f"{stats['hit_rate'] * 100:.1f}%"
+		print(f"hit rate:        {hit_rate} ({stats['hits']} hits, {stats['misses']} misses)")
+		print(f"orphaned files:  {stats['orphans']}")
+		print(f"reclaimable:     {_format_size(stats['reclaimable'])}")
+		for voice_id, voice_stats in sorted(stats["voices"].items()):
+			print(f"  {voice_id}: {voice_stats['samples']} samples ({_format_size(voice_stats['size'])})")
+		for name, file_cache in _file_caches(sample_db.path).items():
+			file_stats = file_cache.statistics()
+			print(f"{name}s:".ljust(17) + f"{file_stats['files']} ({_format_size(file_stats['size'])})")
+	elif options["prune"]:
+		result = sample_db.prune(max_size, max_age, dry_run=options["--dry-run"])
+		action = "would remove" if options["--dry-run"] else "removed"
+		print(f"{action} {result['samples']} sample(s) and {result['orphans']} orphaned file(s), {_format_size(result['size'])}")
+		for name, file_cache in _file_caches(sample_db.path).items():
+			file_result = file_cache.prune(max_size, max_age, dry_run=options["--dry-run"])
+			print(f"{action} {file_result['files']} {name}(s), {_format_size(file_result['size'])}")
+		workspace_result = prune_workspaces(sample_db.path / WORKSPACE_DIR_NAME, max_age, dry_run=options["--dry-run"])
+		print(f"{action} {workspace_result['workspaces']} build workspace(s), {_format_size(workspace_result['size'])}")
+	elif options["verify"]:
+		result = sample_db.verify()
+		print(f"checked {result['checked']} sample(s): {result['broken']} broken entries removed, {result['recovered']} sample(s) recovered")
+
 def run_tavox():
 	options: dict[str, Any] = docopt.docopt(usage_msg, version=__version__)
 
@@ -166,57 +364,295 @@ def run_tavox():
 			print(v)
 		return
 
-	script = Path(options["<SCRIPT>"])
+	cache_dir = Path(options["--cache-dir"]).expanduser()
+	if options["batch"]:
+		# the outputs are rendered while the next script is run in its own working directory
+		cache_dir = cache_dir.absolute()
+	sample_db = SampleDB(cache_dir)
 
-	project = TavoxProject()
-	activate_project(project)
+	if options["cache"]:
+		try:
+			run_cache_command(options, sample_db)
+		finally:
+			sample_db.close()
+		return
 
-	if options["--pre-script"]:
-		run_script(options["--pre-script"])
+	profiler = enable_profiling() if options["--profile"] else None
+	try:
+		if options["batch"]:
+			run_batch(options, cache_dir, sample_db)
+		else:
+			build(options, Path(options["<SCRIPT>"]), cache_dir, sample_db)
+	finally:
+		if profiler is not None:
+			disable_profiling()
+			write_profile(profiler, Path(options["--profile"]))
+
+def write_profile(profiler: Profiler, path: Path):
+	trace_path = path.with_suffix(".trace.json")
+	profiler.write_summary(path)
+	profiler.write_trace(trace_path)
+	logger.info(f"profile written to {path} (trace: {trace_path})")
+
+def check_build_options(options: dict[str, Any]) -> tuple[int, PreviewSettings | None]:
+	"""
+	Validates the build options and returns the number of jobs and the preview settings.
+	"""
+	if options["--render-profile"] is not None:
+		try:
+			get_render_profile(options["--render-profile"])
+		except ValueError as ex:
+			logger.error(ex)
+			raise ex
+
+	try:
+		jobs = int(options["--jobs"])
+	except ValueError as ex:
+		logger.error(f"Invalid number of jobs: {options['--jobs']}")
+		raise ex
+	if options["--segments"] != "auto":
+		_parse_segments(options["--segments"])
+	if options["--backend"] not in ("melt", "ffmpeg"):
+		logger.error(f"Invalid backend: {options['--backend']}")
+		raise ValueError(f"invalid backend {options['--backend']}")
+	preview = None
+	if options["--preview"]:
+		preview = PreviewSettings(words_per_minute=_parse_preview_rate(options["--preview-rate"]), tone=options["--preview-tone"])
+		logger.info("preview mode: using placeholder samples instead of synthesizing the voice samples")
+	return jobs, preview
 
+def compile_script(options: dict[str, Any], project: TavoxProject, script: Path, cache_dir: Path, sample_db: SampleDB, jobs: int, preview: PreviewSettings | None, pools: WorkerPools | None = None) -> tuple[str | os.PathLike, BuildWorkspace | None]:
+	"""
+	Runs the script on the (active) project and creates its MLT project. Returns the path of the MLT project
+	file and the build workspace. If worker pools are given, they are used for the synthesis and the slides.
+	"""
 	set_voice(options["--voice"])
-	run_script(script)
+	with span("run script"):
+		run_script(script)
 
+	if options["--render-profile"] is not None:
+		project.set_render_profile(options["--render-profile"])
+	logger.info(f"using render profile: {project.render_profile_name}")
+
+	# without an explicit project file, the project is built in the persistent workspace of the script
+	workspace = None
 	if options["--mlt-project"]:
 		mlt_project_file = options["--mlt-project"]
 	else:
-		mlt_dir = tempfile.TemporaryDirectory(prefix="tavox_", delete=False).name
-		mlt_project_file = f"{mlt_dir}/{script.name}.mlt"
-	create_mlt(project, mlt_project_file, merge_speak_commands=options["--speak-merge"])
-
-	if not options["--no-video"]:
-		logger.info("rendering video")
-
-		out_path = f"{script.name}.mkv"
-		if options["--out-path"] is not None:
-			out_path = options["--out-path"]
-
-		supported_codecs = ffmpeg_get_encoders()
-		if "libx264" in supported_codecs:
-			vcodec = "libx264"
-		elif "libopenh264" in supported_codecs:
-			vcodec = "libopenh264"
+		workspace = BuildWorkspace.for_script(cache_dir, script)
+		mlt_project_file = workspace.mlt_project_file
+
+	with span("create mlt"):
+		create_mlt(project, mlt_project_file, merge_speak_commands=options["--speak-merge"], jobs=jobs, sample_db=sample_db, workspace=workspace, preview=preview, premix_audio=not options["--separate-audio"], pools=pools)
+	return mlt_project_file, workspace
+
+def render_output(options: dict[str, Any], script: Path, mlt_project_file: str | os.PathLike, render_profile: RenderProfile, workspace: BuildWorkspace | None = None, show_progress: bool = True, cancellation: Cancellation | None = None):
+	"""
+	Renders the video (or the audio track) of an MLT project, depending on the options.
+	"""
+	if options["--audio-only"]:
+		with span("render audio track"):
+			render_audio_track(options, script, mlt_project_file, workspace)
+	elif not options["--no-video"]:
+		with span("render video"):
+			render_video(options, script, mlt_project_file, render_profile, workspace, show_progress, cancellation)
+	if workspace is not None:
+		workspace.save()
+
+def prune_caches(options: dict[str, Any], cache_dir: Path, sample_db: SampleDB):
+	if not options["--cache-max-size"] and not options["--cache-max-age"]:
+		return
+	max_size = _parse_size(options["--cache-max-size"]) if options["--cache-max-size"] else None
+	max_age = _parse_days(options["--cache-max-age"]) if options["--cache-max-age"] else None
+	result = sample_db.prune(max_size, max_age)
+	logger.info(f"pruned sample cache: removed {result['samples']} sample(s) and {result['orphans']} orphaned file(s), {_format_size(result['size'])}")
+	for name, file_cache in _file_caches(cache_dir).items():
+		result = file_cache.prune(max_size, max_age)
+		logger.info(f"pruned {name} cache: removed {result['files']} {name}(s), {_format_size(result['size'])}")
+	result = prune_workspaces(cache_dir / WORKSPACE_DIR_NAME, max_age)
+	logger.info(f"pruned build workspaces: removed {result['workspaces']} workspace(s), {_format_size(result['size'])}")
+
+def build(options: dict[str, Any], script: Path, cache_dir: Path, sample_db: SampleDB):
+	project = TavoxProject()
+	activate_project(project)
+
+	try:
+		if options["--pre-script"]:
+			run_script(options["--pre-script"])
+		jobs, preview = check_build_options(options)
+
+		mlt_project_file, workspace = compile_script(options, project, script, cache_dir, sample_db, jobs, preview)
+		render_output(options, script, mlt_project_file, project.render_profile, workspace)
+
+		# prune after rendering, such that no sample that is used by the project is removed before it was rendered
+		prune_caches(options, cache_dir, sample_db)
+	finally:
+		sample_db.close()
+
+def _expand_script_patterns(patterns: list[str]) -> list[Path]:
+	scripts = []
+	for pattern in patterns:
+		if glob.has_magic(pattern):
+			matches = sorted(glob.glob(pattern, recursive=True))
+			if len(matches) == 0:
+				logger.warning(f"no script matches '{pattern}'")
+			scripts += [Path(x) for x in matches]
+		else:
+			scripts.append(Path(pattern))
+	# the scripts change the working directory, hence all paths must be absolute
+	return list(dict.fromkeys(x.absolute() for x in scripts))
+
+def run_batch(options: dict[str, Any], cache_dir: Path, sample_db: SampleDB):
+	"""
+	Builds several scripts in a single process, such that the voices, the TTS clients, the sample cache and the
+	worker pools for synthesis and slide rendering are shared, i.e., --jobs bounds the whole batch. The scripts
+	are run and compiled one after another (they use the active project and change the working directory),
+	while the output of a compiled script is rendered in the background. A failing script does not affect the
+	other scripts.
+	"""
+	scripts = _expand_script_patterns(options["<PATTERN>"])
+	out_dir = Path(options["--out-dir"] if options["--out-dir"] is not None else ".").absolute()
+	extension = ".flac" if options["--audio-only"] else ".mkv"
+	names = [x.name for x in scripts]
+	duplicates = sorted({x for x in names if names.count(x) > 1})
+	if len(duplicates) > 0:
+		logger.error(f"The output files of scripts with the same name would overwrite each other: {', '.join(duplicates)}")
+		raise ValueError("duplicate script names")
+	try:
+		out_dir.mkdir(parents=True, exist_ok=True)
+	except OSError as ex:
+		logger.error(f"Unable to create the output directory {out_dir}: {ex}")
+		raise ex
+
+	activate_project(TavoxProject())
+	# the pre-script is only run once, it is meant to register voices and render profiles
+	if options["--pre-script"]:
+		run_script(options["--pre-script"])
+	jobs, preview = check_build_options(options)
+
+	# status, duration and output path or error message of every script
+	results: dict[Path, tuple[str, float, str]] = {}
+	cancellation = Cancellation()
+
+	def render(script: Path, mlt_project_file: Path, render_profile: RenderProfile, workspace: BuildWorkspace, duration: float):
+		start = time.monotonic()
+		script_options = dict(options, **{"--out-path": str(out_dir / f"{script.name}{extension}"), "--cache-dir": str(cache_dir)})
+		try:
+			render_output(script_options, script, mlt_project_file, render_profile, workspace, show_progress=False, cancellation=cancellation)
+			output = script_options["--out-path"] if options["--audio-only"] or not options["--no-video"] else ""
+			results[script] = ("ok", duration + time.monotonic() - start, output)
+		except Exception as ex:
+			logger.error(f"Failed to render {script.name}: {ex}")
+			results[script] = ("failed", duration + time.monotonic() - start, str(ex))
+
+	try:
+		with WorkerPools(jobs) as pools, ThreadPoolExecutor(max_workers=1, thread_name_prefix="tavox_render") as executor:
+			try:
+				for idx, script in enumerate(scripts):
+					logger.info(f"[{idx + 1}/{len(scripts)}] building {script}")
+					start = time.monotonic()
+					project = TavoxProject()
+					activate_project(project)
+					try:
+						with span(script.name, "script"):
+							mlt_project_file, workspace = compile_script(options, project, script, cache_dir, sample_db, jobs, preview, pools)
+					except Exception as ex:
+						logger.error(f"Failed to build {script.name}: {ex}")
+						results[script] = ("failed", time.monotonic() - start, str(ex))
+						continue
+					executor.submit(render, script, mlt_project_file, project.render_profile, workspace, time.monotonic() - start)
+			except BaseException as ex:
+				cancellation.cancel()
+				executor.shutdown(wait=True, cancel_futures=True)
+				raise ex
+
+		prune_caches(options, cache_dir, sample_db)
+	finally:
+		sample_db.close()
+
+	logger.info("batch summary:")
+	for script in scripts:
+		status, duration, detail = results[script]
+		logger.info(f"  {status:<8}{script.name:<32}{duration:8.1f} s  {detail.splitlines()[0] if detail else ''}")
+	failed = sum(1 for status, _, _ in results.values() if status != "ok")
+	if failed > 0:
+		logger.error(f"{failed} of {len(scripts)} script(s) failed")
+		raise RuntimeError(f"{failed} of {len(scripts)} script(s) failed")
+
+def render_video(options: dict[str, Any], script: Path, mlt_project_file: str | os.PathLike, render_profile: RenderProfile, workspace: BuildWorkspace | None = None, show_progress: bool = True, cancellation: Cancellation | None = None):
+	logger.info("rendering video")
+
+	out_path = f"{script.name}.mkv"
+	if options["--out-path"] is not None:
+		out_path = options["--out-path"]
+
+	vcodec = render_profile.get_video_codec()
+	logger.info(f"using video codec: {vcodec}")
+	consumer_properties = render_profile.get_consumer_properties(vcodec)
+
+	if workspace is not None:
+		output_fingerprint = workspace.output_fingerprint(f"{mlt_project_file}", f"{out_path}", options["--backend"], consumer_properties)
+		if workspace.is_output_up_to_date(out_path, output_fingerprint):
+			logger.info(f"video {out_path} is up to date")
+			return
+
+	num_segments = None if options["--segments"] == "auto" else _parse_segments(options["--segments"])
+	# the progress bar would clutter redirected output
+	progress = _ProgressBar() if show_progress and sys.stderr.isatty() else None
+	try:
+		if options["--backend"] == "ffmpeg":
+			render_ffmpeg(
+				mlt_project_file,
+				out_path,
+				consumer_properties,
+				work_dir=workspace.path if workspace is not None else None,
+				num_workers=num_segments
+			)
+		elif options["--no-chunk-cache"]:
+			render_segmented(
+				mlt_project_file,
+				out_path,
+				consumer_properties,
+				num_segments=num_segments,
+				work_dir=workspace.path if workspace is not None else None,
+				progress=progress,
+				cancellation=cancellation
+			)
 		else:
-			logger.error("No suitable video codec found.")
-			raise RuntimeError("no video encoder found")
-
-		logger.info(f"using video codec: {vcodec}")
-		run_melt([
-			"-progress",
-			"-verbose",
-			f"{mlt_project_file}",
-			"-consumer",
-			f"avformat:{out_path}",
-			"acodec=flac",
-			f"vcodec={vcodec}",
-			"preset=slow",
-			"crf=16"
-		])
-		logger.info(f"video rendered to {out_path}")
+			chunk_cache = ChunkCache(Path(options["--cache-dir"]).expanduser() / CHUNK_CACHE_DIR_NAME, Path(out_path).suffix)
+			render_chunked(mlt_project_file, out_path, consumer_properties, chunk_cache, num_workers=num_segments, progress=progress, cancellation=cancellation)
+	finally:
+		if progress is not None:
+			progress.close()
+	logger.info(f"video rendered to {out_path}")
+	if workspace is not None:
+		workspace.record_output(out_path, output_fingerprint)
+
+def render_audio_track(options: dict[str, Any], script: Path, mlt_project_file: str | os.PathLike, workspace: BuildWorkspace | None = None):
+	logger.info("rendering audio track")
+
+	out_path = f"{script.name}.flac"
+	if options["--out-path"] is not None:
+		out_path = options["--out-path"]
+
+	if workspace is not None:
+		output_fingerprint = workspace.output_fingerprint(f"{mlt_project_file}", f"{out_path}", "audio-only")
+		if workspace.is_output_up_to_date(out_path, output_fingerprint):
+			logger.info(f"audio track {out_path} is up to date")
+			return
+
+	render_audio(mlt_project_file, out_path, work_dir=workspace.path if workspace is not None else None)
+	logger.info(f"audio track rendered to {out_path}")
+	if workspace is not None:
+		workspace.record_output(out_path, output_fingerprint)
 
 def main():
 	try:
 		run_tavox()
+	except KeyboardInterrupt:
+		# the render functions terminate the melt processes before the interrupt is propagated
+		logger.error("Cancelled")
+		exit(130)
 	except Exception as ex:
 		if logger.getEffectiveLevel() <= logging.DEBUG:
 			raise ex
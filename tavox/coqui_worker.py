@@ -0,0 +1,120 @@
+#!/bin/env python3
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+# Long-lived Coqui TTS worker. The model is loaded once and synthesis requests are read as JSON lines:
+#
+#   request:  {"text": "...", "out_path": "/path/to/sample.wav"}
+#             {"batch": [{"text": "...", "out_path": "..."}, ...]}
+#   response: {"ok": true} or {"ok": false, "error": "..."}
+#
+# After loading the model the worker sends {"ready": true} (or {"ready": false, "error": "..."}).
+# By default requests are read from stdin, with --daemon (or --socket PATH) the worker serves requests on a
+# unix domain socket, such that the model is only loaded once per daemon lifetime. CoquiTTS voices
+# automatically connect to a daemon listening on the default socket path of their model.
+#
+# Note that this file is executed by the Python interpreter of the Coqui TTS installation, which may be
+# older than the one running tavox (Coqui TTS 0.22 requires Python 3.9). Hence, it must not import
+# anything from the tavox package.
+
+import sys
+import os
+import json
+import argparse
+import socket
+import hashlib
+import tempfile
+import traceback
+
+
+def default_socket_path(model):
+	h = hashlib.sha256(model.encode("utf-8")).hexdigest()[:16]
+	return os.path.join(tempfile.gettempdir(), f"tavox_coqui_{h}.sock")
+
+
+def _load_model(model):
+	from TTS.api import TTS
+	return TTS(model_name=model, progress_bar=False)
+
+
+def _serve(tts, req_file, resp_file):
+	for line in req_file:
+		line = line.strip()
+		if line == "":
+			continue
+		try:
+			request = json.loads(line)
+			for item in request.get("batch", [request]):
+				tts.tts_to_file(text=item["text"], file_path=item["out_path"])
+			response = {"ok": True}
+		except Exception as ex:
+			traceback.print_exc(file=sys.stderr)
+			response = {"ok": False, "error": str(ex)}
+		resp_file.write(json.dumps(response) + "\n")
+		resp_file.flush()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="tavox Coqui TTS worker")
+	parser.add_argument("--model", required=True)
+	parser.add_argument("--socket", default=None)
+	parser.add_argument("--daemon", action="store_true")
+	args = parser.parse_args()
+	if args.daemon and args.socket is None:
+		args.socket = default_socket_path(args.model)
+
+	# TTS prints progress information to stdout, which would corrupt the protocol stream
+	resp_file = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+	os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+	try:
+		tts = _load_model(args.model)
+	except Exception as ex:
+		traceback.print_exc(file=sys.stderr)
+		resp_file.write(json.dumps({"ready": False, "error": str(ex)}) + "\n")
+		resp_file.flush()
+		sys.exit(1)
+
+	if args.socket is None:
+		resp_file.write(json.dumps({"ready": True}) + "\n")
+		resp_file.flush()
+		_serve(tts, sys.stdin, resp_file)
+		return
+
+	if os.path.exists(args.socket):
+		os.unlink(args.socket)
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(args.socket)
+	server.listen()
+	resp_file.write(json.dumps({"ready": True}) + "\n")
+	resp_file.flush()
+	try:
+		while True:
+			conn, _ = server.accept()
+			with conn, conn.makefile("r") as req, conn.makefile("w") as resp:
+				conn.sendall((json.dumps({"ready": True}) + "\n").encode("utf-8"))
+				_serve(tts, req, resp)
+	finally:
+		server.close()
+		os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+	main()
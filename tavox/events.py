@@ -22,54 +22,63 @@
 from dataclasses import dataclass
 from pathlib import Path
 from datetime import timedelta
+from typing import Optional
 
 from .voices import Voice
 
 
 class TimelineEvent:
-	pass
+	__slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class ShowSlideEvent(TimelineEvent):
 	pdf: Path
 	slide: int
 
 
-@dataclass
+@dataclass(slots=True)
 class ShowSlideRangeEvent(TimelineEvent):
 	pdf: Path
 	start_slide: int
 	end_slide: int
 
 
-@dataclass
+@dataclass(slots=True)
 class SpeakEvent(TimelineEvent):
 	text: str
 	voice: Voice
 
 
-@dataclass
+@dataclass(slots=True)
 class DelayEvent(TimelineEvent):
 	length: timedelta
 
 
-@dataclass
+@dataclass(slots=True)
 class PlayAudioEvent(TimelineEvent):
 	audio_file: Path
 
 
-@dataclass
+@dataclass(slots=True)
 class ShowImageEvent(TimelineEvent):
 	image_file: Path
 
 
-@dataclass
+@dataclass(slots=True)
 class StillFrame:
 	image_file: Path
-	duration: timedelta
+	length: int = 0  # frames, 0: the remaining time of the range is split evenly among these frames
 
 
-@dataclass
+@dataclass(slots=True)
 class ShowImageRangeEvent(TimelineEvent):
 	frames: list[StillFrame]
+
+
+# the events above are compiled into a frame-exact timeline, in which all audio (including delays) is represented
+# by audio clips
+@dataclass(slots=True)
+class AudioClipEvent(TimelineEvent):
+	audio_file: Optional[Path]  # None: silence
+	length: int  # frames
@@ -7,6 +7,12 @@ import re
 import pathlib
 import os
 import logging
+import threading
+
+from typing import Callable
+from collections import deque
+
+from .profiling import span
 
 logger = logging.getLogger("tavox")
 
@@ -16,9 +22,17 @@ _shotcut_windows_search_paths = [
 	r"%PROGRAMFILES(X86)%/Shotcut"
 ]
 
+_MELT_PROGRESS_RE = re.compile(rb"Current Frame:\s*(\d+)")
+# only the last lines of the output of melt are kept for the error message, s.t. long renders use bounded memory
+_MELT_STDERR_TAIL_LINES = 50
+_MELT_STDERR_READ_SIZE = 65536
+# seconds to wait for a terminated process before it is killed
+_TERMINATE_TIMEOUT = 5
+
 _melt_bin_name = None
 _ffmpeg_bin_name = None
 _ffprobe_bin_name = None
+_ffmpeg_encoders = None
 
 def _get_melt_bin() -> str:
 	global _melt_bin_name
@@ -78,24 +92,116 @@ def run_pdftoppm(arguments):
 	"""
 	Run the pdftoppm command with the given arguments.
 	"""
-	r = subprocess.run(
-		["pdftoppm"] + arguments,
-		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE,
-		text=True
-	)
+	with span("pdftoppm", "tool", arguments=arguments):
+		r = subprocess.run(
+			["pdftoppm"] + arguments,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+			text=True
+		)
 	if r.returncode != 0:
 		raise Exception(f"Unable to render PDF. pdftoppm exited with return code {r.returncode}. stderr: {r.stderr.decode("utf-8")}")
 
-def run_melt(arguments):
-	r = subprocess.run(
-		[_get_melt_bin()] + arguments,
-		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE,
-		text=True
-	)
+class RenderCancelled(Exception):
+	pass
+
+class Cancellation:
+	"""
+	Cancels the external processes that are started on its behalf (see run_melt). Processes that are started
+	after the cancellation are terminated immediately.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._cancelled = False
+		self._processes: set[subprocess.Popen] = set()
+
+	@property
+	def cancelled(self) -> bool:
+		return self._cancelled
+
+	def cancel(self):
+		with self._lock:
+			self._cancelled = True
+			processes = list(self._processes)
+		for process in processes:
+			_terminate(process)
+
+	def _register(self, process: subprocess.Popen) -> bool:
+		with self._lock:
+			if self._cancelled:
+				return False
+			self._processes.add(process)
+			return True
+
+	def _unregister(self, process: subprocess.Popen):
+		with self._lock:
+			self._processes.discard(process)
+
+def _terminate(process: subprocess.Popen):
+	if process.poll() is not None:
+		return
+	process.terminate()
+	try:
+		process.wait(timeout=_TERMINATE_TIMEOUT)
+	except subprocess.TimeoutExpired:
+		process.kill()
+		process.wait()
+
+def run_melt(arguments, progress: Callable[[int], None] | None = None, cancellation: Cancellation | None = None):
+	"""
+	Runs melt with the given arguments. The output of melt is parsed while it is running: the current frame
+	reported by melt (if it is run with -progress) is passed to the progress callback, all other output is
+	discarded except for the last lines, which are included in the error message.
+	"""
+	with span("melt", "tool", arguments=arguments):
+		process = subprocess.Popen(
+			[_get_melt_bin()] + arguments,
+			stdin=subprocess.DEVNULL,
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.PIPE
+		)
+		try:
+			if cancellation is not None and not cancellation._register(process):
+				raise RenderCancelled("rendering was cancelled")
+			tail: deque[bytes] = deque(maxlen=_MELT_STDERR_TAIL_LINES)
+			pending = b""
+			while chunk := process.stderr.read1(_MELT_STDERR_READ_SIZE):
+				# melt terminates the progress lines with a carriage return
+				lines = re.split(rb"[\r\n]", pending + chunk)
+				pending = lines.pop()[-_MELT_STDERR_READ_SIZE:]
+				for line in lines:
+					match = _MELT_PROGRESS_RE.match(line)
+					if match is not None:
+						if progress is not None:
+							progress(int(match.group(1)))
+					elif line.strip() != b"":
+						tail.append(line)
+			process.wait()
+		except BaseException as ex:
+			_terminate(process)
+			raise ex
+		finally:
+			process.stderr.close()
+			if cancellation is not None:
+				cancellation._unregister(process)
+
+	if cancellation is not None and cancellation.cancelled:
+		raise RenderCancelled("rendering was cancelled")
+	if process.returncode != 0:
+		stderr = b"\n".join(tail).decode("utf-8", errors="replace")
+		raise Exception(f"Unable to run MLT. melt exited with return code {process.returncode}. stderr: {stderr}")
+
+def run_ffmpeg(arguments):
+	with span("ffmpeg", "tool", arguments=arguments):
+		r = subprocess.run(
+			[_get_ffmpeg_bin(), "-y", "-v", "error"] + arguments,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+			text=True
+		)
 	if r.returncode != 0:
-		raise Exception(f"Unable to run MLT. melt exited with return code {r.returncode}. stderr: {r.stderr.decode('utf-8')}")
+		raise Exception(f"Unable to run ffmpeg. ffmpeg exited with return code {r.returncode}. stderr: {r.stderr}")
 
 def ffprobe_get_audio_length(audio_file : str) -> float:
 	"""
@@ -112,7 +218,8 @@ def ffprobe_get_audio_length(audio_file : str) -> float:
 		"-of", 
 		"csv=p=0"
 	]
-	return float(subprocess.check_output(ffprobe_cmd).decode("utf-8"))
+	with span("ffprobe", "tool", audio_file=f"{audio_file}"):
+		return float(subprocess.check_output(ffprobe_cmd).decode("utf-8"))
 
 def ffmpeg_get_encoders() -> dict[str, dict[str, str]]:
 	"""
@@ -120,6 +227,10 @@ def ffmpeg_get_encoders() -> dict[str, dict[str, str]]:
 	Returns:
 		dict: A dictionary where keys are encoder names and values are descriptions.
 	"""
+	global _ffmpeg_encoders
+	if _ffmpeg_encoders is not None:
+		return _ffmpeg_encoders
+
 	# Run the `ffmpeg` command to get the list of encoders
 	try:
 		result = subprocess.run([_get_ffmpeg_bin(), "-v", "0", "-encoders"], capture_output=True, text=True, check=True)
@@ -151,4 +262,16 @@ def ffmpeg_get_encoders() -> dict[str, dict[str, str]]:
 			flags, name, description = match.groups()
 			encoders[name] = {"flags": flags.strip(), "description": description.strip()}
 
-	return encoders
\ No newline at end of file
+	_ffmpeg_encoders = encoders
+	return encoders
+
+def pdfinfo_get_page_count(pdf_file: str) -> int:
+	"""
+	Uses pdfinfo to get the number of pages of a PDF file.
+	"""
+	with span("pdfinfo", "tool", pdf_file=f"{pdf_file}"):
+		output = subprocess.check_output(["pdfinfo", f"{pdf_file}"]).decode("utf-8", errors="replace")
+	match = re.search(r"^Pages:\s+(\d+)", output, re.MULTILINE)
+	if match is None:
+		raise RuntimeError(f"Unable to determine the number of pages of {pdf_file}")
+	return int(match.group(1))
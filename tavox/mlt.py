@@ -20,24 +20,62 @@
 
 import os
 import uuid
-import textwrap
+import itertools
 import math
 import logging
 import platform
-import glob
 import shutil
+import tempfile
+import contextlib
 
+from typing import TextIO, Iterator
 from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dataclasses import dataclass
 from datetime import timedelta
 
-from .cache import SampleDB
+from .cache import SampleDB, SlideCache, PlaceholderCache, DEFAULT_CACHE_PATH, SLIDE_CACHE_DIR_NAME, PLACEHOLDER_CACHE_DIR_NAME
+from .voices import Voice
 from .project import TavoxProject
 from .events import *
-from .external_tools import run_pdftoppm, ffprobe_get_audio_length
+from .external_tools import run_pdftoppm
+from .pdf import pdf_page_hashes
+from .workspace import BuildWorkspace, fingerprint
+from .preview import PreviewSettings, get_placeholder_sample
+from .audio import get_audio_lengths, write_audio_track, AudioLengthCache, AUDIO_LENGTH_CACHE_FILE_NAME, AUDIO_TRACK_CHANNELS, AUDIO_TRACK_VERSION
+from .profiling import span
 
 logger = logging.getLogger("tavox")
 
+_MAX_SYNTHESIS_BATCH_SIZE = 32
+_SLIDE_DPI = 600
+
+
+class WorkerPools:
+	"""
+	The thread pools of a build: up to `jobs` voice samples are synthesized at the same time and pdftoppm runs on
+	every core. The pools can be shared by several builds (e.g., the scripts of a batch), such that they are only
+	created once and their limits apply to all of these builds together.
+	"""
+
+	def __init__(self, jobs: int):
+		self.jobs = max(1, jobs)
+		self.pdftoppm_workers = os.cpu_count() or 1
+		self.synthesis = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="tavox_tts")
+		self.pdftoppm = ThreadPoolExecutor(max_workers=self.pdftoppm_workers, thread_name_prefix="tavox_pdftoppm")
+
+	def shutdown(self, cancel_futures: bool = False):
+		self.synthesis.shutdown(wait=True, cancel_futures=cancel_futures)
+		self.pdftoppm.shutdown(wait=True, cancel_futures=cancel_futures)
+
+	def __enter__(self) -> "WorkerPools":
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.shutdown(cancel_futures=exc_type is not None)
+
 
 @dataclass
 class _MLTProject:
@@ -46,13 +84,21 @@ class _MLTProject:
 	width: int
 	height: int
 	pdf_image_dict: dict[Path, Path]
-	producers_xml: str
-	producers_dict: dict[Path, str]
-	audio_playlist_xml: str
-	video_playlist_xml: str
+	# the compiled, frame-exact timeline: (image or audio file, number of frames), silence has no audio file
+	video_playlist: list[tuple[Path, int]]
+	audio_playlist: list[tuple[Path | None, int]]
 	total_length: int
+	# the timeline of the script, it is never modified
 	timeline: list[TimelineEvent]
 	sample_db: SampleDB
+	slide_cache: SlideCache
+	slide_keys: dict[str, str]
+	workspace: BuildWorkspace | None
+	preview: PreviewSettings | None
+	# the premixed narration, if None, every audio file has its own producer
+	audio_track: Path | None
+	pools: WorkerPools
+	jobs: int
 
 	def get_frame_time(self) -> timedelta:
 		return timedelta(microseconds=1000000 / self.fps)
@@ -88,78 +134,132 @@ def _render_pdfs(pdf_files: list[Path], mlt: _MLTProject) -> dict[Path, Path]:
 	logger.info(f"project contains {len(pdf_files)} PDF(s)")
 
 	unique_paths = []
-	for pdf in pdf_files:
+	for pdf in sorted(pdf_files):
 		logger.debug(f"processing {pdf}")
 		dest_path = f"{mlt.project_file_path.parent}/{pdf.name}"
 		while dest_path in unique_paths:
-			dest_path = f"{mlt.project_file_path.parent}/{pdf.name}_{uuid.uuid4().hex}"
+			dest_path = f"{mlt.project_file_path.parent}/{pdf.name}_{len(unique_paths)}"
 		unique_paths.append(dest_path)
 		mlt.pdf_image_dict[pdf] = Path(dest_path).absolute()
 
-		if mlt.pdf_image_dict[pdf].exists():
+		if mlt.workspace is None and mlt.pdf_image_dict[pdf].exists():
 			raise Exception(
 				f"file or directory {mlt.pdf_image_dict[pdf]} already exists in mlt project directory. Try to put the mlt project file in an empty directory!"
 			)
-		os.makedirs(mlt.pdf_image_dict[pdf])
+		os.makedirs(mlt.pdf_image_dict[pdf], exist_ok=True)
 
-	for pdf, dest in mlt.pdf_image_dict.items():
-		logger.info(f"rendering {pdf.name} to {dest}/*.png")
-		run_pdftoppm(["-png", "-r", "600", "-scale-to-y", f"{mlt.height}", "-scale-to-x", f"{mlt.width}", f"{pdf}", f"{dest}/slide"])
-		# rename files to remove leading zeros in slide numbers
-		for path in list(glob.glob(f"{dest}/slide-*.png")):
-			slide_number = Path(path).name.removeprefix("slide-").removesuffix(".png")
-			if slide_number.startswith("0"):
-				new_path = f"{dest}/slide-{int(slide_number)}.png"
-				shutil.move(path, new_path)
-				logger.debug(f"renamed {path} to {new_path}")
-
-
-def _process_slide_events(mlt: _MLTProject):
-	logger.info("processing show slide events")
-	new_timeline = []
+	# only the slides that are actually shown in the timeline are rendered
+	referenced: dict[Path, set[int]] = {}
 	for event in mlt.timeline:
 		match event:
 			case ShowSlideEvent():
-				new_event = ShowImageEvent(
-					image_file=Path(f"{mlt.pdf_image_dict[event.pdf]}/slide-{event.slide}.png").absolute()
-				)
-				new_timeline.append(new_event)
+				referenced.setdefault(event.pdf, set()).add(event.slide)
 			case ShowSlideRangeEvent():
-				frames = []
-				for slide in range(event.start_slide, event.end_slide + 1):
-					frames.append(
-						StillFrame(
-						image_file=Path(f"{mlt.pdf_image_dict[event.pdf]}/slide-{slide}.png").absolute(),
-						duration=timedelta(0)
-						)
-					)
-				new_timeline.append(ShowImageRangeEvent(frames=frames))
-			case _:
-				new_timeline.append(event)
-
-	mlt.timeline = new_timeline
-
+				referenced.setdefault(event.pdf, set()).update(range(event.start_slide, event.end_slide + 1))
 
-def _remove_unnecessary_cuts(mlt: _MLTProject):
-	logger.info("removing unnecessary video cuts")
-	new_timeline = []
-	last_show_image_event = None
-	for event in mlt.timeline:
+	workers = mlt.pools.pdftoppm_workers
+	tasks = []
+	links = []
+	for pdf, dest in mlt.pdf_image_dict.items():
+		# slides are cached by the hash of their page content, such that only changed pages have to be rendered again
+		page_hashes = mlt.workspace.pdf_page_hashes(pdf, pdf_page_hashes) if mlt.workspace is not None else pdf_page_hashes(pdf)
+		keys = [SlideCache.key(x, mlt.width, mlt.height, _SLIDE_DPI) for x in page_hashes]
+		slides = sorted(referenced.get(pdf, ()))
+		for slide in slides:
+			if slide < 1 or slide > len(keys):
+				raise Exception(f"slide {slide} does not exist in {pdf} ({len(keys)} pages)")
+		missing = [slide for slide in slides if mlt.slide_cache.get(keys[slide - 1]) is None]
+		if len(missing) > 0:
+			logger.info(f"rendering {len(missing)} of {len(keys)} slide(s) of {pdf.name}")
+		else:
+			logger.info(f"all {len(slides)} used slide(s) of {pdf.name} are cached")
+		tasks += [(pdf, first, last, keys) for first, last in _split_into_ranges(missing, workers)]
+		links += [(keys[slide - 1], dest / f"slide-{slide}.png") for slide in slides]
+
+	if len(tasks) > 0:
+		with mlt.slide_cache.temporary_directory() as tmp_dir:
+
+			def render(task: tuple[Path, int, int, list[str]]):
+				pdf, first, last, keys = task
+				prefix = f"{tmp_dir}/{uuid.uuid4().hex}"
+				run_pdftoppm([
+					"-png", "-r", f"{_SLIDE_DPI}", "-scale-to-y", f"{mlt.height}", "-scale-to-x", f"{mlt.width}",
+					"-f", f"{first}", "-l", f"{last}", f"{pdf}", prefix
+				])
+				# pdftoppm pads the slide numbers with leading zeros to the number of digits of the page count
+				digits = len(str(len(keys)))
+				for slide in range(first, last + 1):
+					mlt.slide_cache.put(keys[slide - 1], Path(f"{prefix}-{slide:0{digits}d}.png"))
+
+			logger.debug(f"running {len(tasks)} pdftoppm process(es) on up to {workers} core(s)")
+			futures = [mlt.pools.pdftoppm.submit(render, task) for task in tasks]
+			# all processes must have finished before the temporary directory is removed
+			wait(futures)
+			for future in futures:
+				future.result()
+
+	# slides in the workspace of a previous build are only replaced if they changed
+	previous_slides = mlt.workspace.previous("slides", {}) if mlt.workspace is not None else {}
+	for key, dest in links:
+		mlt.slide_keys[str(dest)] = key
+		if previous_slides.get(str(dest)) == key and dest.exists():
+			continue
+		dest.unlink(missing_ok=True)
+		_link_file(mlt.slide_cache.get(key), dest)
+	for path in previous_slides.keys() - mlt.slide_keys.keys():
+		Path(path).unlink(missing_ok=True)
+
+
+def _split_into_ranges(slides: list[int], parts: int) -> list[tuple[int, int]]:
+	"""
+	Splits the given sorted slide numbers into contiguous ranges, such that the work can be distributed among
+	the given number of parts.
+	"""
+	ranges = []
+	for slide in slides:
+		if len(ranges) > 0 and ranges[-1][1] == slide - 1:
+			ranges[-1][1] = slide
+		else:
+			ranges.append([slide, slide])
+
+	chunk_size = max(1, math.ceil(len(slides) / parts))
+	result = []
+	for first, last in ranges:
+		for chunk_first in range(first, last + 1, chunk_size):
+			result.append((chunk_first, min(chunk_first + chunk_size - 1, last)))
+	return result
+
+
+def _link_file(src: Path, dest: Path):
+	try:
+		os.link(src, dest)
+	except OSError:
+		shutil.copyfile(src, dest)
+
+
+# The timeline is compiled by a chain of generators, each of which transforms the event stream of the previous
+# stage. No stage holds more than a few events, such that the compilation is a single linear pass over the
+# timeline. Only the synthesis of the voice samples needs all texts beforehand, it uses a separate pass over the
+# first stages of the chain.
+
+def _remove_unnecessary_cuts(events: Iterator[TimelineEvent]) -> Iterator[TimelineEvent]:
+	last_show_slide_event = None
+	for event in events:
 		match event:
-			case ShowImageEvent():
-				if last_show_image_event != event:
-					last_show_image_event = event
-					new_timeline.append(event)
+			case ShowSlideEvent():
+				if last_show_slide_event != event:
+					last_show_slide_event = event
+					yield event
+			case ShowSlideRangeEvent():
+				last_show_slide_event = None
+				yield event
 			case _:
-				new_timeline.append(event)
-	mlt.timeline = new_timeline
+				yield event
 
 
-def _merge_speak_events(mlt: _MLTProject):
-	logger.info("merging speak events")
-	new_timeline = []
+def _merge_speak_events(events: Iterator[TimelineEvent]) -> Iterator[TimelineEvent]:
 	current_speak = None
-	for event in mlt.timeline:
+	for event in events:
 		match event:
 			case SpeakEvent():
 				if current_speak is None:
@@ -168,86 +268,140 @@ def _merge_speak_events(mlt: _MLTProject):
 					# merge the commands
 					current_speak = SpeakEvent(text=f"{current_speak.text} {event.text}", voice=current_speak.voice)
 				else:
-					# commands cannot be merged, add them separatly to the timeline
-					new_timeline.append(current_speak)
-					new_timeline.append(event)
+					# commands cannot be merged
+					yield current_speak
+					current_speak = event
 			case _:
 				if current_speak is not None:
-					new_timeline.append(current_speak)
+					yield current_speak
 					current_speak = None
-				new_timeline.append(event)
+				yield event
 
 	if current_speak is not None:
-		new_timeline.append(current_speak)
-	mlt.timeline = new_timeline
+		yield current_speak
 
 
-def _process_speak_events(mlt: _MLTProject):
-	logger.info("processing speak events")
-	new_timeline = []
-	for event in mlt.timeline:
+def _process_slide_events(events: Iterator[TimelineEvent], mlt: _MLTProject) -> Iterator[TimelineEvent]:
+	slide_path = lambda pdf, slide: mlt.pdf_image_dict[pdf] / f"slide-{slide}.png"
+	for event in events:
 		match event:
-			case SpeakEvent():
-				if event.text.strip() == "":
-					#ignore empty speak commands
-					continue
-				path = mlt.sample_db.get_sample(event.text, event.voice)
-				new_event = PlayAudioEvent(audio_file=path)
-				new_timeline.append(new_event)
+			case ShowSlideEvent():
+				yield ShowImageEvent(image_file=slide_path(event.pdf, event.slide))
+			case ShowSlideRangeEvent():
+				yield ShowImageRangeEvent(frames=[StillFrame(image_file=slide_path(event.pdf, x)) for x in range(event.start_slide, event.end_slide + 1)])
 			case _:
-				new_timeline.append(event)
-	mlt.timeline = new_timeline
+				yield event
+
 
+def _synthesize_samples(events: Iterator[TimelineEvent], mlt: _MLTProject):
+	logger.info("synthesizing voice samples")
 
-def _create_mlt_producers(mlt: _MLTProject):
-	logger.info(f"creating producers")
-	for idx, event in enumerate(mlt.timeline):
+	# collect all unique (text, voice) pairs that are not in the cache yet
+	voices: dict[str, Voice] = {}
+	queues: dict[str, deque[str]] = {}
+	seen = set()
+	for event in events:
 		match event:
-			case ShowImageEvent():
-				path = event.image_file
-				producer_name = f"producer{idx}_{path.name}"
-				mlt.producers_xml += textwrap.dedent(
-					f"""
-					<producer id="{producer_name}" in="00:00:00.000" out="03:59:59.960">
-						<property name="length">04:00:00.000</property>
-						<property name="resource">{path}</property>
-					</producer>"""
-				)
-				mlt.producers_dict[path] = producer_name
-			case ShowImageRangeEvent():
-				for frame in event.frames:
-					path = frame.image_file
-					producer_name = f"producer{idx}_{path.name}"
-					mlt.producers_xml += textwrap.dedent(
-						f"""
-						<producer id="{producer_name}" in="00:00:00.000" out="03:59:59.960">
-							<property name="length">04:00:00.000</property>
-							<property name="resource">{path}</property>
-						</producer>"""
-					)
-					mlt.producers_dict[path] = producer_name
+			case SpeakEvent():
+				voice_id = event.voice.voice_id
+				if event.text.strip() == "" or (event.text, voice_id) in seen:
+					continue
+				seen.add((event.text, voice_id))
+				if not mlt.sample_db.contains(event.text, event.voice):
+					voices[voice_id] = event.voice
+					queues.setdefault(voice_id, deque()).append(event.text)
+
+	num_samples = sum(len(q) for q in queues.values())
+	if num_samples == 0:
+		return
+	logger.info(f"{num_samples} sample(s) missing in cache, using up to {mlt.jobs} worker(s)")
+
+	# the pool bounds the total number of concurrent requests, the per-voice limits are enforced by only
+	# submitting a new task for a voice once one of its running tasks has finished
+	executor = mlt.pools.synthesis
+	running = {}
+	batch_sizes: dict[str, int] = {}
+
+	def submit_next(voice_id: str):
+		queue = queues[voice_id]
+		voice = voices[voice_id]
+		if voice.supports_batch:
+			batch = [queue.popleft() for _ in range(min(batch_sizes[voice_id], len(queue)))]
+			future = executor.submit(mlt.sample_db.get_samples, batch, voice)
+		else:
+			future = executor.submit(mlt.sample_db.get_sample, queue.popleft(), voice)
+		running[future] = voice_id
+
+	try:
+		for voice_id, queue in queues.items():
+			limit = min(voices[voice_id].max_concurrency or mlt.jobs, mlt.jobs)
+			# spread the samples of batch capable voices over all available workers
+			batch_sizes[voice_id] = min(_MAX_SYNTHESIS_BATCH_SIZE, math.ceil(len(queue) / limit))
+			for _ in range(min(limit, len(queue))):
+				submit_next(voice_id)
+
+		while len(running) > 0:
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				voice_id = running.pop(future)
+				future.result()
+				if len(queues[voice_id]) > 0:
+					submit_next(voice_id)
+	except BaseException as ex:
+		# the pool may be shared with other builds, hence only the tasks of this build are cancelled
+		for future in running:
+			future.cancel()
+		wait(running)
+		raise ex
+
+
+def _probe_audio_files(mlt: _MLTProject) -> dict[Path, float]:
+	# user supplied audio files are probed in bulk, the durations of voice samples are stored in the sample cache
+	audio_files = [e.audio_file for e in mlt.timeline if isinstance(e, PlayAudioEvent)]
+	if len(audio_files) == 0:
+		return {}
+	logger.info(f"probing {len(audio_files)} audio file(s)")
+
+	length_cache = AudioLengthCache(mlt.sample_db.path / AUDIO_LENGTH_CACHE_FILE_NAME)
+	lengths = get_audio_lengths(audio_files, jobs=mlt.jobs, cache=length_cache)
+	length_cache.save()
+	return lengths
+
+
+def _process_audio_events(events: Iterator[TimelineEvent], mlt: _MLTProject, audio_lengths: dict[Path, float]) -> Iterator[TimelineEvent]:
+	# converts speak events, audio files and delays into audio clips with a length in frames
+	if mlt.preview is not None:
+		# placeholders are kept out of the sample cache, they must never be mistaken for synthesized samples
+		placeholder_cache = PlaceholderCache(mlt.sample_db.path / PLACEHOLDER_CACHE_DIR_NAME)
+	to_frames = lambda d: int(d * mlt.fps)
+	for event in events:
+		match event:
+			case SpeakEvent():
+				if event.text.strip() == "":
+					#ignore empty speak commands
+					continue
+				if mlt.preview is not None:
+					path, duration = get_placeholder_sample(placeholder_cache, mlt.preview, event.text)
+					yield AudioClipEvent(audio_file=path, length=to_frames(duration))
+				else:
+					sample = mlt.sample_db.get_sample(event.text, event.voice)
+					yield AudioClipEvent(audio_file=sample.path, length=to_frames(sample.duration))
 			case PlayAudioEvent():
-				path = event.audio_file
-				producer_name = f"producer{idx}_{path.name}"
-				mlt.producers_xml += textwrap.dedent(
-					f"""
-					<producer id="{producer_name}">
-						<property name="resource">{path}</property>
-					</producer>"""
-				)
-				mlt.producers_dict[path] = producer_name
+				yield AudioClipEvent(audio_file=event.audio_file, length=to_frames(audio_lengths[Path(event.audio_file).absolute()]))
+			case DelayEvent():
+				yield AudioClipEvent(audio_file=None, length=to_frames(event.length.total_seconds()))
+			case _:
+				yield event
 
 
-def _create_mlt_playlists(mlt: _MLTProject):
+def _create_mlt_playlists(events: Iterator[TimelineEvent], mlt: _MLTProject):
 
 	def add_event_to_video_playlist(event: TimelineEvent, target_duration: int):
 		match event:
 			case ShowImageEvent():
-				producer_id = mlt.producers_dict[event.image_file]
-				mlt.video_playlist_xml += f"""<entry producer="{producer_id}" out="{frames_to_str(target_duration-1)}"/>\n"""
+				mlt.video_playlist.append((event.image_file, target_duration))
 			case ShowImageRangeEvent():
-				num_auto_frame_duration = 0
-				frame_durations: list[int] = [int(x.duration.total_seconds() * mlt.fps) for x in event.frames]
+				frame_durations = [x.length for x in event.frames]
 				num_auto_frame_duration = sum([x == 0 for x in frame_durations])
 				static_event_duration = sum(frame_durations)
 
@@ -257,7 +411,7 @@ def _create_mlt_playlists(mlt: _MLTProject):
 					)
 
 				#calculate the auto duration
-				auto_duration = int((target_duration - static_event_duration) / num_auto_frame_duration)
+				auto_duration = (target_duration - static_event_duration) // num_auto_frame_duration
 				for i in range(len(frame_durations)):
 					if frame_durations[i] == 0:
 						frame_durations[i] = auto_duration
@@ -267,17 +421,14 @@ def _create_mlt_playlists(mlt: _MLTProject):
 				# hold the last frame if necessary
 				frame_durations[-1] += target_duration - static_event_duration
 
-				for idx, frame in enumerate(current_video_event.frames):
-					producer_id = mlt.producers_dict[frame.image_file]
-					mlt.video_playlist_xml += f"""<entry producer="{producer_id}" out="{frames_to_str(frame_durations[idx]-1)}"/>\n"""
+				for frame, duration in zip(event.frames, frame_durations):
+					mlt.video_playlist.append((frame.image_file, duration))
 			case _:
 				raise NotImplementedError()
 
 	logger.info("creating playlists")
-	to_frames = lambda d: int(d * mlt.fps)
-	frames_to_str = lambda x: f"{int(x / mlt.fps)}:{x % mlt.fps}"
 
-	current_video_event = mlt.timeline[0]
+	current_video_event = next(events, None)
 	if not isinstance(current_video_event, (ShowImageEvent, ShowImageRangeEvent)):
 		raise Exception("first timeline entry must be a video event!")
 
@@ -285,16 +436,11 @@ def _create_mlt_playlists(mlt: _MLTProject):
 	current_video_event_duration: int = 0
 	total_length: int = 0
 
-	for event in mlt.timeline[1:] + [None]:
+	for event in itertools.chain(events, [None]):
 		match event:
-			case DelayEvent():
-				length = to_frames(event.length.total_seconds())
-				current_video_event_duration += length
-				mlt.audio_playlist_xml += f"""<blank length="{length}"/>\n"""
-			case PlayAudioEvent():
-				length = to_frames(ffprobe_get_audio_length(event.audio_file))
-				current_video_event_duration += length
-				mlt.audio_playlist_xml += f"""<entry producer="{mlt.producers_dict[event.audio_file]}" out="{length-1}"/>\n"""
+			case AudioClipEvent():
+				mlt.audio_playlist.append((event.audio_file, event.length))
+				current_video_event_duration += event.length
 			case _:
 				add_event_to_video_playlist(current_video_event, current_video_event_duration)
 
@@ -306,69 +452,169 @@ def _create_mlt_playlists(mlt: _MLTProject):
 	logger.info(f"total length of video project: {mlt.get_frame_time() * mlt.total_length}")
 
 
-def _create_mlt_project_file(mlt: _MLTProject):
-	producers = textwrap.indent(mlt.producers_xml, "\t\t\t")
-	video_playlist = textwrap.indent(mlt.video_playlist_xml, "\t\t\t\t")
-	audio_playlist = textwrap.indent(mlt.audio_playlist_xml, "\t\t\t\t")
-	aspect_ratio_num, aspect_ratio_den = mlt.get_aspect_ratio()
+def _mix_audio_track(mlt: _MLTProject):
+	# melt only has to decode a single audio file instead of opening and resampling every sample
+	logger.info(f"mixing audio track: {mlt.audio_track}")
+	audio_pieces = []
+	position = 0
+	for audio_file, length in mlt.audio_playlist:
+		audio_pieces.append((position, length, audio_file))
+		position += length
 
-	# The profile is important as it determines the output resolution/framerate
-	# If it is ommitted the project cannot be rendered!
-	profile_xml = f"""<profile description="Custom" width="{mlt.width}" height="{mlt.height}" progressive="1" sample_aspect_num="1" sample_aspect_den="1" display_aspect_num="{aspect_ratio_num}" display_aspect_den="{aspect_ratio_den}" frame_rate_num="{mlt.fps}" frame_rate_den="1" colorspace="709"/>"""
-
-	mlt_template = textwrap.dedent(
-		f"""\
-		<?xml version="1.0" standalone="no"?>
-		<mlt LC_NUMERIC="C" version="7.24.0" producer="main_bin">
-			{profile_xml}
-			<playlist id="main_bin">
-				<property name="xml_retain">1</property>
-			</playlist>
-			<producer id="black" in="00:00:00.000" out="{mlt.total_length-1}">
-				<property name="length">{mlt.total_length}</property>
-				<property name="eof">pause</property>
-				<property name="resource">0</property>
-				<property name="aspect_ratio">1</property>
-				<property name="mlt_service">color</property>
-				<property name="mlt_image_format">rgba</property>
-				<property name="set.test_audio">0</property>
-			</producer>
-			<playlist id="background">
-				<entry producer="black" in="00:00:00.000" out="{mlt.total_length-1}"/>
-			</playlist>
-			{producers}
-			<playlist id="playlist0">
-				<property name="shotcut:video">1</property>
-				<property name="shotcut:name">V1</property>
-				{video_playlist}
-			</playlist>
-			<playlist id="playlist1">
-				<property name="shotcut:audio">1</property>
-				<property name="shotcut:name">A1</property>
-				{audio_playlist}
-			</playlist>
-			<tractor id="tractor0">
-				<property name="shotcut">1</property>
-				<property name="shotcut:projectAudioChannels">2</property>
-				<property name="shotcut:projectFolder">0</property>
-				<property name="shotcut:scaleFactor">2.207</property>
-				<property name="shotcut:skipConvert">0</property>
-				<track producer="background"/>
-				<track producer="playlist0"/>
-				<track producer="playlist1" hide="video"/>
-			</tractor>
-		</mlt>"""
-	)
+	with tempfile.TemporaryDirectory(prefix=".tavox_", dir=mlt.project_file_path.parent) as tmp_dir:
+		tmp_path = Path(tmp_dir) / mlt.audio_track.name
+		write_audio_track(audio_pieces, mlt.total_length, mlt.fps, tmp_path, tmp_dir, mlt.jobs)
+		os.replace(tmp_path, mlt.audio_track)
+	mlt.audio_playlist = [(mlt.audio_track, mlt.total_length)] if mlt.total_length > 0 else []
 
-	with open(mlt.project_file_path, "w") as f:
-		f.write(mlt_template)
 
+class _XMLWriter:
+	"""
+	Minimal streaming XML writer. Every element is written to the file as soon as it is started, attribute
+	values and text are escaped.
+	"""
+
+	def __init__(self, f: TextIO):
+		self._f = f
+		self._stack: list[str] = []
+		self._f.write('<?xml version="1.0" standalone="no"?>\n')
+
+	def _open_tag(self, tag: str, attributes: dict[str, object] | None) -> str:
+		attributes = attributes if attributes is not None else {}
+		return "\t" * len(self._stack) + f"<{tag}" + "".join(f" {k}={quoteattr(str(v))}" for k, v in attributes.items())
+
+	def start(self, tag: str, attributes: dict[str, object] | None = None):
+		self._f.write(self._open_tag(tag, attributes) + ">\n")
+		self._stack.append(tag)
+
+	def end(self):
+		tag = self._stack.pop()
+		self._f.write("\t" * len(self._stack) + f"</{tag}>\n")
+
+	def element(self, tag: str, attributes: dict[str, object] | None = None, text: object | None = None):
+		if text is None:
+			self._f.write(self._open_tag(tag, attributes) + "/>\n")
+		else:
+			self._f.write(self._open_tag(tag, attributes) + f">{escape(str(text))}</{tag}>\n")
 
-def create_mlt(project: TavoxProject, path: str | os.PathLike, merge_speak_commands: bool = False):
+	def property(self, name: str, value: object):
+		self.element("property", {"name": name}, value)
+
+
+def _create_mlt_project_file(mlt: _MLTProject):
+	aspect_ratio_num, aspect_ratio_den = mlt.get_aspect_ratio()
+	frames_to_str = lambda x: f"{int(x / mlt.fps)}:{x % mlt.fps}"
+
+	with open(mlt.project_file_path, "w") as f:
+		xml = _XMLWriter(f)
+		xml.start("mlt", {"LC_NUMERIC": "C", "version": "7.24.0", "producer": "main_bin"})
+
+		# The profile is important as it determines the output resolution/framerate
+		# If it is ommitted the project cannot be rendered!
+		xml.element("profile", {
+			"description": "Custom",
+			"width": mlt.width,
+			"height": mlt.height,
+			"progressive": 1,
+			"sample_aspect_num": 1,
+			"sample_aspect_den": 1,
+			"display_aspect_num": aspect_ratio_num,
+			"display_aspect_den": aspect_ratio_den,
+			"frame_rate_num": mlt.fps,
+			"frame_rate_den": 1,
+			"colorspace": 709,
+		})
+		xml.start("playlist", {"id": "main_bin"})
+		xml.property("xml_retain", 1)
+		xml.end()
+
+		xml.start("producer", {"id": "black", "in": "00:00:00.000", "out": mlt.total_length - 1})
+		xml.property("length", mlt.total_length)
+		xml.property("eof", "pause")
+		xml.property("resource", 0)
+		xml.property("aspect_ratio", 1)
+		xml.property("mlt_service", "color")
+		xml.property("mlt_image_format", "rgba")
+		xml.property("set.test_audio", 0)
+		xml.end()
+		xml.start("playlist", {"id": "background"})
+		xml.element("entry", {"producer": "black", "in": "00:00:00.000", "out": mlt.total_length - 1})
+		xml.end()
+
+		# every resource has a single producer that is shared by all playlist entries
+		image_producers: dict[Path, str] = {}
+		audio_producers: dict[Path, str] = {}
+		for path, _ in mlt.video_playlist:
+			if path not in image_producers:
+				image_producers[path] = f"producer{len(image_producers)}_{path.name}"
+		for path, _ in mlt.audio_playlist:
+			if path is not None and path not in audio_producers:
+				audio_producers[path] = f"audio{len(audio_producers)}_{path.name}"
+
+		for path, producer_id in image_producers.items():
+			xml.start("producer", {"id": producer_id, "in": "00:00:00.000", "out": "03:59:59.960"})
+			xml.property("length", "04:00:00.000")
+			xml.property("resource", path)
+			xml.end()
+		for path, producer_id in audio_producers.items():
+			xml.start("producer", {"id": producer_id})
+			xml.property("resource", path)
+			xml.end()
+
+		xml.start("playlist", {"id": "playlist0"})
+		xml.property("shotcut:video", 1)
+		xml.property("shotcut:name", "V1")
+		for path, length in mlt.video_playlist:
+			xml.element("entry", {"producer": image_producers[path], "out": frames_to_str(length - 1)})
+		xml.end()
+
+		xml.start("playlist", {"id": "playlist1"})
+		xml.property("shotcut:audio", 1)
+		xml.property("shotcut:name", "A1")
+		for path, length in mlt.audio_playlist:
+			if path is None:
+				xml.element("blank", {"length": length})
+			else:
+				xml.element("entry", {"producer": audio_producers[path], "out": length - 1})
+		xml.end()
+
+		xml.start("tractor", {"id": "tractor0"})
+		xml.property("shotcut", 1)
+		xml.property("shotcut:projectAudioChannels", 2)
+		xml.property("shotcut:projectFolder", 0)
+		xml.property("shotcut:scaleFactor", 2.207)
+		xml.property("shotcut:skipConvert", 0)
+		xml.element("track", {"producer": "background"})
+		xml.element("track", {"producer": "playlist0"})
+		xml.element("track", {"producer": "playlist1", "hide": "video"})
+		xml.end()
+
+		xml.end()
+
+
+def create_mlt(
+	project: TavoxProject,
+	path: str | os.PathLike,
+	merge_speak_commands: bool = False,
+	jobs: int = 4,
+	sample_db: SampleDB | None = None,
+	workspace: BuildWorkspace | None = None,
+	preview: PreviewSettings | None = None,
+	premix_audio: bool = True,
+	pools: WorkerPools | None = None
+):
+	"""
+	Creates the MLT project for the given project. If a build workspace is given, the project file is allowed to
+	exist already and is only recreated if the project changed since the last build. If preview settings are
+	given, no voice samples are synthesized, placeholder samples of the estimated duration are used instead.
+	With premix_audio, all audio files are mixed into a single audio track (<project>_audio.wav), otherwise
+	the project contains a producer for every audio file. If worker pools are given (e.g., shared by the
+	scripts of a batch), they are used instead of jobs and are not shut down.
+	"""
 	logger.debug("create_mlt()")
 
 	mlt_project_file_path = Path(path)
-	if mlt_project_file_path.exists():
+	if mlt_project_file_path.exists() and workspace is None:
 		raise Exception(f"file {mlt_project_file_path} already exists!")
 	logger.info(f"mlt project file: {mlt_project_file_path}")
 
@@ -376,31 +622,72 @@ def create_mlt(project: TavoxProject, path: str | os.PathLike, merge_speak_comma
 	if not mlt_project_dir_path.exists():
 		raise Exception(f"directory {mlt_project_dir_path} does not exist!")
 
-	mlt = _MLTProject(
-		project_file_path=mlt_project_file_path,
-		width=project.resolution[0],
-		height=project.resolution[1],
-		fps=25,
-		timeline=project.timeline,
-		pdf_image_dict={},
-		producers_xml="\n",
-		producers_dict={},
-		audio_playlist_xml="\n",
-		video_playlist_xml="\n",
-		total_length=timedelta(0),
-		sample_db=SampleDB(Path.home() / ".tavox_cache")
-	)
-
-	_render_pdfs(project.get_all_pdfs(), mlt)
-
-	_process_slide_events(mlt)
-	_remove_unnecessary_cuts(mlt)
-
-	if merge_speak_commands:
-		_merge_speak_events(mlt)
-
-	_process_speak_events(mlt)
-
-	_create_mlt_producers(mlt)
-	_create_mlt_playlists(mlt)
-	_create_mlt_project_file(mlt)
+	if workspace is not None:
+		# the channel count and the version invalidate premixed tracks written in an earlier format
+		timeline_fingerprint = fingerprint(
+			project.timeline, project.resolution, project.fps, merge_speak_commands, preview, premix_audio, AUDIO_TRACK_CHANNELS, AUDIO_TRACK_VERSION
+		)
+		if workspace.is_project_up_to_date(timeline_fingerprint):
+			logger.info("project did not change since the last build")
+			workspace.reuse_project()
+			return
+
+	# pools created here are shut down at the end of the build, shared pools are left to their owner
+	with WorkerPools(jobs) if pools is None else contextlib.nullcontext(pools) as pools:
+		mlt = _MLTProject(
+			project_file_path=mlt_project_file_path,
+			width=project.resolution[0],
+			height=project.resolution[1],
+			fps=project.fps,
+			timeline=project.timeline,
+			pdf_image_dict={},
+			video_playlist=[],
+			audio_playlist=[],
+			total_length=0,
+			sample_db=sample_db if sample_db is not None else SampleDB(DEFAULT_CACHE_PATH),
+			slide_cache=SlideCache((sample_db.path if sample_db is not None else DEFAULT_CACHE_PATH) / SLIDE_CACHE_DIR_NAME),
+			slide_keys={},
+			workspace=workspace,
+			preview=preview,
+			audio_track=mlt_project_file_path.parent.absolute() / f"{mlt_project_file_path.stem}_audio.wav" if premix_audio else None,
+			pools=pools,
+			jobs=pools.jobs
+		)
+
+		with span("render pdfs"):
+			_render_pdfs(project.get_all_pdfs(), mlt)
+
+		def compact_timeline() -> Iterator[TimelineEvent]:
+			events = _remove_unnecessary_cuts(iter(mlt.timeline))
+			if merge_speak_commands:
+				events = _merge_speak_events(events)
+			return events
+
+		try:
+			if preview is None:
+				with span("synthesize samples"):
+					_synthesize_samples(compact_timeline(), mlt)
+			with span("probe audio files"):
+				audio_lengths = _probe_audio_files(mlt)
+
+			# the stages of the compile chain are lazy and interleaved, hence they are recorded as a single span
+			logger.info("compiling timeline")
+			with span("compile timeline"):
+				events = _process_slide_events(compact_timeline(), mlt)
+				events = _process_audio_events(events, mlt, audio_lengths)
+				_create_mlt_playlists(events, mlt)
+		finally:
+			if sample_db is None:
+				mlt.sample_db.close()
+			else:
+				mlt.sample_db.flush()
+
+	if mlt.audio_track is not None:
+		with span("mix audio track"):
+			_mix_audio_track(mlt)
+	with span("write project file"):
+		_create_mlt_project_file(mlt)
+
+	if workspace is not None:
+		samples = list(dict.fromkeys(str(x) for x, _ in mlt.audio_playlist if x is not None))
+		workspace.record_project(timeline_fingerprint, mlt.slide_keys, samples)
@@ -0,0 +1,516 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+# A minimal PDF reader, which is just capable enough to compute a hash of the content of every page. The hash
+# covers everything that is reachable from the page object (content streams, resources, fonts, images, ...)
+# and the optional content configuration of the document, but not the object numbers, which change whenever
+# anything else in the document changes. The document information dictionary and the file identifier are not
+# reachable from any page, so the timestamps LaTeX writes on every compile do not affect the hashes.
+
+import os
+import re
+import zlib
+import hashlib
+import logging
+
+from pathlib import Path
+
+from .external_tools import pdfinfo_get_page_count
+
+logger = logging.getLogger("tavox")
+
+
+class PDFError(Exception):
+	pass
+
+
+class _Ref:
+	__slots__ = ("num",)
+
+	def __init__(self, num: int):
+		self.num = num
+
+
+class _Name(str):
+	pass
+
+
+class _Stream:
+	__slots__ = ("dict", "data")
+
+	def __init__(self, d: dict, data: bytes):
+		self.dict = d
+		self.data = data
+
+
+_TOKEN_RE = re.compile(rb"[^\s()<>\[\]{}/%\x00]+")
+_WS_RE = re.compile(rb"(?:[ \t\r\n\f\x00]|%[^\r\n]*)*")
+_NUMBER_RE = re.compile(rb"[+-]?(?:\d+\.?\d*|\.\d+)")
+_REF_RE = re.compile(rb"(\d+)\s+R(?![^\s()<>\[\]{}/%])")
+_XREF_SUBSECTION_RE = re.compile(rb"(\d+)\s+(\d+)")
+_OCTAL_RE = re.compile(rb"[0-7]{1,3}")
+_STRING_ESCAPES = {ord("n"): 0x0A, ord("r"): 0x0D, ord("t"): 0x09, ord("b"): 0x08, ord("f"): 0x0C}
+
+
+class _Parser:
+
+	def __init__(self, data: bytes, resolve_length=None):
+		self.data = data
+		self.pos = 0
+		self._resolve_length = resolve_length
+
+	def skip_ws(self):
+		self.pos = _WS_RE.match(self.data, self.pos).end()
+
+	def parse_object(self):
+		self.skip_ws()
+		data = self.data
+		c = data[self.pos:self.pos + 1]
+		if c == b"/":
+			m = _TOKEN_RE.match(data, self.pos + 1)
+			end = m.end() if m else self.pos + 1
+			name = data[self.pos + 1:end]
+			self.pos = end
+			if b"#" in name:
+				name = re.sub(rb"#([0-9a-fA-F]{2})", lambda x: bytes([int(x.group(1), 16)]), name)
+			return _Name(name.decode("latin-1"))
+		if c == b"<":
+			if data[self.pos + 1:self.pos + 2] == b"<":
+				return self._parse_dict()
+			end = data.index(b">", self.pos)
+			hex_data = re.sub(rb"\s", b"", data[self.pos + 1:end])
+			self.pos = end + 1
+			if len(hex_data) % 2 == 1:
+				hex_data += b"0"
+			return bytes.fromhex(hex_data.decode("ascii"))
+		if c == b"(":
+			return self._parse_string()
+		if c == b"[":
+			self.pos += 1
+			result = []
+			while True:
+				self.skip_ws()
+				if data[self.pos:self.pos + 1] == b"]":
+					self.pos += 1
+					return result
+				result.append(self.parse_object())
+		m = _TOKEN_RE.match(data, self.pos)
+		if m is None:
+			raise PDFError(f"unexpected character at offset {self.pos}")
+		token = m.group()
+		self.pos = m.end()
+		if _NUMBER_RE.fullmatch(token):
+			if b"." in token:
+				return float(token)
+			# check for an indirect reference: <num> <gen> R
+			save = self.pos
+			self.skip_ws()
+			m2 = _REF_RE.match(data, self.pos)
+			if m2 is not None:
+				self.pos = m2.end()
+				return _Ref(int(token))
+			self.pos = save
+			return int(token)
+		if token == b"true":
+			return True
+		if token == b"false":
+			return False
+		if token == b"null":
+			return None
+		return token  # operator/keyword
+
+	def _parse_dict(self):
+		self.pos += 2
+		result = {}
+		while True:
+			self.skip_ws()
+			if self.data[self.pos:self.pos + 2] == b">>":
+				self.pos += 2
+				break
+			key = self.parse_object()
+			if not isinstance(key, _Name):
+				raise PDFError(f"invalid dictionary key at offset {self.pos}")
+			result[key] = self.parse_object()
+
+		# check for a stream
+		save = self.pos
+		self.skip_ws()
+		if self.data.startswith(b"stream", self.pos):
+			self.pos += 6
+			if self.data[self.pos:self.pos + 2] == b"\r\n":
+				self.pos += 2
+			elif self.data[self.pos:self.pos + 1] in (b"\r", b"\n"):
+				self.pos += 1
+			length = result.get("Length")
+			if isinstance(length, _Ref) and self._resolve_length is not None:
+				length = self._resolve_length(length)
+			if not isinstance(length, int) or not self.data.startswith(b"endstream", self._after_ws(self.pos + length)):
+				# invalid length, search for the end of the stream
+				length = self.data.index(b"endstream", self.pos) - self.pos
+			stream_data = self.data[self.pos:self.pos + length]
+			self.pos = self.data.index(b"endstream", self.pos + length) + 9
+			return _Stream(result, stream_data)
+		self.pos = save
+		return result
+
+	def _after_ws(self, pos: int) -> int:
+		return _WS_RE.match(self.data, pos).end()
+
+	def _parse_string(self):
+		data = self.data
+		self.pos += 1
+		depth = 1
+		result = bytearray()
+		while True:
+			c = data[self.pos]
+			self.pos += 1
+			if c == 0x5C:  # backslash
+				c = data[self.pos]
+				self.pos += 1
+				if c in _STRING_ESCAPES:
+					result.append(_STRING_ESCAPES[c])
+				elif 0x30 <= c <= 0x37:  # octal character code
+					m = _OCTAL_RE.match(data, self.pos - 1)
+					result.append(int(m.group(), 8) & 0xFF)
+					self.pos = m.end()
+				elif c == 0x0D:  # line continuation
+					if data[self.pos] == 0x0A:
+						self.pos += 1
+				elif c != 0x0A:
+					result.append(c)
+			elif c == 0x28:
+				depth += 1
+				result.append(c)
+			elif c == 0x29:
+				depth -= 1
+				if depth == 0:
+					return bytes(result)
+				result.append(c)
+			else:
+				result.append(c)
+
+
+def _decode_stream(stream: _Stream) -> bytes:
+	filters = stream.dict.get("Filter", [])
+	params = stream.dict.get("DecodeParms", [])
+	if not isinstance(filters, list):
+		filters = [filters]
+	if not isinstance(params, list):
+		params = [params]
+	data = stream.data
+	for i, f in enumerate(filters):
+		if f != "FlateDecode":
+			raise PDFError(f"unsupported filter {f}")
+		data = zlib.decompress(data)
+		p = params[i] if i < len(params) and isinstance(params[i], dict) else {}
+		predictor = p.get("Predictor", 1)
+		if predictor >= 10:
+			data = _png_unpredict(data, p.get("Columns", 1) * p.get("Colors", 1) * p.get("BitsPerComponent", 8) // 8)
+		elif predictor != 1:
+			raise PDFError(f"unsupported predictor {predictor}")
+	return data
+
+
+def _png_unpredict(data: bytes, columns: int) -> bytes:
+	result = bytearray()
+	prev = bytearray(columns)
+	for row_start in range(0, len(data), columns + 1):
+		filter_type = data[row_start]
+		row = bytearray(data[row_start + 1:row_start + 1 + columns])
+		for i in range(len(row)):
+			left = row[i - 1] if i > 0 else 0
+			up = prev[i]
+			if filter_type == 1:
+				row[i] = (row[i] + left) & 0xFF
+			elif filter_type == 2:
+				row[i] = (row[i] + up) & 0xFF
+			elif filter_type == 3:
+				row[i] = (row[i] + ((left + up) >> 1)) & 0xFF
+			elif filter_type == 4:
+				up_left = prev[i - 1] if i > 0 else 0
+				pa, pb, pc = abs(up - up_left), abs(left - up_left), abs(left + up - 2 * up_left)
+				row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else up_left)) & 0xFF
+		result += row
+		prev = row
+	return bytes(result)
+
+
+class PDFDocument:
+
+	def __init__(self, path: str | os.PathLike):
+		self.path = Path(path)
+		with open(self.path, "rb") as f:
+			self._data = f.read()
+		self._xref: dict[int, tuple] = {}
+		self._cache: dict[int, object] = {}
+		self._obj_streams: dict[int, tuple[bytes, list[tuple[int, int]], int]] = {}
+		self.trailer = {}
+		self._read_xref()
+		if "Encrypt" in self.trailer:
+			raise PDFError("encrypted documents are not supported")
+		self.pages = self._collect_pages()
+
+	def _read_xref(self):
+		idx = self._data.rfind(b"startxref")
+		if idx < 0:
+			raise PDFError("startxref not found")
+		offset = int(re.match(rb"startxref\s+(\d+)", self._data[idx:]).group(1))
+		visited = set()
+		while offset is not None and offset not in visited:
+			visited.add(offset)
+			trailer = self._read_xref_section(offset)
+			for k, v in trailer.items():
+				self.trailer.setdefault(k, v)
+			if "XRefStm" in trailer:
+				self._read_xref_section(trailer["XRefStm"])
+			offset = trailer.get("Prev")
+
+	def _read_xref_section(self, offset: int) -> dict:
+		p = _Parser(self._data)
+		p.pos = offset
+		p.skip_ws()
+		if self._data.startswith(b"xref", p.pos):
+			p.pos += 4
+			while True:
+				p.skip_ws()
+				if self._data.startswith(b"trailer", p.pos):
+					p.pos += 7
+					return p.parse_object()
+				m = _XREF_SUBSECTION_RE.match(self._data, p.pos)
+				start, count = int(m.group(1)), int(m.group(2))
+				p.pos = m.end()
+				for i in range(count):
+					p.skip_ws()
+					entry = self._data[p.pos:p.pos + 18]
+					p.pos += 18
+					if entry[17:18] == b"n":
+						self._xref.setdefault(start + i, ("n", int(entry[0:10])))
+					else:
+						self._xref.setdefault(start + i, ("f",))
+
+		# cross-reference stream
+		p.parse_object()  # object number
+		p.parse_object()  # generation
+		p.skip_ws()
+		if not self._data.startswith(b"obj", p.pos):
+			raise PDFError(f"invalid cross-reference section at offset {offset}")
+		p.pos += 3
+		stream = p.parse_object()
+		if not isinstance(stream, _Stream):
+			raise PDFError(f"invalid cross-reference stream at offset {offset}")
+		data = _decode_stream(stream)
+		widths = stream.dict["W"]
+		index = stream.dict.get("Index", [0, stream.dict["Size"]])
+		entry_size = sum(widths)
+		pos = 0
+		for section in range(0, len(index), 2):
+			start, count = index[section], index[section + 1]
+			for i in range(count):
+				fields = []
+				for w in widths:
+					fields.append(int.from_bytes(data[pos:pos + w], "big") if w > 0 else None)
+					pos += w
+				entry_type = fields[0] if fields[0] is not None else 1
+				if entry_type == 1:
+					self._xref.setdefault(start + i, ("n", fields[1]))
+				elif entry_type == 2:
+					self._xref.setdefault(start + i, ("c", fields[1], fields[2]))
+				else:
+					self._xref.setdefault(start + i, ("f",))
+		return stream.dict
+
+	def _parse_at(self, offset: int):
+		p = _Parser(self._data, self._resolve_length)
+		p.pos = offset
+		p.parse_object()
+		p.parse_object()
+		p.skip_ws()
+		if not self._data.startswith(b"obj", p.pos):
+			raise PDFError(f"invalid object at offset {offset}")
+		p.pos += 3
+		return p.parse_object()
+
+	def _resolve_length(self, ref: _Ref):
+		value = self.get_object(ref.num)
+		return value if isinstance(value, int) else None
+
+	def get_object(self, num: int):
+		if num in self._cache:
+			return self._cache[num]
+		entry = self._xref.get(num)
+		if entry is None or entry[0] == "f":
+			value = None
+		elif entry[0] == "n":
+			value = self._parse_at(entry[1])
+		else:
+			value = self._get_compressed_object(entry[1], entry[2])
+		self._cache[num] = value
+		return value
+
+	def _get_compressed_object(self, stream_num: int, index: int):
+		if stream_num not in self._obj_streams:
+			stream = self.get_object(stream_num)
+			data = _decode_stream(stream)
+			p = _Parser(data)
+			offsets = []
+			for _ in range(stream.dict["N"]):
+				num = p.parse_object()
+				off = p.parse_object()
+				offsets.append((num, off))
+			self._obj_streams[stream_num] = (data, offsets, stream.dict["First"])
+		data, offsets, first = self._obj_streams[stream_num]
+		p = _Parser(data, self._resolve_length)
+		p.pos = first + offsets[index][1]
+		return p.parse_object()
+
+	def resolve(self, value):
+		while isinstance(value, _Ref):
+			value = self.get_object(value.num)
+		return value
+
+	def _collect_pages(self) -> list[tuple[int | None, dict, dict]]:
+		# returns (object number, page dictionary, inherited attributes) for every page
+		pages = []
+		inheritable = ("Resources", "MediaBox", "CropBox", "Rotate")
+
+		def walk(node_ref, inherited: dict, visited: set):
+			num = node_ref.num if isinstance(node_ref, _Ref) else None
+			if num is not None:
+				if num in visited:
+					raise PDFError("cycle in page tree")
+				visited.add(num)
+			node = self.resolve(node_ref)
+			inherited = dict(inherited)
+			for key in inheritable:
+				if key in node:
+					inherited[key] = node[key]
+			if node.get("Type") == "Pages" or "Kids" in node:
+				for kid in self.resolve(node["Kids"]):
+					walk(kid, inherited, visited)
+			else:
+				pages.append((num, node, inherited))
+
+		root = self.resolve(self.trailer["Root"])
+		walk(root["Pages"], {}, set())
+		return pages
+
+	def page_hashes(self) -> list[str]:
+		page_numbers = {num: idx for idx, (num, _, _) in enumerate(self.pages) if num is not None}
+		memo: dict[int, bytes] = {}
+		# objects whose digest is being computed, a reference back to one of them is hashed as its distance in this
+		# stack, and a digest that depends on an object further up the stack (i.e., on where a cycle was entered)
+		# is not reused
+		stack: list[int] = []
+		lowest_cycle_target = [len(stack)]
+
+		def digest(value) -> bytes:
+			h = hashlib.sha256()
+			serialize(value, h)
+			return h.digest()
+
+		def digest_object(num: int) -> bytes:
+			if num in memo:
+				return memo[num]
+			depth = len(stack)
+			outer_target = lowest_cycle_target[0]
+			lowest_cycle_target[0] = depth + 1
+			stack.append(num)
+			result = digest(self.get_object(num))
+			stack.pop()
+			if lowest_cycle_target[0] >= depth:
+				# the digest does not depend on any object further up the stack
+				memo[num] = result
+			lowest_cycle_target[0] = min(outer_target, lowest_cycle_target[0])
+			return result
+
+		def serialize(value, h):
+			if isinstance(value, _Ref):
+				if value.num in page_numbers:
+					# references to (other) pages, e.g., in link annotations, only depend on the page index
+					h.update(b"P%d;" % page_numbers[value.num])
+				elif value.num in stack:
+					depth = stack.index(value.num)
+					lowest_cycle_target[0] = min(lowest_cycle_target[0], depth)
+					h.update(b"C%d;" % (len(stack) - depth))
+				else:
+					h.update(b"R")
+					h.update(digest_object(value.num))
+			elif isinstance(value, _Stream):
+				h.update(b"S")
+				serialize({k: v for k, v in value.dict.items() if k != "Length"}, h)
+				h.update(hashlib.sha256(value.data).digest())
+			elif isinstance(value, dict):
+				h.update(b"<<")
+				for k in sorted(value.keys()):
+					h.update(b"/" + k.encode("latin-1") + b" ")
+					serialize(value[k], h)
+				h.update(b">>")
+			elif isinstance(value, list):
+				h.update(b"[")
+				for x in value:
+					serialize(x, h)
+				h.update(b"]")
+			elif isinstance(value, _Name):
+				h.update(b"/" + value.encode("latin-1") + b" ")
+			elif isinstance(value, bytes):
+				h.update(b"(%d)" % len(value))
+				h.update(value)
+			else:
+				h.update(repr(value).encode("ascii") + b" ")
+
+		# the optional content configuration of the catalog decides which layers of a page are visible
+		root = self.resolve(self.trailer["Root"])
+		document_state = digest(root.get("OCProperties"))
+
+		hashes = []
+		for num, page, inherited in self.pages:
+			attributes = dict(inherited)
+			attributes.update({k: v for k, v in page.items() if k != "Parent"})
+			hashes.append(hashlib.sha256(document_state + digest(attributes)).hexdigest())
+		return hashes
+
+
+# values that change on every compile of a document without changing its pages: the timestamps of the document
+# information dictionary, the file identifier in the trailer and their counterparts in (uncompressed) XMP metadata
+_VOLATILE_METADATA_RE = re.compile(
+	rb"/(?:CreationDate|ModDate)\s*\((?:\\.|[^\\)])*\)"
+	rb"|/ID\s*\[[^\]]*\]"
+	rb"|<(xmp:CreateDate|xmp:ModifyDate|xmp:MetadataDate|xmpMM:DocumentID|xmpMM:InstanceID)>[^<]*</\1>"
+)
+
+
+def _masked_file_hash(path: str | os.PathLike) -> str:
+	with open(path, "rb") as f:
+		data = f.read()
+	return hashlib.sha256(_VOLATILE_METADATA_RE.sub(b"", data)).hexdigest()
+
+
+def pdf_page_hashes(path: str | os.PathLike) -> list[str]:
+	"""
+	Returns a content hash for every page of a PDF file. If the document cannot be parsed, the hash of every
+	page is derived from the hash of the whole file, not counting the timestamps and the file identifier.
+	"""
+	try:
+		return PDFDocument(path).page_hashes()
+	except (PDFError, KeyError, ValueError, TypeError, IndexError, AttributeError, RecursionError, zlib.error) as ex:
+		logger.warning(f"unable to determine the page hashes of {path}, falling back to the hash of the file ({ex})")
+
+	file_hash = _masked_file_hash(path)
+	return [hashlib.sha256(f"{file_hash}:{i}".encode("ascii")).hexdigest() for i in range(pdfinfo_get_page_count(path))]
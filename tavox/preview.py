@@ -0,0 +1,81 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import math
+import wave
+import array
+import logging
+
+from pathlib import Path
+from dataclasses import dataclass
+
+from .cache import PlaceholderCache
+
+logger = logging.getLogger("tavox")
+
+_SAMPLE_RATE = 48000
+_TONE_FREQUENCY = 880
+_TONE_LENGTH = 0.1
+_TONE_AMPLITUDE = 0.2
+_MIN_DURATION = 0.3
+
+
+@dataclass(frozen=True)
+class PreviewSettings:
+	"""
+	Settings of preview builds, which use placeholder samples instead of synthesized voice samples. The duration
+	of a placeholder is estimated from the number of words of the text and the speaking rate.
+	"""
+	words_per_minute: float = 150
+	# start every placeholder with a short tone, such that the beginning of a sample is audible
+	tone: bool = False
+
+	def estimate_duration(self, text: str) -> float:
+		return max(_MIN_DURATION, len(text.split()) * 60 / self.words_per_minute)
+
+
+def _write_placeholder_sample(path: str | os.PathLike, duration: float, tone: bool):
+	samples = array.array("h", bytes(2 * round(duration * _SAMPLE_RATE)))
+	if tone:
+		amplitude = _TONE_AMPLITUDE * 32767
+		for i in range(min(len(samples), int(_TONE_LENGTH * _SAMPLE_RATE))):
+			samples[i] = int(amplitude * math.sin(2 * math.pi * _TONE_FREQUENCY * i / _SAMPLE_RATE))
+	with wave.open(str(path), "wb") as f:
+		f.setnchannels(1)
+		f.setsampwidth(2)
+		f.setframerate(_SAMPLE_RATE)
+		f.writeframes(samples.tobytes())
+
+
+def get_placeholder_sample(cache: PlaceholderCache, settings: PreviewSettings, text: str) -> tuple[Path, float]:
+	"""
+	Returns the placeholder sample for the given text and its duration in seconds.
+	"""
+	duration_ms = round(settings.estimate_duration(text) * 1000)
+	key = PlaceholderCache.key(duration_ms, settings.tone)
+	path = cache.get(key)
+	if path is None:
+		logger.debug(f"creating placeholder sample of {duration_ms} ms")
+		with cache.temporary_directory() as tmp_dir:
+			tmp_path = Path(tmp_dir) / "sample.wav"
+			_write_placeholder_sample(tmp_path, duration_ms / 1000, settings.tone)
+			path = cache.put(key, tmp_path)
+	return path, duration_ms / 1000
@@ -0,0 +1,96 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import logging
+
+from typing import Optional
+from dataclasses import dataclass
+
+from .external_tools import ffmpeg_get_encoders
+
+logger = logging.getLogger("tavox")
+
+
+@dataclass(frozen=True)
+class RenderProfile:
+	fps: int
+	resolution: tuple[int, int]
+	# if no video codec is given, libx264 or libopenh264 is used, depending on what is available
+	video_codec: Optional[str] = None
+	audio_codec: str = "flac"
+	preset: Optional[str] = None
+	crf: Optional[int] = None
+	# maximum number of frames between two keyframes
+	gop_length: Optional[int] = None
+	# tune the encoder for still images (libx264 only)
+	still_image: bool = False
+
+	def get_video_codec(self) -> str:
+		if self.video_codec is not None:
+			return self.video_codec
+
+		supported_codecs = ffmpeg_get_encoders()
+		if "libx264" in supported_codecs:
+			return "libx264"
+		elif "libopenh264" in supported_codecs:
+			return "libopenh264"
+		logger.error("No suitable video codec found.")
+		raise RuntimeError("no video encoder found")
+
+	def get_consumer_properties(self, video_codec: str) -> list[str]:
+		"""
+		Returns the properties of the melt avformat consumer for this profile.
+		"""
+		properties = [f"acodec={self.audio_codec}", f"vcodec={video_codec}"]
+		if self.preset is not None:
+			properties.append(f"preset={self.preset}")
+		if self.crf is not None:
+			properties.append(f"crf={self.crf}")
+		if self.gop_length is not None:
+			properties.append(f"g={self.gop_length}")
+		if self.still_image and video_codec == "libx264":
+			properties.append("tune=stillimage")
+		return properties
+
+
+_profile_dict: dict[str, RenderProfile] = {
+	# fast encodes for review iterations
+	"draft": RenderProfile(fps=10, resolution=(1280, 720), preset="veryfast", crf=28, gop_length=100, still_image=True),
+	# the encoder settings of earlier versions, such that existing builds produce the same video
+	"final": RenderProfile(fps=25, resolution=(1920, 1080), preset="slow", crf=16),
+}
+
+DEFAULT_RENDER_PROFILE = "final"
+
+
+def available_render_profiles() -> list[str]:
+	return list(_profile_dict.keys())
+
+
+def get_render_profile(name: str) -> RenderProfile:
+	if name not in _profile_dict:
+		raise ValueError(f"Render profile '{name}' not found! Available profiles: {', '.join(_profile_dict.keys())}")
+	return _profile_dict[name]
+
+
+def register_render_profile(name: str, profile: RenderProfile):
+	if name in _profile_dict:
+		raise ValueError(f"There already is a render profile with the name '{name}'.")
+	_profile_dict[name] = profile
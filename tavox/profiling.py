@@ -0,0 +1,131 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+from typing import Any, Iterator, Optional
+from collections import Counter
+
+_profiler: Optional["Profiler"] = None
+
+
+class Profiler:
+	"""
+	Records spans (build stages, external tool calls, voice synthesis) and counters (cache hits and misses). The
+	recording can be written as a JSON summary and as a trace in the Chrome trace event format, which can be
+	opened in chrome://tracing or https://ui.perfetto.dev.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._start = time.perf_counter_ns()
+		# (name, category, thread id, start, duration, args), times are in nanoseconds since the start
+		self._spans: list[tuple[str, str, int, int, int, dict[str, Any]]] = []
+		self._thread_names: dict[int, str] = {}
+		self._counters: Counter[str] = Counter()
+
+	@contextlib.contextmanager
+	def span(self, name: str, category: str, args: dict[str, Any]) -> Iterator[None]:
+		start = time.perf_counter_ns()
+		try:
+			yield
+		finally:
+			end = time.perf_counter_ns()
+			thread = threading.current_thread()
+			with self._lock:
+				self._spans.append((name, category, thread.native_id, start - self._start, end - start, args))
+				self._thread_names[thread.native_id] = thread.name
+
+	def count(self, name: str, n: int = 1):
+		with self._lock:
+			self._counters[name] += n
+
+	def summary(self) -> dict:
+		"""
+		Returns the number of calls, the total and the maximum duration (in seconds) of the spans, grouped by
+		category and name, and the counters.
+		"""
+		with self._lock:
+			spans = list(self._spans)
+			counters = dict(self._counters)
+		stages: dict[str, dict[str, dict[str, float]]] = {}
+		for name, category, _, _, duration, _ in spans:
+			entry = stages.setdefault(category, {}).setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+			entry["count"] += 1
+			entry["total"] += duration / 1e9
+			entry["max"] = max(entry["max"], duration / 1e9)
+		return {
+			"wall_time": (time.perf_counter_ns() - self._start) / 1e9,
+			"spans": stages,
+			"counters": counters,
+		}
+
+	def write_summary(self, path: str | os.PathLike):
+		with open(path, "w") as f:
+			json.dump(self.summary(), f, indent=2)
+
+	def write_trace(self, path: str | os.PathLike):
+		pid = os.getpid()
+		with self._lock:
+			spans = list(self._spans)
+			thread_names = dict(self._thread_names)
+			counters = dict(self._counters)
+		events: list[dict[str, Any]] = [{"ph": "M", "name": "process_name", "pid": pid, "tid": 0, "args": {"name": "tavox"}}]
+		events += [{"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": name}} for tid, name in thread_names.items()]
+		events += [
+			{"ph": "X", "name": name, "cat": category, "pid": pid, "tid": tid, "ts": start / 1000, "dur": duration / 1000, "args": args}
+			for name, category, tid, start, duration, args in spans
+		]
+		end = max((start + duration for _, _, _, start, duration, _ in spans), default=0)
+		events += [{"ph": "C", "name": name, "pid": pid, "tid": 0, "ts": end / 1000, "args": {"value": value}} for name, value in counters.items()]
+		with open(path, "w") as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+def enable_profiling() -> Profiler:
+	"""
+	Starts a new recording, which is used by all subsequent span and count calls.
+	"""
+	global _profiler
+	_profiler = Profiler()
+	return _profiler
+
+
+def disable_profiling():
+	global _profiler
+	_profiler = None
+
+
+def span(name: str, category: str = "stage", **args) -> contextlib.AbstractContextManager:
+	"""
+	Context manager that records the enclosed code as a span if profiling is enabled.
+	"""
+	if _profiler is None:
+		return contextlib.nullcontext()
+	return _profiler.span(name, category, args)
+
+
+def count(name: str, n: int = 1):
+	if _profiler is not None:
+		_profiler.count(name, n)
@@ -24,6 +24,7 @@ from typing import Optional
 from datetime import timedelta
 
 from .voices import Voice, get_voice
+from .profiles import RenderProfile, get_render_profile, DEFAULT_RENDER_PROFILE
 from .events import TimelineEvent, SpeakEvent, DelayEvent, ShowSlideRangeEvent, ShowSlideEvent, PlayAudioEvent
 
 
@@ -33,13 +34,16 @@ class TavoxProject:
 	_current_voice: Optional[Voice]
 	timeline: list[TimelineEvent]
 	resolution: tuple[int, int]
+	fps: int
+	render_profile: RenderProfile
+	render_profile_name: str
 
 	def __init__(self):
 		self._current_slide = 1
 		self._current_pdf = None
 		self._current_voice = get_voice("default")
 		self.timeline = []
-		self.resolution = (1920, 1080)
+		self.set_render_profile(DEFAULT_RENDER_PROFILE)
 
 	def set_pdf(self, path: str | os.PathLike):
 		abs_path = Path(path).absolute()
@@ -59,6 +63,12 @@ class TavoxProject:
 		else:
 			self._current_voice = voice
 
+	def set_render_profile(self, name: str):
+		self.render_profile = get_render_profile(name)
+		self.render_profile_name = name
+		self.resolution = self.render_profile.resolution
+		self.fps = self.render_profile.fps
+
 	def show_slide_range(self, start_slide: int, end_slide: int):
 		self._check_current_pdf()
 
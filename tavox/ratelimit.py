@@ -0,0 +1,209 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import re
+import time
+import random
+import logging
+import threading
+import email.utils
+
+from typing import Optional, Mapping
+
+logger = logging.getLogger("tavox")
+
+
+class _Budget:
+	"""
+	Token bucket that allows `limit` units per minute.
+	"""
+
+	def __init__(self, limit: float):
+		self.limit = limit
+		self.tokens = limit
+		self.last_refill = time.monotonic()
+
+	def refill(self, now: float):
+		self.tokens = min(self.limit, self.tokens + (now - self.last_refill) * self.limit / 60)
+		self.last_refill = now
+
+	def wait_time(self, amount: float) -> float:
+		# requests larger than the whole budget are allowed once the bucket is full
+		amount = min(amount, self.limit)
+		if self.tokens >= amount:
+			return 0
+		return (amount - self.tokens) * 60 / self.limit
+
+
+def _parse_duration(value: str) -> Optional[float]:
+	# OpenAI-style reset durations, e.g., "1s", "6m0s", "120ms", "1h2m3.5s"
+	parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value.strip())
+	if len(parts) == 0:
+		try:
+			return float(value)
+		except ValueError:
+			return None
+	factors = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+	return sum(float(n) * factors[unit] for n, unit in parts)
+
+
+def _parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+	if "retry-after-ms" in headers:
+		try:
+			return float(headers["retry-after-ms"]) / 1000
+		except ValueError:
+			pass
+	if "retry-after" in headers:
+		value = headers["retry-after"]
+		try:
+			return float(value)
+		except ValueError:
+			pass
+		try:
+			return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+		except (TypeError, ValueError):
+			pass
+	return None
+
+
+class RateLimiter:
+	"""
+	Client-side rate limiter shared by all requests to an endpoint. It enforces requests-per-minute and
+	characters-per-minute budgets, adopts the limits reported by the server via x-ratelimit-* headers and
+	computes exponential backoff delays (with jitter) for rejected requests.
+	"""
+
+	def __init__(
+		self,
+		requests_per_minute: Optional[float] = None,
+		chars_per_minute: Optional[float] = None,
+		*,
+		max_retries: int = 8,
+		base_delay: float = 1.0,
+		max_delay: float = 60.0
+	):
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self._lock = threading.Lock()
+		self._requests = None
+		self._chars = None
+		# budgets set by the user take precedence over the limits reported by the server
+		self._configured = set()
+		self._pause_until = 0.0
+		self.configure(requests_per_minute, chars_per_minute)
+
+	def configure(self, requests_per_minute: Optional[float] = None, chars_per_minute: Optional[float] = None):
+		"""
+		Sets the budgets that are given (i.e., not None). The limiter is shared by all voices of an endpoint, if
+		they configure different budgets, the stricter one is kept.
+		"""
+		with self._lock:
+			for attr, limit, unit in (("_requests", requests_per_minute, "requests"), ("_chars", chars_per_minute, "characters")):
+				if limit is None:
+					continue
+				budget = getattr(self, attr)
+				if attr in self._configured:
+					if limit != budget.limit:
+						logger.warning(f"conflicting rate limits of {budget.limit:g} and {limit:g} {unit} per minute, using the lower one")
+					if limit >= budget.limit:
+						continue
+				if budget is None:
+					setattr(self, attr, _Budget(limit))
+				else:
+					budget.limit = limit
+					budget.tokens = min(budget.tokens, limit)
+				self._configured.add(attr)
+
+	def acquire(self, chars: int = 0):
+		"""
+		Blocks until a request with the given number of characters fits into the budgets.
+		"""
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				delay = self._pause_until - now
+				for budget, amount in ((self._requests, 1), (self._chars, chars)):
+					if budget is not None:
+						budget.refill(now)
+						delay = max(delay, budget.wait_time(amount))
+				if delay <= 0:
+					for budget, amount in ((self._requests, 1), (self._chars, chars)):
+						if budget is not None:
+							budget.tokens -= min(amount, budget.limit)
+					return
+			time.sleep(delay)
+
+	def update_from_headers(self, headers: Mapping[str, str]):
+		"""
+		Synchronizes the budgets with the rate limit headers of a server response.
+		"""
+		headers = {k.lower(): v for k, v in headers.items()}
+		with self._lock:
+			now = time.monotonic()
+			# TTS endpoints report their character budget as tokens
+			for kind, attr in (("requests", "_requests"), ("tokens", "_chars")):
+				try:
+					limit = float(headers[f"x-ratelimit-limit-{kind}"])
+				except (KeyError, ValueError):
+					continue
+				budget = getattr(self, attr)
+				if budget is None or (attr not in self._configured and budget.limit != limit):
+					budget = _Budget(limit)
+					setattr(self, attr, budget)
+				budget.refill(now)
+				try:
+					budget.tokens = min(budget.tokens, float(headers[f"x-ratelimit-remaining-{kind}"]))
+				except (KeyError, ValueError):
+					pass
+				if budget.tokens < 1:
+					reset = _parse_duration(headers.get(f"x-ratelimit-reset-{kind}", ""))
+					if reset is not None:
+						self._pause_until = max(self._pause_until, now + reset)
+
+	def backoff(self, attempt: int, headers: Optional[Mapping[str, str]] = None) -> float:
+		"""
+		Registers a rejected request and returns the time to wait before the next attempt. The pause applies
+		to all users of this limiter, i.e., subsequent calls to acquire block until it is over.
+		"""
+		retry_after = None
+		if headers is not None:
+			headers = {k.lower(): v for k, v in headers.items()}
+			retry_after = _parse_retry_after(headers)
+		if retry_after is None:
+			# exponential backoff with "full jitter"
+			retry_after = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+		else:
+			retry_after += random.uniform(0, self.base_delay)
+
+		with self._lock:
+			self._pause_until = max(self._pause_until, time.monotonic() + retry_after)
+		return retry_after
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(endpoint: str) -> RateLimiter:
+	with _rate_limiters_lock:
+		if endpoint not in _rate_limiters:
+			_rate_limiters[endpoint] = RateLimiter()
+		return _rate_limiters[endpoint]
@@ -0,0 +1,391 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import json
+import math
+import wave
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+
+from typing import Callable
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+from .cache import ChunkCache
+from .external_tools import run_melt, run_ffmpeg, Cancellation
+from .audio import write_audio_track, AUDIO_TRACK_SAMPLE_RATE, AUDIO_TRACK_CHANNELS
+
+logger = logging.getLogger("tavox")
+
+# segments shorter than this (in seconds) are not worth the overhead of an additional melt process
+_MIN_SEGMENT_LENGTH = 30
+
+
+def _parse_frames(value: str, fps: int) -> int:
+	# tavox writes the video entries as <seconds>:<frames> and the audio entries as number of frames
+	if ":" in value:
+		seconds, frames = value.split(":")
+		return int(seconds) * fps + int(frames)
+	return int(value)
+
+
+def _parse_playlist(root: ET.Element, playlist_id: str, fps: int, resources: dict[str, str]) -> list[tuple[int, int, str | None]]:
+	# returns (first frame, number of frames, resource) for every entry and blank
+	items = []
+	position = 0
+	for child in root.find(f"playlist[@id='{playlist_id}']"):
+		if child.tag == "entry":
+			length = _parse_frames(child.get("out"), fps) + 1
+			items.append((position, length, resources[child.get("producer")]))
+		elif child.tag == "blank":
+			length = int(child.get("length"))
+			items.append((position, length, None))
+		else:
+			continue
+		position += length
+	return items
+
+
+def _parse_project(mlt_project_file: str | os.PathLike) -> tuple[ET.Element, int, dict[str, str]]:
+	root = ET.parse(mlt_project_file).getroot()
+	fps = int(root.find("profile").get("frame_rate_num"))
+	resources = {}
+	for producer in root.iter("producer"):
+		resource = producer.find("property[@name='resource']")
+		resources[producer.get("id")] = resource.text if resource is not None else None
+	return root, fps, resources
+
+
+def get_slide_boundaries(mlt_project_file: str | os.PathLike) -> tuple[int, int, list[int]]:
+	"""
+	Returns the frame rate and the total number of frames of an MLT project created by tavox, as well as the
+	frames at which the video track switches to a different slide.
+	"""
+	root, fps, resources = _parse_project(mlt_project_file)
+	video = _parse_playlist(root, "playlist0", fps, resources)
+	boundaries = [start + length for start, length, _ in video]
+	return fps, boundaries[-1] if len(boundaries) > 0 else 0, boundaries[:-1]
+
+
+def _audio_samples_hash(audio_file: str, offset: int, length: int, fps: int) -> str | None:
+	# hash of the samples of the given frames of a PCM WAV file (None for other formats)
+	try:
+		with wave.open(audio_file, "rb") as w:
+			if w.getcomptype() != "NONE":
+				return None
+			rate = w.getframerate()
+			first = offset * rate // fps
+			w.setpos(min(first, w.getnframes()))
+			data = w.readframes((offset + length) * rate // fps - first)
+			params = [w.getnchannels(), w.getsampwidth(), rate]
+	except (wave.Error, EOFError, OSError):
+		return None
+	return hashlib.sha256(json.dumps(params).encode("ascii") + data).hexdigest()
+
+
+def get_chunks(mlt_project_file: str | os.PathLike, consumer_properties: list[str], extension: str) -> list[tuple[int, int, str]]:
+	"""
+	Splits an MLT project created by tavox into chunks that show a single slide. Returns the first and last
+	frame and the cache key of every chunk. The key covers the content of the image and the audio samples
+	(including the offsets into the samples), the duration, the profile and the encoder settings. Of PCM WAV
+	files only the samples played during the chunk are hashed, such that the chunks of a premixed audio track
+	are only invalidated where the track changed.
+	"""
+	root, fps, resources = _parse_project(mlt_project_file)
+	video = _parse_playlist(root, "playlist0", fps, resources)
+	audio = _parse_playlist(root, "playlist1", fps, resources)
+
+	file_hashes = {}
+	def file_hash(path: str) -> str:
+		if path not in file_hashes:
+			with open(path, "rb") as f:
+				file_hashes[path] = hashlib.file_digest(f, "sha256").hexdigest()
+		return file_hashes[path]
+
+	settings = [dict(root.find("profile").attrib), consumer_properties, extension]
+	chunks = []
+	for start, length, image in video:
+		end = start + length
+		audio_pieces = []
+		for audio_start, audio_length, resource in audio:
+			first, last = max(start, audio_start), min(end, audio_start + audio_length)
+			if resource is None or first >= last:
+				continue
+			samples_hash = _audio_samples_hash(resource, first - audio_start, last - first, fps)
+			if samples_hash is not None:
+				audio_pieces.append([samples_hash, last - first, first - start])
+			else:
+				audio_pieces.append([file_hash(resource), first - audio_start, last - first, first - start])
+		key_data = json.dumps([settings, file_hash(image), length, audio_pieces], sort_keys=True)
+		chunks.append((start, end - 1, hashlib.sha256(key_data.encode("utf-8")).hexdigest()))
+	return chunks
+
+
+def split_into_segments(total_length: int, boundaries: list[int], num_segments: int) -> list[tuple[int, int]]:
+	"""
+	Splits the frames [0, total_length) into (at most) the given number of segments of similar length, which
+	start and end at the given boundaries. The segments are returned as (first frame, last frame).
+	"""
+	cuts = []
+	for i in range(1, num_segments):
+		target = total_length * i / num_segments
+		candidates = [x for x in boundaries if len(cuts) == 0 or x > cuts[-1]]
+		if len(candidates) == 0:
+			break
+		cut = min(candidates, key=lambda x: abs(x - target))
+		if cut not in cuts:
+			cuts.append(cut)
+
+	starts = [0] + cuts
+	ends = cuts + [total_length]
+	return [(start, end - 1) for start, end in zip(starts, ends) if end > start]
+
+
+def get_num_segments(total_length: int, fps: int, num_cores: int | None = None) -> int:
+	"""
+	Chooses the number of segments for the given video length based on the number of CPU cores.
+	"""
+	num_cores = num_cores if num_cores is not None else (os.cpu_count() or 1)
+	return max(1, min(num_cores, math.floor(total_length / fps / _MIN_SEGMENT_LENGTH)))
+
+
+class _Progress:
+	"""
+	Sums up the frames rendered by concurrent melt processes and reports the total to a callback.
+	"""
+
+	def __init__(self, total: int, callback: Callable[[int, int], None] | None):
+		self._total = total
+		self._callback = callback
+		self._lock = threading.Lock()
+		self._frames: dict[object, int] = {}
+		self._done = 0
+
+	def update(self, task: object, length: int, frame: int):
+		if self._callback is None:
+			return
+		with self._lock:
+			frames = min(max(frame, 0), length)
+			self._done += frames - self._frames.get(task, 0)
+			self._frames[task] = frames
+			done = self._done
+		self._callback(done, self._total)
+
+	def tracker(self, task: object, length: int) -> Callable[[int], None] | None:
+		# melt reports the frames relative to the in point
+		return None if self._callback is None else lambda frame: self.update(task, length, frame)
+
+
+def _run_melt_tasks(render: Callable, tasks: list, num_workers: int, cancellation: Cancellation):
+	with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="tavox_melt") as executor:
+		futures = [executor.submit(render, task) for task in tasks]
+		try:
+			done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+			for future in done:
+				future.result()
+		except BaseException as ex:
+			# terminate the other melt processes if one of them failed or the rendering was interrupted
+			cancellation.cancel()
+			raise ex
+
+
+def render_segmented(
+	mlt_project_file: str | os.PathLike,
+	out_path: str | os.PathLike,
+	consumer_properties: list[str],
+	num_segments: int | None = None,
+	work_dir: str | os.PathLike | None = None,
+	progress: Callable[[int, int], None] | None = None,
+	cancellation: Cancellation | None = None
+):
+	"""
+	Renders an MLT project by splitting it at slide boundaries into segments, which are rendered by
+	concurrent melt processes and then concatenated without re-encoding. Since every segment is encoded
+	independently, each of them starts with a keyframe, such that the joins are seamless. The progress
+	callback is called with the number of rendered frames and the total number of frames.
+	"""
+	fps, total_length, boundaries = get_slide_boundaries(mlt_project_file)
+	if num_segments is None:
+		num_segments = get_num_segments(total_length, fps)
+	segments = split_into_segments(total_length, boundaries, num_segments)
+	cancellation = cancellation if cancellation is not None else Cancellation()
+	tracker = _Progress(total_length, progress)
+
+	if len(segments) <= 1:
+		run_melt(
+			["-progress", "-verbose", f"{mlt_project_file}", "-consumer", f"avformat:{out_path}"] + consumer_properties,
+			progress=tracker.tracker(0, total_length),
+			cancellation=cancellation
+		)
+		tracker.update(0, total_length, total_length)
+		return
+
+	logger.info(f"rendering {len(segments)} segment(s) in parallel")
+	extension = Path(out_path).suffix
+	with tempfile.TemporaryDirectory(prefix=".tavox_", dir=work_dir if work_dir is not None else Path(out_path).absolute().parent) as tmp_dir:
+		segment_files = [Path(tmp_dir) / f"segment{i}{extension}" for i in range(len(segments))]
+
+		def render(idx: int):
+			first, last = segments[idx]
+			logger.debug(f"rendering segment {idx} (frames {first} to {last})")
+			run_melt([
+				"-progress", f"{mlt_project_file}", f"in={first}", f"out={last}",
+				"-consumer", f"avformat:{segment_files[idx]}"
+			] + consumer_properties, progress=tracker.tracker(idx, last - first + 1), cancellation=cancellation)
+			tracker.update(idx, last - first + 1, last - first + 1)
+
+		_run_melt_tasks(render, list(range(len(segments))), len(segments), cancellation)
+
+		concatenate_videos(segment_files, out_path, tmp_dir)
+
+
+def render_chunked(
+	mlt_project_file: str | os.PathLike,
+	out_path: str | os.PathLike,
+	consumer_properties: list[str],
+	chunk_cache: ChunkCache,
+	num_workers: int | None = None,
+	progress: Callable[[int, int], None] | None = None,
+	cancellation: Cancellation | None = None
+):
+	"""
+	Renders an MLT project by encoding every slide into a separate chunk, which is stored in the chunk cache.
+	Chunks whose slide did not change since an earlier build are reused. The chunks are concatenated without
+	re-encoding. The progress callback is called with the number of encoded frames and the total number of
+	frames of the missing chunks.
+	"""
+	chunks = get_chunks(mlt_project_file, consumer_properties, Path(out_path).suffix)
+	missing = {key: (first, last) for first, last, key in chunks if chunk_cache.get(key) is None}
+	logger.info(f"encoding {len(missing)} of {len(chunks)} video chunk(s)")
+	cancellation = cancellation if cancellation is not None else Cancellation()
+	tracker = _Progress(sum(last - first + 1 for first, last in missing.values()), progress)
+
+	with chunk_cache.temporary_directory() as tmp_dir:
+
+		def render(key: str):
+			first, last = missing[key]
+			chunk_file = Path(tmp_dir) / f"{key}{Path(out_path).suffix}"
+			logger.debug(f"encoding chunk {key} (frames {first} to {last})")
+			run_melt([
+				"-progress", f"{mlt_project_file}", f"in={first}", f"out={last}",
+				"-consumer", f"avformat:{chunk_file}"
+			] + consumer_properties, progress=tracker.tracker(key, last - first + 1), cancellation=cancellation)
+			tracker.update(key, last - first + 1, last - first + 1)
+			chunk_cache.put(key, chunk_file)
+
+		if len(missing) > 0:
+			num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+			_run_melt_tasks(render, list(missing.keys()), num_workers, cancellation)
+
+		concatenate_videos([chunk_cache.get(key) for _, _, key in chunks], out_path, tmp_dir)
+
+
+def _ffmpeg_encoder_arguments(consumer_properties: list[str]) -> list[str]:
+	# translate the properties of the melt avformat consumer into ffmpeg options
+	arguments = []
+	for prop in consumer_properties:
+		key, value = prop.split("=", 1)
+		if key == "vcodec":
+			arguments += ["-c:v", value]
+		elif key == "acodec":
+			arguments += ["-c:a", value]
+		else:
+			arguments += [f"-{key}", value]
+	return arguments
+
+
+def render_ffmpeg(mlt_project_file: str | os.PathLike, out_path: str | os.PathLike, consumer_properties: list[str], work_dir: str | os.PathLike | None = None, num_workers: int | None = None):
+	"""
+	Renders an MLT project created by tavox directly with ffmpeg, without melt. The slides are fed to ffmpeg
+	using the concat demuxer with the exact duration of every slide, the audio track is assembled from the
+	samples beforehand. Since every slide is decoded only once, this is much faster than rendering the
+	project with melt.
+	"""
+	root, fps, resources = _parse_project(mlt_project_file)
+	profile = root.find("profile")
+	width, height = int(profile.get("width")), int(profile.get("height"))
+	video = _parse_playlist(root, "playlist0", fps, resources)
+	audio = _parse_playlist(root, "playlist1", fps, resources)
+	total_length = sum(x[1] for x in video)
+	num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+
+	with tempfile.TemporaryDirectory(prefix=".tavox_", dir=work_dir if work_dir is not None else Path(out_path).absolute().parent) as tmp_dir:
+		list_file = Path(tmp_dir) / "slides.txt"
+		with open(list_file, "w") as f:
+			f.write("ffconcat version 1.0\n")
+			for _, length, image in video:
+				f.write(f"file '{_escape_concat_path(image)}'\nduration {length / fps}\n")
+			# the duration of the last entry is only respected if the file is repeated
+			if len(video) > 0:
+				f.write(f"file '{_escape_concat_path(video[-1][2])}'\n")
+
+		audio_file = Path(tmp_dir) / "audio.wav"
+		write_audio_track(audio, total_length, fps, audio_file, tmp_dir, num_workers)
+
+		logger.info(f"encoding {len(video)} slide(s) using ffmpeg")
+		run_ffmpeg([
+			"-f", "concat", "-safe", "0", "-i", f"{list_file}",
+			"-i", f"{audio_file}",
+			"-map", "0:v", "-map", "1:a",
+			# the fps filter places the slide changes at the exact frames (unlike -r)
+			"-vf", f"fps={fps},scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,format=yuv420p",
+			"-ac", f"{AUDIO_TRACK_CHANNELS}", "-ar", f"{AUDIO_TRACK_SAMPLE_RATE}",
+			"-frames:v", f"{total_length}",
+		] + _ffmpeg_encoder_arguments(consumer_properties) + [f"{out_path}"])
+
+
+def render_audio(mlt_project_file: str | os.PathLike, out_path: str | os.PathLike, work_dir: str | os.PathLike | None = None, num_workers: int | None = None):
+	"""
+	Renders only the audio track of an MLT project created by tavox (e.g., for a podcast). The format of the
+	output file is determined by its extension, WAV files are written directly, other formats are encoded
+	with ffmpeg.
+	"""
+	root, fps, resources = _parse_project(mlt_project_file)
+	video = _parse_playlist(root, "playlist0", fps, resources)
+	audio = _parse_playlist(root, "playlist1", fps, resources)
+	total_length = sum(x[1] for x in video)
+
+	with tempfile.TemporaryDirectory(prefix=".tavox_", dir=work_dir if work_dir is not None else Path(out_path).absolute().parent) as tmp_dir:
+		audio_file = Path(tmp_dir) / "audio.wav"
+		write_audio_track(audio, total_length, fps, audio_file, tmp_dir, num_workers)
+		if Path(out_path).suffix.lower() == ".wav":
+			shutil.move(audio_file, out_path)
+		else:
+			run_ffmpeg(["-i", f"{audio_file}", f"{out_path}"])
+
+
+def _escape_concat_path(path: str | os.PathLike) -> str:
+	return str(Path(path).absolute()).replace("'", "'\\''")
+
+
+def concatenate_videos(files: list[Path], out_path: str | os.PathLike, tmp_dir: str | os.PathLike):
+	"""
+	Concatenates video files with the same encoding using the concat demuxer of ffmpeg (stream copy).
+	"""
+	list_file = Path(tmp_dir) / "segments.txt"
+	with open(list_file, "w") as f:
+		for file in files:
+			f.write(f"file '{_escape_concat_path(file)}'\n")
+	run_ffmpeg(["-f", "concat", "-safe", "0", "-i", f"{list_file}", "-map", "0", "-c", "copy", f"{out_path}"])
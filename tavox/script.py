@@ -32,6 +32,10 @@ def set_voice(voice):
 	_project.set_voice(voice)
 
 
+def set_render_profile(name: str):
+	_project.set_render_profile(name)
+
+
 def set_pdf(path: str | os.PathLike):
 	_project.set_pdf(path)
 
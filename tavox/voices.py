@@ -21,16 +21,25 @@
 import subprocess
 import textwrap
 import os
+import sys
+import shutil
+import socket
+import atexit
 import logging
 import hashlib
 import base64
 import json
-import time
+import tempfile
+import threading
 
 from abc import ABC, abstractmethod
 from typing import Optional
+from pathlib import Path
 from urllib.parse import urlparse
 
+from .coqui_worker import default_socket_path
+from .ratelimit import get_rate_limiter
+
 logger = logging.getLogger("tavox")
 
 
@@ -49,17 +58,214 @@ class Voice(ABC):
 	def info(self) -> str | None:
 		return None
 
+	@property
+	def max_concurrency(self) -> int | None:
+		# maximum number of samples this voice may synthesize at the same time (None: no voice-specific limit)
+		return None
+
+	@property
+	def supports_batch(self) -> bool:
+		# scheduling hint: texts are only grouped into batches for voices whose generate_samples is more
+		# efficient than one generate_sample call per text
+		return False
+
+	def generate_samples(self, texts: list[str], dir_path: str | os.PathLike):
+		"""
+		Batch version of generate_sample. The sample of the i-th text must be written to a file named
+		{i}.<extension> (e.g., 0.wav, 1.wav, ...) in dir_path. By default, generate_sample is called for every
+		text.
+		"""
+		for i, text in enumerate(texts):
+			with tempfile.TemporaryDirectory(prefix=".tavox_", dir=dir_path) as sample_dir:
+				self.generate_sample(text, sample_dir)
+				files = list(Path(sample_dir).iterdir())
+				if len(files) != 1:
+					raise Exception("The Voice instance created an unexpected number of files.")
+				os.replace(files[0], Path(dir_path) / f"{i}{files[0].suffix}")
+
+
+class _WorkerLost(RuntimeError):
+	# the worker process terminated (e.g., killed by the OOM killer) or the connection to the daemon broke
+	pass
+
+
+class _CoquiWorker:
+
+	def __init__(self, model: str, python: Optional[str]):
+		self._model = model
+		self._python = python
+		self._process = None
+		self._socket = None
+		self._req_file = None
+		self._resp_file = None
+
+	def _find_python(self) -> str:
+		if self._python is not None:
+			return self._python
+		# use the interpreter of the tts command, Coqui TTS is often installed for a different Python version
+		tts_bin = shutil.which("tts")
+		if tts_bin is not None:
+			with open(tts_bin, "rb") as f:
+				shebang = f.readline().decode("utf-8", errors="replace").strip()
+			if shebang.startswith("#!") and "python" in shebang:
+				interpreter = shebang[2:].split()
+				if Path(interpreter[0]).name == "env":
+					return shutil.which(interpreter[1])
+				return interpreter[0]
+		return sys.executable
+
+	def _read_response(self) -> dict:
+		try:
+			line = self._resp_file.readline()
+		except OSError as ex:
+			raise _WorkerLost(f"[coquiTTS] lost connection to worker: {ex}") from ex
+		if line == "":
+			raise _WorkerLost("[coquiTTS] worker terminated unexpectedly")
+		return json.loads(line)
+
+	def _connect_to_daemon(self) -> bool:
+		socket_path = default_socket_path(self._model)
+		if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+			return False
+		logger.debug(f"[coquiTTS] connecting to worker daemon at {socket_path}")
+		try:
+			self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self._socket.connect(socket_path)
+		except OSError as ex:
+			logger.debug(f"[coquiTTS] unable to connect to worker daemon: {ex}")
+			self._socket.close()
+			self._socket = None
+			return False
+		self._req_file = self._socket.makefile("w", encoding="utf-8")
+		self._resp_file = self._socket.makefile("r", encoding="utf-8")
+		return True
+
+	def start(self):
+		if not self._connect_to_daemon():
+			python = self._find_python()
+			logger.info(f"[coquiTTS] starting worker for {self._model}")
+			logger.debug(f"[coquiTTS] worker interpreter: {python}")
+			self._process = subprocess.Popen(
+				[python, str(Path(__file__).parent / "coqui_worker.py"), "--model", self._model],
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+				stderr=None if logger.getEffectiveLevel() <= logging.DEBUG else subprocess.DEVNULL,
+				text=True,
+				encoding="utf-8"
+			)
+			self._req_file = self._process.stdin
+			self._resp_file = self._process.stdout
+
+		response = self._read_response()
+		if not response.get("ready", False):
+			self.close()
+			raise RuntimeError(f"[coquiTTS] worker failed to load model: {response.get('error')}")
+
+	def _request(self, request: dict):
+		try:
+			self._req_file.write(json.dumps(request) + "\n")
+			self._req_file.flush()
+		except OSError as ex:
+			# BrokenPipeError or ConnectionResetError
+			raise _WorkerLost(f"[coquiTTS] lost connection to worker: {ex}") from ex
+		response = self._read_response()
+		if not response["ok"]:
+			raise RuntimeError(f"[coquiTTS] Unable to generate TTS sample: {response['error']}")
+
+	def synthesize(self, text: str, out_path: str | os.PathLike):
+		self._request({"text": text, "out_path": str(Path(out_path).absolute())})
+
+	def synthesize_batch(self, texts: list[str], out_paths: list[str | os.PathLike]):
+		self._request({"batch": [{"text": t, "out_path": str(Path(p).absolute())} for t, p in zip(texts, out_paths)]})
+
+	def close(self):
+		if self._socket is not None:
+			self._socket.close()
+			self._socket = None
+		if self._process is not None:
+			try:
+				self._process.stdin.close()
+			except OSError:
+				# the worker already terminated, flushing the pipe failed
+				pass
+			try:
+				self._process.wait(timeout=10)
+			except subprocess.TimeoutExpired:
+				self._process.kill()
+			self._process = None
+
 
 class CoquiTTS(Voice):
 
-	def __init__(self, model: str):
+	def __init__(self, model: str, *, max_concurrency: int = 1, worker: bool = True, python: Optional[str] = None):
 		self._voice_id = f"coquiTTS/{model}"
 		self._model = model
+		self._max_concurrency = max_concurrency
+		# the worker keeps the model loaded, the tts command is used as a fallback if it cannot be started
+		self._use_worker = worker
+		self._python = python
+		self._worker = None
+		self._worker_lock = threading.Lock()
+		self._close_at_exit = False
+
+	def _get_worker(self) -> Optional[_CoquiWorker]:
+		if self._worker is None and self._use_worker:
+			worker = _CoquiWorker(self._model, self._python)
+			try:
+				worker.start()
+			except Exception as ex:
+				logger.warning(f"[coquiTTS] Unable to start worker, falling back to the tts command: {ex}")
+				self._use_worker = False
+				return None
+			self._worker = worker
+			if not self._close_at_exit:
+				atexit.register(self.close)
+				self._close_at_exit = True
+		return self._worker
+
+	def _synthesize_on_worker(self, synthesize) -> bool:
+		"""
+		Calls synthesize with the worker. If the worker terminates in the meantime, the request is retried once
+		with a new worker, if that fails as well, the worker is no longer used. Returns False if the tts command
+		has to be used instead.
+		"""
+		with self._worker_lock:
+			for attempt in range(2):
+				worker = self._get_worker()
+				if worker is None:
+					return False
+				try:
+					synthesize(worker)
+					return True
+				except _WorkerLost as ex:
+					worker.close()
+					self._worker = None
+					if attempt == 0:
+						logger.warning(f"{ex}, restarting it")
+			logger.warning("[coquiTTS] worker terminated again, falling back to the tts command")
+			self._use_worker = False
+			return False
 
 	def generate_sample(self, text: str, dir_path: str | os.PathLike):
 		logger.info(f"[coquiTTS] generating: {textwrap.shorten(text, 40)}")
+		if self._synthesize_on_worker(lambda worker: worker.synthesize(text, f"{dir_path}/sample.wav")):
+			return
+
+		self._run_tts_command(text, f"{dir_path}/sample.wav")
+
+	def generate_samples(self, texts: list[str], dir_path: str | os.PathLike):
+		logger.info(f"[coquiTTS] generating batch of {len(texts)} sample(s)")
+		out_paths = [f"{dir_path}/{i}.wav" for i in range(len(texts))]
+		if self._synthesize_on_worker(lambda worker: worker.synthesize_batch(texts, out_paths)):
+			return
+
+		for text, out_path in zip(texts, out_paths):
+			logger.info(f"[coquiTTS] generating: {textwrap.shorten(text, 40)}")
+			self._run_tts_command(text, out_path)
+
+	def _run_tts_command(self, text: str, out_path: str):
 		r = subprocess.run(
-			f"""tts --text "{text}" --model_name "{self._model}" --out_path={dir_path}/sample.wav""",
+			f"""tts --text "{text}" --model_name "{self._model}" --out_path={out_path}""",
 			stdout=subprocess.PIPE,
 			stderr=subprocess.PIPE,
 			shell=True
@@ -67,18 +273,44 @@ class CoquiTTS(Voice):
 		if r.returncode != 0:
 			raise RuntimeError(f"[coquiTTS] Unable to generate TTS sample: {r.stderr}")
 
+	def close(self):
+		with self._worker_lock:
+			if self._worker is not None:
+				self._worker.close()
+				self._worker = None
+
 	@property
 	def voice_id(self) -> str:
 		return self._voice_id
 
+	@property
+	def max_concurrency(self) -> int | None:
+		return self._max_concurrency
+
+	@property
+	def supports_batch(self) -> bool:
+		return True
+
 
 class OpenAIAPIVoice(Voice):
 
-	def __init__(self, voice: str, model: str, *, instructions: Optional[str] = None, base_url: Optional[str] = None, api_key: Optional[str] = None):
+	def __init__(
+		self,
+		voice: str,
+		model: str,
+		*,
+		instructions: Optional[str] = None,
+		base_url: Optional[str] = None,
+		api_key: Optional[str] = None,
+		max_concurrency: Optional[int] = None,
+		requests_per_minute: Optional[float] = None,
+		chars_per_minute: Optional[float] = None
+	):
 		self._voice = voice
 		self._model = model
 		self._base_url = base_url
 		self._api_key = api_key
+		self._max_concurrency = max_concurrency
 
 		instructions = instructions.strip() if instructions is not None else ""
 		self._instructions = instructions
@@ -101,31 +333,48 @@ class OpenAIAPIVoice(Voice):
 		self._voice_id = f"{voice_id_base}/{model}/{voice}{voice_suffix}"
 		self._client = None
 
+		# all voices using the same model of a service share their rate limits
+		self._rate_limiter = get_rate_limiter(f"{voice_id_base}/{model}")
+		self._rate_limiter.configure(requests_per_minute, chars_per_minute)
+		self._client_lock = threading.Lock()
+
 	def _get_client(self):
 		from openai import OpenAI
-		if self._client is None:
-			if self._base_url is None:
-				# use the "offical" OpenAI API
-				if self._api_key is not None:
-					api_key = os.environ["OPENAI_API_KEY"]
+		# samples may be synthesized concurrently, make sure only one client is created
+		with self._client_lock:
+			if self._client is None:
+				if self._base_url is None:
+					# use the "offical" OpenAI API
+					if self._api_key is not None:
+						api_key = os.environ["OPENAI_API_KEY"]
+					else:
+						api_key = self._api_key
+					self._client = OpenAI(api_key=api_key, max_retries=0)
 				else:
-					api_key = self._api_key
-				self._client = OpenAI(api_key=api_key)
-			else:
-				self._client = OpenAI(api_key=self._api_key, base_url=self._base_url)
+					self._client = OpenAI(api_key=self._api_key, base_url=self._base_url, max_retries=0)
 		return self._client
 
 	def generate_sample(self, text: str, dir_path: str | os.PathLike):
-		from openai import RateLimitError
+		from openai import RateLimitError, APIConnectionError, InternalServerError
+		attempt = 0
 		while True:
+			self._rate_limiter.acquire(len(text))
 			try:
 				logger.info(f"[{self.service_name}] generating: {textwrap.shorten(text, 40)}")
-				r = self._get_client().audio.speech.create(model=self._model, voice=self._voice, instructions=self._instructions, response_format="wav", input=text)
+				r = self._get_client().audio.speech.with_raw_response.create(model=self._model, voice=self._voice, instructions=self._instructions, response_format="wav", input=text)
+				self._rate_limiter.update_from_headers(r.headers)
 				break
-			except RateLimitError as e:
-				logger.warning(f"[{self.service_name}] Rate limit exceeded, waiting 10 seconds...")
-				time.sleep(10)
-		r.write_to_file(f"{dir_path}/sample.wav")
+			except (RateLimitError, APIConnectionError, InternalServerError) as e:
+				if attempt >= self._rate_limiter.max_retries:
+					raise e
+				response = getattr(e, "response", None)
+				delay = self._rate_limiter.backoff(attempt, response.headers if response is not None else None)
+				attempt += 1
+				if isinstance(e, RateLimitError):
+					logger.warning(f"[{self.service_name}] Rate limit exceeded, retrying in {delay:.1f} seconds...")
+				else:
+					logger.warning(f"[{self.service_name}] Request failed ({e}), retrying in {delay:.1f} seconds...")
+		r.parse().write_to_file(f"{dir_path}/sample.wav")
 
 	@property
 	def voice_id(self) -> str:
@@ -137,6 +386,10 @@ class OpenAIAPIVoice(Voice):
 			return None
 		return json.dumps({"instructions": self._instructions})
 
+	@property
+	def max_concurrency(self) -> int | None:
+		return self._max_concurrency
+
 
 _voice_dict: dict[str, str | Voice] = {}
 
@@ -0,0 +1,220 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import dataclasses
+
+from pathlib import Path
+from datetime import timedelta
+
+from .voices import Voice
+from .cache import _disk_usage, WORKSPACE_DIR_NAME
+
+logger = logging.getLogger("tavox")
+
+_MANIFEST_FILE_NAME = "manifest.json"
+# version 2: page hashes are derived from the hash of the PDF file
+# version 3: page hashes are derived from the page content again, including the optional content configuration
+_MANIFEST_VERSION = 3
+
+
+def _file_state(path: str | os.PathLike) -> list[int] | None:
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return [stat.st_mtime_ns, stat.st_size]
+
+
+def _file_hash(path: str | os.PathLike) -> str | None:
+	try:
+		with open(path, "rb") as f:
+			return hashlib.file_digest(f, "sha256").hexdigest()
+	except FileNotFoundError:
+		return None
+
+
+def _to_json(value):
+	match value:
+		case Voice():
+			return value.voice_id
+		case Path():
+			return {"path": str(value.absolute()), "state": _file_state(value)}
+		case timedelta():
+			return value.total_seconds()
+		case list() | tuple():
+			return [_to_json(x) for x in value]
+		case _ if dataclasses.is_dataclass(value):
+			return {"type": type(value).__name__} | {f.name: _to_json(getattr(value, f.name)) for f in dataclasses.fields(value)}
+		case _:
+			return value
+
+
+def fingerprint(*values) -> str:
+	"""
+	Returns a hash of the given values. Voices are represented by their id and files by their path, modification
+	time and size.
+	"""
+	return hashlib.sha256(json.dumps(_to_json(list(values)), sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class BuildWorkspace:
+	"""
+	Persistent build directory of a script. It holds the rendered MLT project and a manifest (manifest.json),
+	which records what the previous build was made of: the compiled timeline, the page hashes of the PDFs, the
+	slide images, the voice samples, the MLT project and the rendered video. A rebuild compares the current
+	state with the manifest to skip the stages whose inputs did not change.
+	"""
+
+	def __init__(self, path: str | os.PathLike, script: str | os.PathLike):
+		self._path = Path(path)
+		os.makedirs(self._path, exist_ok=True)
+		self._previous = {}
+		try:
+			with open(self._path / _MANIFEST_FILE_NAME) as f:
+				manifest = json.load(f)
+			if manifest.get("version") == _MANIFEST_VERSION:
+				self._previous = manifest
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError) as ex:
+			logger.debug(f"ignoring invalid build manifest in {self._path}: {ex}")
+		self.manifest = {"version": _MANIFEST_VERSION, "script": str(Path(script).absolute())}
+
+	@staticmethod
+	def for_script(cache_path: str | os.PathLike, script: str | os.PathLike) -> "BuildWorkspace":
+		script = Path(script).absolute()
+		key = hashlib.sha256(str(script).encode("utf-8")).hexdigest()[:16]
+		return BuildWorkspace(Path(cache_path) / WORKSPACE_DIR_NAME / f"{script.name}_{key}", script)
+
+	@property
+	def path(self) -> Path:
+		return self._path
+
+	@property
+	def mlt_project_file(self) -> Path:
+		return self._path / "project.mlt"
+
+	def previous(self, key: str, default=None):
+		return self._previous.get(key, default)
+
+	def pdf_page_hashes(self, pdf: Path, compute) -> list[str]:
+		"""
+		Returns the page hashes of the given PDF, they are only recomputed if the file changed since the last build.
+		"""
+		state = _file_state(pdf)
+		entry = self._previous.get("pdfs", {}).get(str(pdf.absolute()))
+		if entry is not None and entry["state"] == state:
+			hashes = entry["page_hashes"]
+		else:
+			hashes = compute(pdf)
+		self.manifest.setdefault("pdfs", {})[str(pdf.absolute())] = {"state": state, "page_hashes": hashes}
+		return hashes
+
+	def is_project_up_to_date(self, timeline_fingerprint: str) -> bool:
+		"""
+		Checks if the MLT project of the last build can be reused, i.e., if the timeline and all PDFs are unchanged
+		and all files referenced by the project still exist.
+		"""
+		if self._previous.get("timeline") != timeline_fingerprint:
+			return False
+		for pdf, entry in self._previous.get("pdfs", {}).items():
+			if _file_state(pdf) != entry["state"]:
+				return False
+		if self._previous.get("mlt") != _file_hash(self.mlt_project_file):
+			return False
+		files = list(self._previous.get("slides", {}).keys()) + self._previous.get("samples", [])
+		return all(os.path.exists(x) for x in files)
+
+	def reuse_project(self):
+		for key in ("timeline", "pdfs", "slides", "samples", "mlt"):
+			if key in self._previous:
+				self.manifest[key] = self._previous[key]
+
+	def record_project(self, timeline_fingerprint: str, slides: dict[str, str], samples: list[str]):
+		self.manifest["timeline"] = timeline_fingerprint
+		self.manifest["slides"] = slides
+		self.manifest["samples"] = samples
+		self.manifest["mlt"] = _file_hash(self.mlt_project_file)
+
+	def output_fingerprint(self, *settings) -> str:
+		"""
+		Returns the fingerprint of the video rendered from the current project with the given settings.
+		"""
+		return fingerprint(self.manifest.get("slides"), self.manifest.get("mlt"), self.manifest.get("timeline"), list(settings))
+
+	def is_output_up_to_date(self, out_path: str | os.PathLike, output_fingerprint: str) -> bool:
+		output = self._previous.get("output")
+		return (
+			output is not None
+			and output["path"] == str(Path(out_path).absolute())
+			and output["fingerprint"] == output_fingerprint
+			and output["state"] == _file_state(out_path)
+		)
+
+	def record_output(self, out_path: str | os.PathLike, output_fingerprint: str):
+		self.manifest["output"] = {
+			"path": str(Path(out_path).absolute()),
+			"fingerprint": output_fingerprint,
+			"state": _file_state(out_path),
+		}
+
+	def save(self):
+		if "output" not in self.manifest and "output" in self._previous:
+			# nothing was rendered, the recorded video is still valid if its fingerprint matches in a later build
+			self.manifest["output"] = self._previous["output"]
+		fd, tmp_path = tempfile.mkstemp(prefix=".tavox_", dir=self._path)
+		with os.fdopen(fd, "w") as f:
+			json.dump(self.manifest, f, indent=1)
+		os.replace(tmp_path, self._path / _MANIFEST_FILE_NAME)
+		self._previous = self.manifest
+		self.manifest = {"version": _MANIFEST_VERSION, "script": self.manifest["script"]}
+
+
+def prune_workspaces(path: str | os.PathLike, max_age: float | None = None, dry_run: bool = False) -> dict[str, int]:
+	"""
+	Removes the build workspaces of scripts that no longer exist, or that have not been built for the given
+	number of seconds.
+	"""
+	workspaces = []
+	now = time.time()
+	for workspace in Path(path).glob("*"):
+		manifest_path = workspace / _MANIFEST_FILE_NAME
+		try:
+			with open(manifest_path) as f:
+				script = json.load(f)["script"]
+			last_used = manifest_path.stat().st_mtime
+		except (OSError, ValueError, KeyError):
+			script, last_used = None, workspace.stat().st_mtime
+		if (script is not None and not os.path.exists(script)) or (max_age is not None and last_used < now - max_age) or (script is None and last_used < now - 24 * 3600):
+			workspaces.append(workspace)
+
+	result = {"workspaces": len(workspaces), "size": sum(_disk_usage(x) for x in workspaces)}
+	if not dry_run:
+		for workspace in workspaces:
+			logger.debug(f"removing build workspace {workspace}")
+			shutil.rmtree(workspace, ignore_errors=True)
+	return result
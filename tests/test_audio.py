@@ -0,0 +1,121 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import wave
+import array
+import shutil
+
+from pathlib import Path
+
+import pytest
+
+from tavox import audio
+from tavox.audio import write_audio_track, AUDIO_TRACK_SAMPLE_RATE, AUDIO_TRACK_CHANNELS
+
+_FPS = 25
+
+
+def _write_wav(path: Path, sample_rate: int, num_samples: int, value: int = 1000, channels: int = 1):
+	with wave.open(str(path), "wb") as w:
+		w.setnchannels(channels)
+		w.setsampwidth(2)
+		w.setframerate(sample_rate)
+		w.writeframes(array.array("h", [value] * (num_samples * channels)).tobytes())
+
+
+def _read_track(path: Path) -> tuple[int, int, array.array]:
+	with wave.open(str(path), "rb") as w:
+		return w.getnchannels(), w.getframerate(), array.array("h", w.readframes(w.getnframes()))
+
+
+class _FakeFFmpeg:
+	"""
+	Counts the ffmpeg invocations and writes one second of a constant sample value to every raw output.
+	"""
+
+	def __init__(self):
+		self.calls: list[list[str]] = []
+
+	def __call__(self, arguments: list[str]):
+		self.calls.append(arguments)
+		for i, arg in enumerate(arguments):
+			if arg == "-ar":
+				Path(arguments[i + 2]).write_bytes(array.array("h", [7] * (AUDIO_TRACK_CHANNELS * AUDIO_TRACK_SAMPLE_RATE)).tobytes())
+
+
+def test_samples_in_another_format_are_decoded_in_few_ffmpeg_processes(tmp_path, monkeypatch):
+	fake = _FakeFFmpeg()
+	monkeypatch.setattr(audio, "run_ffmpeg", fake)
+	num_samples = audio._DECODE_BATCH_SIZE + 10
+	pieces = []
+	for i in range(num_samples):
+		# e.g., voice samples of Coqui TTS
+		_write_wav(tmp_path / f"{i}.wav", 22050, 22050)
+		pieces.append((i * _FPS, _FPS, tmp_path / f"{i}.wav"))
+	# a sample in the format of the track is not decoded at all
+	_write_wav(tmp_path / "native.wav", AUDIO_TRACK_SAMPLE_RATE, AUDIO_TRACK_SAMPLE_RATE, value=1000)
+	pieces.append((num_samples * _FPS, _FPS, tmp_path / "native.wav"))
+	total_length = (num_samples + 1) * _FPS
+
+	write_audio_track(pieces, total_length, _FPS, tmp_path / "track.wav", tmp_path, num_workers=4)
+
+	assert len(fake.calls) == 2
+	assert sorted(x.count("-i") for x in fake.calls) == [10, audio._DECODE_BATCH_SIZE]
+	channels, sample_rate, samples = _read_track(tmp_path / "track.wav")
+	assert (channels, sample_rate) == (AUDIO_TRACK_CHANNELS, AUDIO_TRACK_SAMPLE_RATE)
+	assert len(samples) == total_length // _FPS * AUDIO_TRACK_SAMPLE_RATE * AUDIO_TRACK_CHANNELS
+	assert set(samples[:-AUDIO_TRACK_SAMPLE_RATE * AUDIO_TRACK_CHANNELS]) == {7}
+	assert set(samples[-AUDIO_TRACK_SAMPLE_RATE * AUDIO_TRACK_CHANNELS:]) == {707}
+
+
+def test_track_format_needs_no_ffmpeg(tmp_path, monkeypatch):
+	fake = _FakeFFmpeg()
+	monkeypatch.setattr(audio, "run_ffmpeg", fake)
+	_write_wav(tmp_path / "mono.wav", AUDIO_TRACK_SAMPLE_RATE, AUDIO_TRACK_SAMPLE_RATE, value=1000)
+	_write_wav(tmp_path / "stereo.wav", AUDIO_TRACK_SAMPLE_RATE, AUDIO_TRACK_SAMPLE_RATE, value=600, channels=2)
+	pieces = [(0, _FPS, tmp_path / "mono.wav"), (_FPS, _FPS, tmp_path / "stereo.wav"), (2 * _FPS, _FPS, None), (3 * _FPS, _FPS, tmp_path / "mono.wav")]
+
+	write_audio_track(pieces, 4 * _FPS, _FPS, tmp_path / "track.wav", tmp_path)
+
+	assert fake.calls == []
+	_, _, samples = _read_track(tmp_path / "track.wav")
+	second = AUDIO_TRACK_SAMPLE_RATE * AUDIO_TRACK_CHANNELS
+	# mono samples are mixed into both channels at -3 dB like ffmpeg does
+	assert [set(samples[i * second:(i + 1) * second]) for i in range(4)] == [{707}, {600}, {0}, {707}]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not found")
+def test_decoding_with_ffmpeg(tmp_path, monkeypatch):
+	calls = []
+	run_ffmpeg = audio.run_ffmpeg
+	monkeypatch.setattr(audio, "run_ffmpeg", lambda arguments: (calls.append(arguments), run_ffmpeg(arguments)))
+	_write_wav(tmp_path / "a.wav", 22050, 22050, value=1000)
+	_write_wav(tmp_path / "b.wav", 24000, 24000, value=-1000)
+	pieces = [(0, _FPS, tmp_path / "a.wav"), (_FPS, _FPS, tmp_path / "b.wav")]
+
+	write_audio_track(pieces, 2 * _FPS, _FPS, tmp_path / "track.wav", tmp_path)
+
+	assert len(calls) == 1
+	_, _, samples = _read_track(tmp_path / "track.wav")
+	second = AUDIO_TRACK_SAMPLE_RATE * AUDIO_TRACK_CHANNELS
+	# ffmpeg mixes a mono channel into both stereo channels at -3 dB, the edges are skipped, where the resampler
+	# may smooth the signal
+	assert set(samples[second // 4:second * 3 // 4]) == {707}
+	assert set(samples[second + second // 4:second + second * 3 // 4]) == {-707}
@@ -0,0 +1,177 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import zlib
+
+from pathlib import Path
+
+import pytest
+
+from tavox import pdf
+from tavox.pdf import pdf_page_hashes
+
+
+def _write_pdf(
+	path: Path,
+	contents: list[bytes],
+	date: str = "20250101120000+01'00'",
+	file_id: str = "0123456789abcdef",
+	compressed: bool = False,
+	extra_objects: int = 0,
+	oc_on: bool = True,
+):
+	"""
+	Writes a document in the layout of pdfTeX: an information dictionary with timestamps, a file identifier in
+	the trailer, a font shared by all pages and, if compressed, an object stream and a cross-reference stream.
+	extra_objects unused objects are placed in front of the pages to shift all object numbers.
+	"""
+	objects: list[bytes] = [b""] * (extra_objects + 5 + 2 * len(contents))
+	catalog, pages, font, info, ocg = 1, 2, 3, 4, 5
+	first_page = 6 + extra_objects
+	for i in range(extra_objects):
+		objects[5 + i] = f"<< /Unused {i} >>".encode("ascii")
+	kids = " ".join(f"{first_page + 2 * i} 0 R" for i in range(len(contents)))
+	objects[catalog - 1] = (
+		f"<< /Type /Catalog /Pages {pages} 0 R /OCProperties << /OCGs [{ocg} 0 R] "
+		f"/D << /{'ON' if oc_on else 'OFF'} [{ocg} 0 R] >> >> >>"
+	).encode("ascii")
+	objects[pages - 1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(contents)} /MediaBox [0 0 400 300] >>".encode("ascii")
+	# the font refers back to itself, like the cyclic structures some producers write
+	objects[font - 1] = f"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Self {font} 0 R >>".encode("ascii")
+	objects[info - 1] = f"<< /Producer (pdfTeX-1.40.26) /CreationDate (D:{date}) /ModDate (D:{date}) >>".encode("ascii")
+	objects[ocg - 1] = b"<< /Type /OCG /Name (layer) >>"
+	streams = {}
+	for i, content in enumerate(contents):
+		page = first_page + 2 * i
+		objects[page - 1] = (
+			f"<< /Type /Page /Parent {pages} 0 R /Contents {page + 1} 0 R /Resources << /Font << /F1 {font} 0 R >> >> "
+			f"/Annots [<< /Subtype /Link /Dest [{first_page} 0 R /Fit] >>] >>"
+		).encode("ascii")
+		streams[page + 1] = content
+
+	trailer_id = f"/ID [<{file_id}> <{file_id}>]"
+	with open(path, "wb") as f:
+		f.write(b"%PDF-1.5\n")
+		offsets = {}
+
+		def write_object(num: int, body: bytes):
+			offsets[num] = f.tell()
+			f.write(f"{num} 0 obj\n".encode("ascii") + body + b"\nendobj\n")
+
+		def stream(d: str, data: bytes) -> bytes:
+			return f"<< {d} /Length {len(data)} >>\nstream\n".encode("ascii") + data + b"\nendstream"
+
+		for num, content in streams.items():
+			if compressed:
+				write_object(num, stream("/Filter /FlateDecode", zlib.compress(content)))
+			else:
+				write_object(num, stream("", content))
+		in_object_stream = [num for num in range(1, len(objects) + 1) if num not in streams] if compressed else []
+		for num in range(1, len(objects) + 1):
+			if num not in streams and num not in in_object_stream:
+				write_object(num, objects[num - 1])
+
+		if not compressed:
+			xref = f.tell()
+			f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii"))
+			for num in range(1, len(objects) + 1):
+				f.write(f"{offsets[num]:010d} 00000 n \n".encode("ascii"))
+			f.write(f"trailer\n<< /Size {len(objects) + 1} /Root {catalog} 0 R /Info {info} 0 R {trailer_id} >>\n".encode("ascii"))
+			f.write(f"startxref\n{xref}\n%%EOF\n".encode("ascii"))
+			return
+
+		object_stream_num = len(objects) + 1
+		header, body = [], b""
+		for num in in_object_stream:
+			header.append(f"{num} {len(body)}")
+			body += objects[num - 1] + b"\n"
+		header_data = (" ".join(header) + "\n").encode("ascii")
+		write_object(
+			object_stream_num,
+			stream(f"/Type /ObjStm /N {len(in_object_stream)} /First {len(header_data)} /Filter /FlateDecode", zlib.compress(header_data + body)),
+		)
+		xref_num = object_stream_num + 1
+		rows = [bytes([0, 0, 0, 0, 0])]
+		for num in range(1, xref_num + 1):
+			if num in in_object_stream:
+				rows.append(bytes([2]) + object_stream_num.to_bytes(3, "big") + in_object_stream.index(num).to_bytes(1, "big"))
+			elif num == xref_num:
+				rows.append(bytes([1]) + f.tell().to_bytes(3, "big") + bytes([0]))
+			else:
+				rows.append(bytes([1]) + offsets[num].to_bytes(3, "big") + bytes([0]))
+		xref = f.tell()
+		write_object(
+			xref_num,
+			stream(
+				f"/Type /XRef /Size {xref_num + 1} /W [1 3 1] /Root {catalog} 0 R /Info {info} 0 R {trailer_id} /Filter /FlateDecode",
+				zlib.compress(b"".join(rows)),
+			),
+		)
+		f.write(f"startxref\n{xref}\n%%EOF\n".encode("ascii"))
+
+
+_CONTENTS = [b"BT /F1 24 Tf 10 10 Td (first) Tj ET", b"BT /F1 24 Tf 10 10 Td (second) Tj ET", b"0.5 g 0 0 100 100 re f"]
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_metadata_does_not_change_page_hashes(tmp_path, compressed):
+	_write_pdf(tmp_path / "a.pdf", _CONTENTS, compressed=compressed)
+	_write_pdf(tmp_path / "b.pdf", _CONTENTS, date="20250302093011Z", file_id="fedcba98765432100123", compressed=compressed)
+	assert (tmp_path / "a.pdf").read_bytes() != (tmp_path / "b.pdf").read_bytes()
+	hashes = pdf_page_hashes(tmp_path / "a.pdf")
+	assert len(hashes) == len(_CONTENTS)
+	assert len(set(hashes)) == len(_CONTENTS)
+	assert pdf_page_hashes(tmp_path / "b.pdf") == hashes
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_only_changed_pages_change_their_hashes(tmp_path, compressed):
+	_write_pdf(tmp_path / "a.pdf", _CONTENTS, compressed=compressed)
+	changed = list(_CONTENTS)
+	changed[1] = b"BT /F1 24 Tf 10 10 Td (changed) Tj ET"
+	# the changed document also has different object numbers
+	_write_pdf(tmp_path / "b.pdf", changed, date="20250302093011Z", compressed=compressed, extra_objects=3)
+	a, b = pdf_page_hashes(tmp_path / "a.pdf"), pdf_page_hashes(tmp_path / "b.pdf")
+	assert a[0] == b[0] and a[2] == b[2]
+	assert a[1] != b[1]
+
+
+def test_optional_content_configuration_changes_all_hashes(tmp_path):
+	_write_pdf(tmp_path / "a.pdf", _CONTENTS)
+	_write_pdf(tmp_path / "b.pdf", _CONTENTS, oc_on=False)
+	a, b = pdf_page_hashes(tmp_path / "a.pdf"), pdf_page_hashes(tmp_path / "b.pdf")
+	assert all(x != y for x, y in zip(a, b))
+
+
+def test_fallback_ignores_metadata(tmp_path, monkeypatch):
+	monkeypatch.setattr(pdf, "pdfinfo_get_page_count", lambda path: len(_CONTENTS))
+	# pdfTeX writes timestamps and identifiers of fixed length, so the offsets in the file stay the same
+	for name, date, file_id in (("a.pdf", "20250101120000+01'00'", "00ff"), ("b.pdf", "20250302093011+02'00'", "ff00")):
+		_write_pdf(tmp_path / name, _CONTENTS, date=date, file_id=file_id)
+		# without the startxref keyword the document cannot be parsed
+		data = (tmp_path / name).read_bytes()
+		(tmp_path / name).write_bytes(data.replace(b"startxref", b"startref"))
+	hashes = pdf_page_hashes(tmp_path / "a.pdf")
+	assert len(set(hashes)) == len(_CONTENTS)
+	assert pdf_page_hashes(tmp_path / "b.pdf") == hashes
+
+	_write_pdf(tmp_path / "c.pdf", _CONTENTS[:2] + [b"0.25 g 0 0 100 100 re f"])
+	(tmp_path / "c.pdf").write_bytes((tmp_path / "c.pdf").read_bytes().replace(b"startxref", b"startref"))
+	assert pdf_page_hashes(tmp_path / "c.pdf")[0] != hashes[0]
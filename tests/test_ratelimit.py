@@ -0,0 +1,144 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import email.utils
+
+import pytest
+
+from tavox import ratelimit
+from tavox.ratelimit import RateLimiter, get_rate_limiter
+
+
+class _FakeClock:
+	"""
+	Replaces the time module of the rate limiter, sleeping advances the clock immediately.
+	"""
+
+	def __init__(self):
+		self.now = 1000.0
+		self.slept = 0.0
+
+	def monotonic(self) -> float:
+		return self.now
+
+	def time(self) -> float:
+		return 1_700_000_000.0 + self.now
+
+	def sleep(self, seconds: float):
+		self.slept += seconds
+		self.now += seconds
+
+
+class _NoJitter:
+
+	@staticmethod
+	def uniform(a: float, b: float) -> float:
+		return b
+
+
+@pytest.fixture
+def clock(monkeypatch) -> _FakeClock:
+	clock = _FakeClock()
+	monkeypatch.setattr(ratelimit, "time", clock)
+	monkeypatch.setattr(ratelimit, "random", _NoJitter())
+	return clock
+
+
+def test_request_budget(clock):
+	limiter = RateLimiter(requests_per_minute=60)
+	for _ in range(60):
+		limiter.acquire()
+	assert clock.slept == 0
+	limiter.acquire()
+	assert clock.slept == pytest.approx(1.0)
+
+
+def test_character_budget(clock):
+	limiter = RateLimiter(chars_per_minute=600)
+	limiter.acquire(300)
+	limiter.acquire(300)
+	assert clock.slept == 0
+	limiter.acquire(300)
+	assert clock.slept == pytest.approx(30.0)
+	# a request larger than the whole budget waits for a full bucket
+	limiter.acquire(6000)
+	assert clock.slept == pytest.approx(90.0)
+
+
+def test_limits_are_adopted_from_headers(clock):
+	limiter = RateLimiter()
+	limiter.update_from_headers({
+		"X-RateLimit-Limit-Requests": "120",
+		"X-RateLimit-Remaining-Requests": "0",
+		"X-RateLimit-Reset-Requests": "2s",
+		"x-ratelimit-limit-tokens": "6000",
+		"x-ratelimit-remaining-tokens": "5000",
+		"x-ratelimit-reset-tokens": "6m0s",
+	})
+	limiter.acquire(100)
+	# the request budget is exhausted until it is reset, the character budget is not
+	assert clock.slept == pytest.approx(2.0)
+
+
+def test_configured_budgets_take_precedence_over_headers(clock):
+	limiter = RateLimiter(requests_per_minute=6)
+	limiter.update_from_headers({"x-ratelimit-limit-requests": "600", "x-ratelimit-remaining-requests": "600"})
+	for _ in range(6):
+		limiter.acquire()
+	limiter.acquire()
+	assert clock.slept == pytest.approx(10.0)
+
+
+@pytest.mark.parametrize("headers, expected", [
+	({"retry-after-ms": "1500"}, 1.5),
+	({"Retry-After": "3"}, 3.0),
+	({"retry-after": email.utils.formatdate(1_700_000_000.0 + 1000.0 + 20, usegmt=True)}, 20.0),
+])
+def test_backoff_uses_retry_after(clock, headers, expected):
+	limiter = RateLimiter(base_delay=0.5)
+	delay = limiter.backoff(0, headers)
+	# plus the jitter of at most base_delay
+	assert delay == pytest.approx(expected + 0.5)
+	# the pause applies to all requests
+	limiter.acquire()
+	assert clock.slept == pytest.approx(expected + 0.5)
+
+
+def test_exponential_backoff(clock):
+	limiter = RateLimiter(base_delay=1.0, max_delay=60.0)
+	assert [limiter.backoff(attempt) for attempt in range(8)] == [1, 2, 4, 8, 16, 32, 60, 60]
+
+
+def test_shared_limiter_keeps_the_stricter_budget(clock):
+	limiter = get_rate_limiter("test/stricter-budget")
+	limiter.configure(requests_per_minute=60, chars_per_minute=1000)
+	# e.g., a second voice of the same model, which only sets a request budget
+	limiter.configure(requests_per_minute=120)
+	limiter.configure(chars_per_minute=500)
+	assert get_rate_limiter("test/stricter-budget") is limiter
+	for _ in range(60):
+		limiter.acquire()
+	limiter.acquire()
+	assert clock.slept == pytest.approx(1.0)
+	slept = clock.slept
+	limiter.acquire(500)
+	limiter.acquire(500)
+	# the second request waits a minute for 500 characters, not half a minute
+	assert clock.slept - slept == pytest.approx(61.0)
@@ -0,0 +1,103 @@
+#
+# This file is part of tavox.
+#
+# Copyright (C) 2025 Florian Huemer
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import os
+import sys
+import uuid
+
+from pathlib import Path
+
+from tavox.voices import CoquiTTS
+
+# Stands in for the Python interpreter of the Coqui TTS installation, i.e., it is called with the path of
+# coqui_worker.py and its arguments. It speaks the worker protocol, but exits after serving a given number of
+# requests (like a worker killed by the OOM killer). Every start is logged.
+_WORKER_STUB = """
+import sys, json
+log_file, num_requests = sys.argv[1:3]
+with open(log_file, "a") as f:
+	f.write("start\\n")
+print(json.dumps({"ready": True}), flush=True)
+for _ in range(int(num_requests)):
+	request = json.loads(sys.stdin.readline())
+	for item in request.get("batch", [request]):
+		with open(item["out_path"], "w") as f:
+			f.write("worker:" + item["text"])
+	print(json.dumps({"ok": True}), flush=True)
+"""
+
+_TTS_STUB = """
+import sys
+out_path = [x for x in sys.argv if x.startswith("--out_path=")][0].split("=", 1)[1]
+with open(out_path, "w") as f:
+	f.write("tts:" + sys.argv[sys.argv.index("--text") + 1])
+"""
+
+
+def _write_stub(path: Path, code: str, *args: str):
+	# the worker is started as [python, coqui_worker.py, --model, MODEL], the stub gets its settings first
+	script = path.with_suffix(".py")
+	script.write_text(code)
+	path.write_text(f"#!/bin/sh\nexec {sys.executable} {script} {' '.join(args)} \"$@\"\n")
+	path.chmod(0o755)
+
+
+def _voice(tmp_path: Path, num_requests: int) -> tuple[CoquiTTS, Path]:
+	log_file = tmp_path / "starts.log"
+	_write_stub(tmp_path / "python", _WORKER_STUB, str(log_file), str(num_requests))
+	# a unique model name, such that no running worker daemon is used
+	return CoquiTTS(f"stub/{uuid.uuid4().hex}", python=str(tmp_path / "python")), log_file
+
+
+def _starts(log_file: Path) -> int:
+	return len(log_file.read_text().splitlines()) if log_file.exists() else 0
+
+
+def test_worker_is_restarted_after_it_terminated(tmp_path):
+	voice, log_file = _voice(tmp_path, num_requests=1)
+	try:
+		for i in range(3):
+			sample_dir = tmp_path / f"sample{i}"
+			sample_dir.mkdir()
+			voice.generate_sample(f"text {i}", sample_dir)
+			assert (sample_dir / "sample.wav").read_text() == f"worker:text {i}"
+		voice.generate_samples(["a", "b"], tmp_path)
+		assert [(tmp_path / f"{i}.wav").read_text() for i in range(2)] == ["worker:a", "worker:b"]
+	finally:
+		voice.close()
+	# the first worker served the first request, every other request needed a new one
+	assert _starts(log_file) == 4
+
+
+def test_tts_command_is_used_if_the_restarted_worker_terminates_as_well(tmp_path, monkeypatch):
+	bin_dir = tmp_path / "bin"
+	bin_dir.mkdir()
+	_write_stub(bin_dir / "tts", _TTS_STUB)
+	monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+	voice, log_file = _voice(tmp_path, num_requests=0)
+	try:
+		voice.generate_sample("first", tmp_path)
+		assert (tmp_path / "sample.wav").read_text() == "tts:first"
+		voice.generate_samples(["second"], tmp_path)
+		assert (tmp_path / "0.wav").read_text() == "tts:second"
+	finally:
+		voice.close()
+	# the worker was started and restarted once, afterwards it is not used any more
+	assert _starts(log_file) == 2